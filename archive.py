@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+""" Content-addressed archive of every version of the downloaded files
+
+get-covid-data.py --archive DIR adds each new download here, parse-data.py --as_of DATE parses
+the files as they were on a past day.
+
+    <archive_dir>/
+        log.jsonl               one line per new version: fetch time, file name, sha1
+        objects/<ab>/<sha1>.gz      a full version, gzip compressed
+        objects/<ab>/<sha1>.delta   a version as a delta against an older one, gzip compressed
+        as-of/                  the files of the last --as_of checkout, with their own
+                                .parse-cache so consecutive checkouts parse incrementally
+
+Objects are named by the sha1 of the uncompressed content, so a download identical to any
+earlier version costs one log line, and one identical to the latest version of its file not
+even that.
+
+CSSE and OWID restate their whole history every day: CSSE lines grow by one column, OWID gets
+rows inserted per location.  A delta is therefore a list of line operations against the
+previous version of the same file
+
+    c <start> <count>       copy count lines of the base from line start
+    x <start> <count> <n>   the same lines without their line ends, each followed by its own
+                            line of the n bytes after the operation (the new columns)
+    i <n>                   n literal bytes
+
+which is a few kilobytes where the full file is megabytes.  Every MAX_CHAIN versions, or when
+the delta is over a quarter of the file, a version is stored whole instead, so building any
+version reads at most MAX_CHAIN deltas.
+"""
+
+import datetime as dt
+import gzip
+import hashlib
+import json
+import os
+import rawfile
+import tempfile
+import threading
+
+MAX_CHAIN = 16
+KEY_BYTES = 48
+CACHE_SIZE = 8
+
+
+def content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+def _stripped(line):
+    return line.rstrip(b"\r\n")
+
+
+def make_delta(base, target):
+    """ the line operations that turn base into target, both bytes """
+    base_lines = base.splitlines(keepends=True)
+    exact, by_key = {}, {}
+    for index, line in enumerate(base_lines):
+        exact.setdefault(line, index)
+        by_key.setdefault(line[:KEY_BYTES], index)
+    ops = []
+    # the run being collected: copied lines, or base lines that grew and their tails
+    run_op, run_start, run_count, tails = None, 0, 0, []
+
+    def flush():
+        if run_op == b"c":
+            ops.append(b"c %d %d\n" % (run_start, run_count))
+        elif run_op == b"x":
+            tail = b"".join(tails)
+            ops.append(b"x %d %d %d\n" % (run_start, run_count, len(tail)))
+            ops.append(tail)
+
+    expected = 0
+    for line in target.splitlines(keepends=True):
+        index, op = exact.get(line), b"c"
+        if index is None:
+            # a line of the base that grew, looked for where the last one left off, then by key
+            for candidate in (expected, by_key.get(line[:KEY_BYTES])):
+                if candidate is not None and candidate < len(base_lines):
+                    prefix = _stripped(base_lines[candidate])
+                    if line.startswith(prefix) and len(prefix) >= len(line) // 2:
+                        index, op = candidate, b"x"
+                        break
+        if index is None:
+            flush()
+            run_op = None
+            ops.append(b"i %d\n" % len(line))
+            ops.append(line)
+            continue
+        if op != run_op or index != run_start + run_count:
+            flush()
+            run_op, run_start, run_count, tails = op, index, 0, []
+        run_count += 1
+        if op == b"x":
+            tails.append(line[len(_stripped(base_lines[index])):])
+        expected = index + 1
+    flush()
+    return b"".join(ops)
+
+
+def apply_delta(base, delta):
+    base_lines = base.splitlines(keepends=True)
+    out = []
+    pos = 0
+    while pos < len(delta):
+        end = delta.index(b"\n", pos)
+        op, *numbers = delta[pos:end].split(b" ")
+        numbers = [int(number) for number in numbers]
+        pos = end + 1
+        if op == b"c":
+            start, count = numbers
+            out.extend(base_lines[start:start + count])
+        elif op == b"x":
+            start, count, size = numbers
+            tails = delta[pos:pos + size].splitlines(keepends=True)
+            pos += size
+            for line, tail in zip(base_lines[start:start + count], tails):
+                out.append(_stripped(line))
+                out.append(tail)
+        elif op == b"i":
+            size, = numbers
+            out.append(delta[pos:pos + size])
+            pos += size
+        else:
+            raise ValueError(f"bad delta operation {op!r}")
+    return b"".join(out)
+
+
+class Version(object):
+    def __init__(self, fetched, filename, sha1):
+        self.fetched = fetched
+        self.filename = filename
+        self.sha1 = sha1
+
+
+class Archive(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self._cache = {}
+
+    # storage
+
+    def _object_path(self, sha1, kind):
+        return os.path.join(self.directory, "objects", sha1[:2], f"{sha1}.{kind}")
+
+    def _write_object(self, sha1, kind, data):
+        path = self._object_path(sha1, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, 'wb') as object_file:
+            object_file.write(gzip.compress(data, compresslevel=rawfile.GZIP_LEVEL, mtime=0))
+        os.replace(tmppath, path)
+
+    def _read_object(self, path):
+        with open(path, 'rb') as object_file:
+            return gzip.decompress(object_file.read())
+
+    def has(self, sha1):
+        return any(os.path.isfile(self._object_path(sha1, kind)) for kind in ("gz", "delta"))
+
+    def _chain(self, sha1):
+        """ the base of each delta from sha1 back to a full version, newest first """
+        chain = [sha1]
+        while not os.path.isfile(self._object_path(chain[-1], "gz")):
+            with gzip.open(self._object_path(chain[-1], "delta"), 'rb') as delta_file:
+                chain.append(delta_file.readline().split()[1].decode())
+        return chain
+
+    def content(self, sha1):
+        """ the bytes of version sha1, applying its deltas from the nearest full version """
+        if sha1 in self._cache:
+            return self._cache[sha1]
+        chain = self._chain(sha1)
+        for depth in range(len(chain)):
+            if chain[depth] in self._cache:
+                chain = chain[:depth + 1]
+                break
+        content = self._cache.get(chain[-1])
+        if content is None:
+            content = self._read_object(self._object_path(chain[-1], "gz"))
+        for link in reversed(chain[:-1]):
+            delta = self._read_object(self._object_path(link, "delta"))
+            content = apply_delta(content, delta[delta.index(b"\n") + 1:])
+            if content_hash(content) != link:
+                raise ValueError(f"archive object {link} does not rebuild to its hash")
+        self._remember(sha1, content)
+        return content
+
+    def _remember(self, sha1, content):
+        if len(self._cache) >= CACHE_SIZE:
+            del self._cache[next(iter(self._cache))]
+        self._cache[sha1] = content
+
+    # versions
+
+    def versions(self):
+        """ every version in the log, oldest first """
+        try:
+            with open(os.path.join(self.directory, "log.jsonl")) as log_file:
+                entries = [json.loads(line) for line in log_file if line.strip()]
+        except OSError:
+            return []
+        return [Version(dt.datetime.fromisoformat(entry["fetched"]), entry["file"], entry["sha1"])
+                for entry in entries]
+
+    def latest(self, as_of=None):
+        """ filename -> the last Version fetched on or before the day as_of (default any) """
+        latest = {}
+        for version in self.versions():
+            if as_of is None or version.fetched.date() <= as_of:
+                latest[version.filename] = version
+        return latest
+
+    def days(self):
+        """ the days with a new version of some file, oldest first """
+        return sorted({version.fetched.date() for version in self.versions()})
+
+    def add(self, filename, path, fetched=None):
+        """ archives the file at path (compressed or not) as the newest version of filename
+
+        Returns the Version, or None if it is the same content as the newest one.
+        """
+        with rawfile.open_binary(path) as infile:
+            content = infile.read()
+        sha1 = content_hash(content)
+        with self.lock:
+            previous = self.latest().get(filename)
+            if previous is not None and previous.sha1 == sha1:
+                return None
+            if not self.has(sha1):
+                self._store(sha1, content, previous)
+            version = Version(fetched or dt.datetime.now(dt.timezone.utc), filename, sha1)
+            with open(os.path.join(self.directory, "log.jsonl"), 'a') as log_file:
+                log_file.write(json.dumps({"fetched": version.fetched.isoformat(),
+                                           "file": filename, "sha1": sha1}) + "\n")
+        return version
+
+    def _store(self, sha1, content, previous):
+        self._remember(sha1, content)
+        if previous is not None and len(self._chain(previous.sha1)) < MAX_CHAIN:
+            base = self.content(previous.sha1)
+            delta = make_delta(base, content)
+            # tails split back by line end, which odd mixes of line ends could defeat
+            if len(delta) < len(content) / 4 and apply_delta(base, delta) == content:
+                self._write_object(sha1, "delta", b"base %s\n" % previous.sha1.encode() + delta)
+                return
+        self._write_object(sha1, "gz", content)
+
+    # checkout
+
+    def checkout(self, as_of, directory=None):
+        """ writes the files as they were on the day as_of into directory (default
+            <archive>/as-of) and returns it
+
+        Files whose version did not change since the last checkout are left alone, so their
+        snapshots stay fresh.
+        """
+        directory = directory or os.path.join(self.directory, "as-of")
+        os.makedirs(directory, exist_ok=True)
+        state_path = os.path.join(directory, ".checkout.json")
+        try:
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            state = {}
+        latest = self.latest(as_of)
+        for filename in set(state) - set(latest):
+            for path in rawfile.stored_paths(directory, filename):
+                if os.path.isfile(path):
+                    os.unlink(path)
+        for filename, version in latest.items():
+            path = os.path.join(directory, filename)
+            if state.get(filename) == version.sha1 and os.path.isfile(path):
+                continue
+            fd, tmppath = tempfile.mkstemp(dir=directory, suffix=".part")
+            with os.fdopen(fd, 'wb') as outfile:
+                outfile.write(self.content(version.sha1))
+            os.replace(tmppath, path)
+        with open(state_path, 'w') as state_file:
+            json.dump({filename: version.sha1 for filename, version in latest.items()}, state_file)
+        return directory
+
+
+def main():
+    header = b"Province/State,Country/Region,Lat,Long," + b",".join(b"d%d" % n for n in range(60))
+    rows = [b"%d,Country %d,1.0,2.0," % (n, n) + b",".join(b"%d" % (n * day) for day in range(60))
+            for n in range(200)]
+    first = b"\r\n".join([header] + rows) + b"\r\n"
+    grown = b"\r\n".join([header + b",d60"] + [row + b",4" for row in rows[:150]] +
+                         [b"new row"] + [row + b",5" for row in rows[151:]]) + b"\r\n"
+    with tempfile.TemporaryDirectory() as tmp:
+        store = Archive(os.path.join(tmp, "archive"))
+        paths = []
+        for name, content in (("v1.csv", first), ("v2.csv", grown), ("v3.csv", first)):
+            paths.append(os.path.join(tmp, name))
+            with open(paths[-1], 'wb') as outfile:
+                outfile.write(content)
+        day = dt.datetime(2020, 4, 1, 12, tzinfo=dt.timezone.utc)
+        v1 = store.add("data.csv", paths[0], day)
+        same = store.add("data.csv", paths[0], day + dt.timedelta(hours=1))
+        v2 = store.add("data.csv", paths[1], day + dt.timedelta(days=1))
+        v3 = store.add("data.csv", paths[2], day + dt.timedelta(days=2))
+        delta = make_delta(first, grown)
+        checkout = store.checkout(day.date() + dt.timedelta(days=1))
+        with open(os.path.join(checkout, "data.csv"), 'rb') as infile:
+            checked_out = infile.read()
+        print(all([
+            same is None,
+            v3.sha1 == v1.sha1,
+            [version.sha1 for version in store.versions()] == [v1.sha1, v2.sha1, v1.sha1],
+            os.path.isfile(store._object_path(v2.sha1, "delta")),
+            len(delta) < len(grown) / 20,
+            apply_delta(first, delta) == grown,
+            Archive(store.directory).content(v2.sha1) == grown,
+            checked_out == grown,
+            store.days() == [day.date() + dt.timedelta(days=n) for n in range(3)],
+            store.latest(day.date() - dt.timedelta(days=1)) == {},
+        ]))
+
+
+if __name__ == '__main__':
+    main()
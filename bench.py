@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+""" Benchmarks for every stage of parse-data.py on synthetic data
+
+Generates CSSE, covidtracker and OWID csv files of the requested size, then times
+
+    ingest:<file>       reading one file into its raw store
+    normalize-cold      normalize() on every distinct region of the CSSE file, empty caches
+    normalize-warm      the same calls again, answered from the memo cache
+    normalize-match     region_match lookups of every country name with a letter dropped
+    derive:<step>       each derived-metric helper of parsers.py, summed over all sources
+    derive:materialize  computing the lazy rate types of every source
+    merge               merging the per-file stores into the master map
+    reconcile           comparing the sources with reconcile.py
+    metrics             every metric of metrics.py, with made up populations
+    write:<format>      writing the master map with writer.py to /dev/null
+    changes             hashing every series of the master map with changes.py
+    stream              parse-data.py --stream from the files to /dev/null, see streaming.py
+
+Each stage reports the best time over --repeat runs, its throughput and the peak RSS of the
+process after the stage (a high-water mark, so it only ever grows).  --save_baseline keeps the
+times in a json file and --baseline compares against one, flagging stages that got slower by
+more than --threshold (stages under NOISE_FLOOR are never flagged); the exit status is 1 when
+any did.
+
+    python bench.py --regions 3300 --days 1100      # roughly county level over three years
+    python bench.py --compress gzip                 # ingest from gzip files instead
+"""
+
+import argparse
+import changes
+import contextlib
+import csv
+import datetime as dt
+import functools
+import instrument
+import json
+import metrics
+import os
+import parsers
+import pipeline
+import random
+import rawfile
+import reconcile
+import region_normalize as rn
+import streaming
+import sys
+import tempfile
+import time
+import writer
+
+DERIVE_STEPS = ["fill_gaps_for_source", "calc_deltas", "add_aggregations", "calc_rates",
+                "calc_weighted_rates"]
+WRITE_FORMATS = ["text", "csv", "jsonl"]
+# stages faster than this are too noisy to call a regression
+NOISE_FLOOR = 0.005
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--regions', default='500', type=int, nargs='?',
+                        help="number of CSSE rows, covidtracker and OWID get as many as they have")
+    parser.add_argument('--days', default='365', type=int, nargs='?',
+                        help="number of days in every file")
+    parser.add_argument('--seed', default='1', type=int, nargs='?')
+    parser.add_argument('--repeat', default='3', type=int, nargs='?',
+                        help="runs per stage, the best one is reported")
+    parser.add_argument('-d', '--datadir', default=None, type=str, nargs='?',
+                        help="keep the generated files here instead of a temporary directory")
+    parser.add_argument('--compress', default='none', choices=list(rawfile.CODECS) + ["none"],
+                        help="store the generated files compressed, like get-covid-data.py")
+    parser.add_argument('--baseline', default=None, type=str, nargs='?',
+                        help="json file from --save_baseline to compare against")
+    parser.add_argument('--save_baseline', default=None, type=str, nargs='?',
+                        help="write the stage times to this json file")
+    parser.add_argument('--threshold', default='0.1', type=float, nargs='?',
+                        help="relative slowdown against the baseline that counts as a regression")
+    args = parser.parse_args()
+    return args
+
+
+# synthetic data
+
+def cumulative(rng, n_days, growth):
+    """ a running total with the glitches of the real files: missing days and zero reports """
+    total = rng.randint(0, 5)
+    values = []
+    for day in range(n_days):
+        total += rng.randint(0, growth + day // 4)
+        if rng.random() < 0.03:
+            values.append("")
+        elif rng.random() < 0.01:
+            values.append("0")
+        else:
+            values.append(str(total))
+    return values
+
+
+def country_names():
+    return [name for name, country in rn.COUNTRIES.items() if country["name"] == name]
+
+
+def csse_regions(n_regions):
+    """ (province, country) pairs: every country, then US states, then made up provinces """
+    regions = [("", name) for name in country_names()]
+    regions += [(state, "US") for state in rn.STATES]
+    countries = country_names()
+    index = 0
+    while len(regions) < n_regions:
+        regions.append((f"Province {index}", countries[index % len(countries)]))
+        index += 1
+    return regions[:n_regions]
+
+
+def write_csse(filepath, regions, start, n_days, growth, rng):
+    dates = [start + dt.timedelta(day) for day in range(n_days)]
+    with open(filepath, 'w', newline='') as csvfile:
+        out = csv.writer(csvfile)
+        out.writerow(["Province/State", "Country/Region", "Lat", "Long"] +
+                     [f"{date.month}/{date.day}/{date.year % 100}" for date in dates])
+        for province, country in regions:
+            out.writerow([province, country, "0.0", "0.0"] + cumulative(rng, n_days, growth))
+
+
+def write_covidtracker(filepath, start, n_days, rng):
+    with open(filepath, 'w', newline='') as csvfile:
+        out = csv.writer(csvfile)
+        out.writerow(["date", "state", "positive", "negative", "death", "total"])
+        columns = {state: (cumulative(rng, n_days, 40), cumulative(rng, n_days, 2))
+                   for state in rn.REV_STATES}
+        for day in reversed(range(n_days)):
+            date = f"{start + dt.timedelta(day):%Y%m%d}"
+            for state, (cases, deaths) in columns.items():
+                out.writerow([date, state, cases[day], "", deaths[day], ""])
+
+
+def write_owid(filepath, locations, start, n_days, rng):
+    with open(filepath, 'w', newline='') as csvfile:
+        out = csv.writer(csvfile)
+        out.writerow(["date", "location", "new_cases", "new_deaths", "total_cases",
+                      "total_deaths"])
+        for location in locations:
+            total_cases = total_deaths = 0
+            for day in range(n_days):
+                new_cases, new_deaths = rng.randint(0, 50 + day), rng.randint(0, 3)
+                total_cases += new_cases
+                total_deaths += new_deaths
+                out.writerow([f"{start + dt.timedelta(day):%Y-%m-%d}", location, new_cases,
+                              new_deaths, total_cases, total_deaths])
+
+
+def generate(datadir, n_regions, n_days, seed, codec=None):
+    """ writes one file per entry of pipeline.SOURCES into datadir, compressed with codec """
+    rng = random.Random(seed)
+    start = dt.date(2020, 1, 22)
+    regions = csse_regions(n_regions)
+    write_covidtracker(os.path.join(datadir, "covidtracker-daily.csv"), start, n_days, rng)
+    write_csse(os.path.join(datadir, "csse-confirmed.csv"), regions, start, n_days, 40, rng)
+    write_csse(os.path.join(datadir, "csse-deaths.csv"), regions, start, n_days, 2, rng)
+    locations = ["World"] + country_names()[:max(n_regions, 1)]
+    write_owid(os.path.join(datadir, "owid-full_data.csv"), locations, start, n_days, rng)
+    if codec:
+        for source in pipeline.SOURCES:
+            rawfile.compress_file(os.path.join(datadir, source.filename), codec)
+    return regions
+
+
+# measuring
+
+class Stage(object):
+    def __init__(self, name, seconds, items, unit):
+        self.name = name
+        self.seconds = seconds
+        self.items = items
+        self.unit = unit
+        self.peak_rss_mb = instrument.peak_rss_mb()
+
+    def rate(self):
+        return self.items / self.seconds if self.seconds else float("inf")
+
+
+def best_of(repeat, function):
+    """ the smallest wall time of repeat calls to function, and its last result """
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def count_lines(filepath):
+    with rawfile.open_binary(filepath) as infile:
+        return sum(1 for _ in infile) - 1
+
+
+@contextlib.contextmanager
+def timed_steps(totals):
+    """ wraps the parsers helpers in DERIVE_STEPS, adding their run time to totals """
+    originals = {name: getattr(parsers, name) for name in DERIVE_STEPS}
+
+    def timed(name, function, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            totals[name] = totals.get(name, 0.0) + time.perf_counter() - start
+
+    for name, function in originals.items():
+        setattr(parsers, name, functools.partial(timed, name, function))
+    try:
+        yield totals
+    finally:
+        for name, function in originals.items():
+            setattr(parsers, name, function)
+
+
+def bench_ingest(args, sources):
+    stages, raws = [], []
+    with open(os.devnull, 'w') as devnull:
+        for source in sources:
+            with contextlib.redirect_stdout(devnull):
+                seconds, raw = best_of(args.repeat,
+                                       functools.partial(pipeline.ingest_source, args, source))
+            rows = count_lines(pipeline.source_path(args, source))
+            stages.append(Stage(f"ingest:{source.filename}", seconds, rows, "rows"))
+            raws.append(raw)
+    return stages, raws
+
+
+def bench_normalize(args, regions):
+    pairs = [(country, province) for province, country in regions]
+
+    def cold():
+        rn.reset_normalize_cache()
+        return rn.normalize_column(*zip(*pairs))
+
+    cold_seconds, _ = best_of(args.repeat, cold)
+    warm_seconds, _ = best_of(args.repeat, lambda: [rn.normalize(*pair) for pair in pairs])
+    # misspelled names, which only the trigram index resolves
+    names = [name[:1] + name[2:] for name in country_names()]
+    matcher = rn.get_matcher()
+    match_seconds, _ = best_of(args.repeat, lambda: [matcher.match(name) for name in names])
+    return [Stage("normalize-cold", cold_seconds, len(pairs), "regions"),
+            Stage("normalize-warm", warm_seconds, len(pairs), "regions"),
+            Stage("normalize-match", match_seconds, len(names), "names")]
+
+
+def bench_derive(args, sources, raws):
+    best = {}
+    cells = sum(len(raw.regions) * raw.n_days for raw in raws)
+    partials = []
+    for _ in range(args.repeat):
+        partials = [raw.copy() for raw in raws]
+        with timed_steps({}) as totals:
+            for source, partial in zip(sources, partials):
+                source.parser.derive(partial)
+        # the rate types are lazy, computing them is what derive used to do
+        start = time.perf_counter()
+        for partial in partials:
+            partial.materialize()
+        totals["materialize"] = time.perf_counter() - start
+        for name, seconds in totals.items():
+            best[name] = min(best.get(name, float("inf")), seconds)
+    stages = [Stage(f"derive:{name}", best[name], cells, "cells")
+              for name in DERIVE_STEPS + ["materialize"] if name in best]
+    return stages, partials
+
+
+def bench_merge(args, partials):
+    def merge():
+        master_map = parsers.build_master_dict()
+        for partial in partials:
+            master_map.merge(partial)
+        return master_map
+
+    seconds, master_map = best_of(args.repeat, merge)
+    cells = sum(len(partial.regions) * partial.n_days for partial in partials)
+    return [Stage("merge", seconds, cells, "cells")], master_map
+
+
+def bench_reconcile(args, master_map):
+    cells = sum(master_map.array(source, datatype).size
+                for datatype in reconcile.TYPES for source in master_map
+                if master_map.has_array(source, datatype))
+    seconds, _ = best_of(args.repeat, lambda: [reconcile.reconcile(master_map, datatype)
+                                               for datatype in reconcile.TYPES])
+    return [Stage("reconcile", seconds, cells, "cells")]
+
+
+def bench_metrics(args, master_map):
+    # on a copy, so the write stages still see the parsed types only
+    scratch = master_map.copy()
+    populations = {region: 1e6 for region in scratch.regions}
+    seconds, _ = best_of(args.repeat, lambda: metrics.compute(scratch, metrics.METRICS,
+                                                              populations))
+    cells = sum(scratch.array(source, metric.name).size
+                for metric in metrics.METRICS for source in scratch
+                if scratch.has_array(source, metric.name))
+    return [Stage("metrics", seconds, cells, "cells")]
+
+
+def bench_write(args, master_map):
+    start = master_map.date_of(0)
+    series = sum(1 for _ in writer.series(master_map))
+    stages = []
+    for fmt in WRITE_FORMATS:
+        seconds, _ = best_of(args.repeat, functools.partial(
+            writer.write_master_map, os.devnull, master_map, start, fmt))
+        stages.append(Stage(f"write:{fmt}", seconds, series, "series"))
+    return stages
+
+
+def bench_changes(args, master_map):
+    def track():
+        tracker = changes.ChangeTracker()
+        tracker.add(master_map)
+        return tracker
+
+    seconds, tracker = best_of(args.repeat, track)
+    return [Stage("changes", seconds, tracker.report()["series"], "series")]
+
+
+def bench_stream(args, sources, master_map):
+    """ the whole streaming parse, its peak memory is lost under the stages before it """
+    seconds, _ = best_of(args.repeat, functools.partial(
+        streaming.stream_sources, pipeline.options(args.datadir), sources, os.devnull))
+    return [Stage("stream", seconds, sum(1 for _ in writer.series(master_map)), "series")]
+
+
+def run(args):
+    sources = pipeline.SOURCES
+    codec = None if args.compress == "none" else args.compress
+    regions = generate(args.datadir, args.regions, args.days, args.seed, codec)
+    stages, raws = bench_ingest(args, sources)
+    stages += bench_normalize(args, regions)
+    derive_stages, partials = bench_derive(args, sources, raws)
+    stages += derive_stages
+    merge_stages, master_map = bench_merge(args, partials)
+    stages += merge_stages
+    stages += bench_reconcile(args, master_map)
+    stages += bench_metrics(args, master_map)
+    stages += bench_write(args, master_map)
+    stages += bench_changes(args, master_map)
+    stages += bench_stream(args, sources, master_map)
+    return stages
+
+
+# reporting
+
+def read_baseline(filepath):
+    with open(filepath) as baseline_file:
+        return json.load(baseline_file)
+
+
+def write_baseline(filepath, args, stages):
+    baseline = {
+        "config": {"regions": args.regions, "days": args.days, "seed": args.seed},
+        "stages": {stage.name: stage.seconds for stage in stages},
+    }
+    with open(filepath, 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2)
+
+
+def print_report(args, stages, baseline=None):
+    """ prints one line per stage, returns the names of stages that regressed """
+    previous = baseline["stages"] if baseline else {}
+    regressions = []
+    print(f"regions {args.regions}  days {args.days}  seed {args.seed}  best of {args.repeat}")
+    if baseline and baseline["config"] != {"regions": args.regions, "days": args.days,
+                                           "seed": args.seed}:
+        print(f"warning: baseline was taken with {baseline['config']}")
+    for stage in stages:
+        line = (f"{stage.name:<36} {stage.seconds * 1000:10.1f} ms "
+                f"{stage.rate():14,.0f} {stage.unit}/s {stage.peak_rss_mb:8.1f} MB")
+        if stage.name in previous:
+            change = stage.seconds / previous[stage.name] - 1 if previous[stage.name] else 0.0
+            line += f" {change:+8.1%}"
+            if change > args.threshold and stage.seconds > NOISE_FLOOR:
+                line += "  REGRESSION"
+                regressions.append(stage.name)
+        print(line)
+    return regressions
+
+
+def main():
+    args = get_args()
+    error = rawfile.needs_zstandard(args.compress)
+    if error:
+        sys.exit(error)
+    baseline = read_baseline(args.baseline) if args.baseline else None
+    with contextlib.ExitStack() as stack:
+        if args.datadir is None:
+            args.datadir = stack.enter_context(tempfile.TemporaryDirectory(prefix="bench-"))
+        os.makedirs(args.datadir, exist_ok=True)
+        stages = run(args)
+    regressions = print_report(args, stages, baseline)
+    if args.save_baseline:
+        write_baseline(args.save_baseline, args, stages)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
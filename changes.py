@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+""" What changed in the parsed series since the previous run
+
+parse-data.py --changes keeps a content hash of every (source, region, type) series it wrote in
+a state file and compares the next run against it, reporting
+
+    new_series       series the previous run did not have
+    removed_series   series it had and this run does not
+    new_days         series that only gained days after their last previous day
+    revised          series with a value on or before their last previous day changed,
+                     from the first day of the first BLOCK_DAYS block that differs
+    new_regions      (source, region) pairs without any series before, and removed_regions
+
+so publishing can push only the series that changed instead of diffing two dumps.
+
+A series is hashed as the sum over its present days of a 64-bit mix of the value bits and the
+day, so the hash of any range of days is a difference of running sums.  The state keeps, per
+series, the sums over blocks of BLOCK_DAYS days aligned on the calendar and the last present
+day; the block holding that day is compared over the days up to it only, which tells appended
+days from revisions.  Everything is computed a whole [region, day] array at a time.  Missing
+days add nothing, so the hash does not depend on the days the store spans.
+"""
+
+import datetime as dt
+import json
+import numpy as np
+import os
+import sys
+import tempfile
+
+BLOCK_DAYS = 28
+HASH_ROWS = 1024
+STATE_VERSION = 1
+MIX_1 = np.uint64(0xbf58476d1ce4e5b9)
+MIX_2 = np.uint64(0x94d049bb133111eb)
+DAY_KEY = np.uint64(0x9e3779b97f4a7c15)
+
+
+def mix(values, scratch):
+    """ the splitmix64 finalizer over a uint64 array, in place, scratch is an array like it """
+    for shift, factor in ((30, MIX_1), (27, MIX_2), (31, None)):
+        np.right_shift(values, np.uint64(shift), out=scratch)
+        values ^= scratch
+        if factor is not None:
+            values *= factor
+    return values
+
+
+def day_terms(values, origin):
+    """ the hash term of every cell of a [row, day] array whose first day is the ordinal origin,
+        0 where missing
+    """
+    days = np.arange(origin, origin + values.shape[1], dtype=np.uint64) * DAY_KEY
+    days = mix(days, np.empty_like(days))
+    missing = np.isnan(values)
+    # + 0.0 turns -0.0 into 0.0
+    terms = (values + 0.0).view(np.uint64)
+    terms ^= days
+    mix(terms, np.empty_like(terms))
+    terms[missing] = 0
+    return terms
+
+
+def running_sums(terms):
+    """ wrapping running sums of each row with a zero column in front """
+    sums = np.zeros((terms.shape[0], terms.shape[1] + 1), dtype=np.uint64)
+    np.cumsum(terms, axis=1, out=sums[:, 1:])
+    return sums
+
+
+def range_sums(sums, origin, first, last):
+    """ per row, the sum of the terms from ordinal first to last (numbers or one per row), from
+        running_sums() of days starting at origin; 0 where last is before first
+    """
+    n_days = sums.shape[1] - 1
+    low = np.clip(first - origin, 0, n_days)
+    high = np.maximum(np.clip(last - origin + 1, 0, n_days), low)
+    rows = np.arange(sums.shape[0])
+    return sums[rows, high] - sums[rows, low]
+
+
+class State(object):
+    """ the hashes of one run: series keys, block sums from block first_block on and the last
+        present day of each series
+    """
+    def __init__(self, keys, first_block, blocks, last, created):
+        self.keys = keys
+        self.first_block = first_block
+        self.blocks = blocks
+        self.last = last
+        self.created = created
+        self.index = {key: index for index, key in enumerate(keys)}
+
+
+def load_state(path):
+    """ the state saved at path, None if there is none or it is from another version """
+    try:
+        with np.load(path, allow_pickle=False) as saved:
+            header = json.loads(str(saved["header"]))
+            if header["version"] != STATE_VERSION:
+                return None
+            keys = [(source, tuple(region), datatype)
+                    for source, region, datatype in header["keys"]]
+            return State(keys, header["first_block"], saved["blocks"], saved["last"],
+                         header["created"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_state(path, state):
+    header = {
+        "version": STATE_VERSION,
+        "created": state.created,
+        "first_block": state.first_block,
+        "keys": [[source, list(region), datatype] for source, region, datatype in state.keys],
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as state_file:
+            np.savez(state_file, header=np.array(json.dumps(header)), blocks=state.blocks,
+                     last=state.last)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def day(ordinal):
+    return dt.date.fromordinal(int(ordinal)).isoformat()
+
+
+class ChangeTracker(object):
+    """ hashes the series of the stores given to add() and compares them with previous, a
+        State or None for a first run
+    """
+    def __init__(self, previous=None):
+        self.previous = previous
+        self.created = dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")
+        # per hashed group of rows: keys, first block, block sums, last days
+        self.parts = []
+        self.seen = np.zeros(len(previous.keys) if previous else 0, dtype=bool)
+        self.changes = {"new_series": [], "new_days": [], "revised": []}
+        self.unchanged = 0
+
+    def add(self, store):
+        """ hashes every series holding data in store, lazy types are computed """
+        if store.origin is None:
+            return
+        first_block = store.origin // BLOCK_DAYS
+        end_block = (store.origin + store.n_days - 1) // BLOCK_DAYS + 1
+        # the offset of the last day of each block in store, for the running sums
+        ends = np.minimum((np.arange(first_block, end_block) + 1) * BLOCK_DAYS - store.origin,
+                          store.n_days)
+        for source in store:
+            for datatype in store.types(source):
+                values = store.array(source, datatype)
+                rows = np.flatnonzero(~np.isnan(values).all(axis=1))
+                # a few rows at a time keeps the temporaries in cache
+                for begin in range(0, len(rows), HASH_ROWS):
+                    part = rows[begin:begin + HASH_ROWS]
+                    block = values[part]
+                    present = ~np.isnan(block)
+                    sums = running_sums(day_terms(block, store.origin))
+                    blocks = np.diff(sums[:, ends], axis=1, prepend=np.uint64(0))
+                    last = store.origin + store.n_days - 1 - np.argmax(present[:, ::-1], axis=1)
+                    keys = [(source, store.regions[rid], datatype) for rid in part.tolist()]
+                    self.parts.append((keys, first_block, blocks, last))
+                    self.compare(keys, store.origin, present, sums, last)
+
+    def compare(self, keys, origin, present, sums, last):
+        previous = self.previous
+        index = previous.index if previous else {}
+        before = np.array([index.get(key, -1) for key in keys], dtype=np.intp)
+        for row in np.flatnonzero(before < 0).tolist():
+            self.changes["new_series"].append(self.entry(keys[row], last=last[row]))
+        common = np.flatnonzero(before >= 0)
+        if not len(common):
+            return
+        before, sums, present = before[common], sums[common], present[common]
+        self.seen[before] = True
+        previous_last = previous.last[before]
+        # this run's sums on the blocks of the previous state, each only up to the previous
+        # last day, so appended days do not count
+        starts = (previous.first_block + np.arange(previous.blocks.shape[1])) * BLOCK_DAYS
+        current = np.stack([range_sums(sums, origin, start,
+                                       np.minimum(start + BLOCK_DAYS - 1, previous_last))
+                            for start in starts.tolist()], axis=1)
+        differs = current != previous.blocks[before]
+        # values before the first previous block are new there, which is a revision too
+        earlier = range_sums(sums, origin, origin, starts[0] - 1) != 0
+        revised = earlier | differs.any(axis=1)
+        since = np.where(earlier, origin + np.argmax(present, axis=1),
+                         starts[np.argmax(differs, axis=1)])
+        days = np.arange(origin, origin + present.shape[1])
+        new_days = np.count_nonzero(present & (days[None, :] > previous_last[:, None]), axis=1)
+        for position, row in enumerate(common.tolist()):
+            if revised[position]:
+                self.changes["revised"].append(self.entry(keys[row], since[position],
+                                                          last[row]))
+            elif new_days[position]:
+                entry = self.entry(keys[row], previous_last[position] + 1, last[row])
+                entry["days"] = int(new_days[position])
+                self.changes["new_days"].append(entry)
+            else:
+                self.unchanged += 1
+
+    @staticmethod
+    def entry(key, first=None, last=None):
+        source, region, datatype = key
+        entry = {"source": source, "region": list(region), "type": datatype}
+        if first is not None:
+            entry["from"] = day(first)
+        if last is not None:
+            entry["last_day"] = day(last)
+        return entry
+
+    def state(self):
+        """ the State of this run, for the next one to compare against """
+        keys = [key for part_keys, _, _, _ in self.parts for key in part_keys]
+        if not self.parts:
+            return State([], 0, np.zeros((0, 0), dtype=np.uint64), np.zeros(0, dtype=np.int64),
+                         self.created)
+        first_block = min(part[1] for part in self.parts)
+        end_block = max(part[1] + part[2].shape[1] for part in self.parts)
+        blocks = np.zeros((len(keys), end_block - first_block), dtype=np.uint64)
+        row = 0
+        for part_keys, part_first, part_blocks, _ in self.parts:
+            start = part_first - first_block
+            blocks[row:row + len(part_keys), start:start + part_blocks.shape[1]] = part_blocks
+            row += len(part_keys)
+        last = np.concatenate([part[3] for part in self.parts]).astype(np.int64)
+        return State(keys, first_block, blocks, last, self.created)
+
+    def report(self):
+        """ the change set as a dict for json """
+        previous = self.previous
+        removed = [previous.keys[index] for index in np.flatnonzero(~self.seen).tolist()]
+        pairs = {(source, region) for keys, _, _, _ in self.parts
+                 for source, region, _ in keys}
+        previous_pairs = {(source, region) for source, region, _ in previous.keys} \
+            if previous else set()
+        n_series = sum(len(part[0]) for part in self.parts)
+        return {
+            "previous_run": previous.created if previous else None,
+            "run": self.created,
+            "series": n_series,
+            "unchanged": self.unchanged,
+            "new_series": self.changes["new_series"],
+            "removed_series": [self.entry(key) for key in removed],
+            "new_days": self.changes["new_days"],
+            "revised": self.changes["revised"],
+            "new_regions": [{"source": source, "region": list(region)}
+                            for source, region in sorted(pairs - previous_pairs)],
+            "removed_regions": [{"source": source, "region": list(region)}
+                                for source, region in sorted(previous_pairs - pairs)],
+        }
+
+
+def write_report(path, report):
+    """ writes report as json to path, "-" for stderr """
+    if path == "-":
+        json.dump(report, sys.stderr, indent=2)
+        sys.stderr.write("\n")
+    else:
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+def main():
+    from timeseries import TimeSeriesStore
+
+    def store_of(series):
+        store = TimeSeriesStore()
+        for region, values in series.items():
+            for offset, value in enumerate(values):
+                if value is not None:
+                    store.set_value("src", region, "total_cases",
+                                    dt.date(2020, 3, 1) + dt.timedelta(offset), value)
+        return store
+
+    days = list(range(60))
+    first = ChangeTracker()
+    first.add(store_of({("A",): days, ("B",): days, ("C",): days, ("D",): days}))
+    with tempfile.TemporaryDirectory() as directory:
+        save_state(os.path.join(directory, "state.npz"), first.state())
+        previous = load_state(os.path.join(directory, "state.npz"))
+    revised = days[:10] + [-1] + days[11:]
+    second = ChangeTracker(previous)
+    second.add(store_of({("A",): days, ("B",): days + [60, 61], ("C",): revised,
+                         ("E",): [None] * 70 + [1]}))
+    report = second.report()
+
+    def regions(name):
+        return [entry["region"] for entry in report[name]]
+
+    print(all([
+        first.report()["unchanged"] == 0 and len(first.report()["new_series"]) == 4,
+        previous.keys[0] == ("src", ("A",), "total_cases"),
+        report["unchanged"] == 1,
+        regions("new_days") == [["B"]] and report["new_days"][0]["days"] == 2,
+        report["new_days"][0]["from"] == "2020-04-30",
+        regions("revised") == [["C"]],
+        report["revised"][0]["from"] <= "2020-03-11",
+        regions("new_series") == [["E"]] and regions("removed_series") == [["D"]],
+        regions("new_regions") == [["E"]] and regions("removed_regions") == [["D"]],
+    ]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+""" Query API over a parsed master map
+
+A Dataset wraps a finished TimeSeriesStore and answers questions like
+
+    dataset = Dataset(pipeline.load_sources(pipeline.options("data"), pipeline.SOURCES))
+    europe = dataset.regions(region="Europe", level=1)
+    last_days = dataset.query("owid", "weighted_rate_cases", europe,
+                              start=dataset.max_date() - dt.timedelta(days=21))
+
+without going through the nested mapping views.  At construction it indexes
+
+    - the first and last day with data of every source
+    - regions by country, by level (1 country, 2 subdivision, 3 microdivision), US states
+      (region_normalize.is_us_state) and the ISO 3166 region, sub-region and
+      intermediate-region columns of countries.csv, and the roll-up rows of those columns,
+      from the attributes the store's region_table holds for every region (see registry.py)
+
+Dates map to array columns by subtracting the store origin, so a date range is a slice and a
+query copies only the selected rows and days.  Lazy types such as weighted_rate_cases are
+computed for the selected rows only.  The indexes are not updated if the store
+changes afterwards, build a new Dataset instead.
+"""
+
+import datetime as dt
+import numpy as np
+
+GEO_KEYS = {"region": "region", "sub-region": "sub_region",
+            "intermediate-region": "intermediate_region"}
+
+
+class Selection(object):
+    """ the values of one (source, type) for some regions over a range of days
+
+    values is a [region, day] array with NaN for missing days, in the order of regions and
+    dates.
+    """
+    def __init__(self, regions, dates, values):
+        self.regions = regions
+        self.dates = dates
+        self.values = values
+
+    def _series(self, row):
+        return {date: value for date, value in zip(self.dates, row.tolist()) if value == value}
+
+    def series(self, region):
+        """ date -> value for one region, skipping missing days """
+        return self._series(self.values[self.regions.index(region)])
+
+    def to_dict(self):
+        return {region: self._series(row) for region, row in zip(self.regions, self.values)}
+
+
+class Dataset(object):
+    def __init__(self, store):
+        self.store = store
+        self._date_ranges = {source: self._date_range(source) for source in store}
+        self._index = {}
+        for rid in range(len(store.regions)):
+            for key in self._region_keys(store.region_table[rid]):
+                self._index.setdefault(key, []).append(rid)
+
+    def _date_range(self, source):
+        present = np.zeros(self.store.n_days, dtype=bool)
+        # lazy types lie within the days of the types they are derived from
+        for name, _, values in self.store.arrays():
+            if name == source:
+                present |= ~np.isnan(values).all(axis=0)
+        days = np.flatnonzero(present)
+        if not len(days):
+            return None
+        return self.store.date_of(days[0]), self.store.date_of(days[-1])
+
+    @staticmethod
+    def _region_keys(region_info):
+        if region_info.aggregate:
+            yield "aggregate", region_info.aggregate
+            return
+        yield "country", region_info.country
+        yield "level", region_info.level
+        if region_info.us_state:
+            yield "us_state", True
+        for column, group in region_info.groups.items():
+            yield GEO_KEYS[column], group
+
+    # dates
+
+    def sources(self):
+        return list(self._date_ranges)
+
+    def date_range(self, source=None):
+        """ (first, last) day with data in source, or over all sources; None if there is none """
+        if source is not None:
+            return self._date_ranges.get(source)
+        ranges = [days for days in self._date_ranges.values() if days]
+        if not ranges:
+            return None
+        return min(first for first, _ in ranges), max(last for _, last in ranges)
+
+    def min_date(self, source=None):
+        days = self.date_range(source)
+        return days[0] if days else None
+
+    def max_date(self, source=None):
+        days = self.date_range(source)
+        return days[1] if days else None
+
+    def last_days(self, days, end=None):
+        """ (start, end) of the last days days up to end, by default the last day with data;
+            raises ValueError for fewer than one day or more than there are since date.min
+        """
+        end = end or self.max_date()
+        if not 1 <= days <= (end - dt.date.min).days + 1:
+            raise ValueError(f"days {days} out of range")
+        return end - dt.timedelta(days=days - 1), end
+
+    def day_slice(self, start=None, end=None):
+        """ the columns from start to end, both included and both optional """
+        store = self.store
+        if store.origin is None:
+            return slice(0, 0)
+        first = 0 if start is None else start.toordinal() - store.origin
+        last = store.n_days - 1 if end is None else end.toordinal() - store.origin
+        first, last = max(first, 0), min(last, store.n_days - 1)
+        return slice(first, max(first, last + 1))
+
+    # regions
+
+    def regions(self, country=None, level=None, us_state=False, region=None, sub_region=None,
+                intermediate_region=None, aggregate=None):
+        """ the regions matching every given filter, in store order
+
+        region, sub_region and intermediate_region are the countries.csv columns, for example
+        region="Europe" or sub_region="Western Europe".  aggregate picks the roll-up rows of
+        one of those columns (see rollup.py), aggregate="region" gives the continents.  The
+        other filters only match regions that are not roll-ups of countries.
+        """
+        filters = [("country", country), ("level", level), ("us_state", us_state or None),
+                   ("region", region), ("sub_region", sub_region),
+                   ("intermediate_region", intermediate_region), ("aggregate", aggregate)]
+        rids = None
+        for key, value in filters:
+            if value is None:
+                continue
+            matches = set(self._index.get((key, value), []))
+            rids = matches if rids is None else rids & matches
+        if rids is None:
+            return list(self.store.regions)
+        return [self.store.regions[rid] for rid in sorted(rids)]
+
+    # values
+
+    def query(self, source, datatype, regions=None, start=None, end=None):
+        """ a Selection of datatype in source for regions (default all) from start to end
+
+        Raises ValueError naming the source, type or first region the store does not know.
+        """
+        store = self.store
+        if source not in self._date_ranges:
+            raise ValueError(f"no source {source!r}")
+        if not store.has_array(source, datatype):
+            raise ValueError(f"no type {datatype!r} in source {source!r}")
+        if regions is None:
+            regions = store.regions
+        rids = [store.find_region(region) for region in regions]
+        for region, rid in zip(regions, rids):
+            if rid is None:
+                raise ValueError(f"no region {region!r}")
+        rids = np.array(rids, dtype=np.intp)
+        days = self.day_slice(start, end)
+        dates = [store.date_of(offset) for offset in range(days.start, days.stop)]
+        # only the selected rows of a lazy type are computed
+        return Selection(regions, dates, store.rows(source, datatype, rids)[:, days])
+
+
+def main():
+    from timeseries import TimeSeriesStore
+    store = TimeSeriesStore()
+    day = dt.date(2020, 3, 1)
+    for offset in range(10):
+        date = day + dt.timedelta(offset)
+        store.set_value("owid", ("France",), "total_cases", date, offset)
+        store.set_value("owid", ("Japan",), "total_cases", date, 10 * offset)
+        if offset < 5:
+            store.set_value("covid", ("United States of America", "CA"), "total_cases", date, 1)
+    dataset = Dataset(store)
+    last_days = dataset.query("owid", "total_cases", dataset.regions(region="Europe"),
+                              start=dataset.max_date() - dt.timedelta(2))
+
+    def rejected(*args, call=dataset.query):
+        try:
+            call(*args)
+        except ValueError:
+            return True
+        return False
+
+    print(all([
+        dataset.date_range("covid") == (day, day + dt.timedelta(4)),
+        dataset.max_date() == day + dt.timedelta(9),
+        dataset.regions(region="Europe") == [("France",)],
+        dataset.regions(us_state=True) == [("United States of America", "CA")],
+        dataset.regions(level=1, sub_region="Eastern Asia") == [("Japan",)],
+        dataset.regions(aggregate="region") == [],
+        last_days.to_dict() == {("France",): {day + dt.timedelta(offset): float(offset)
+                                             for offset in (7, 8, 9)}},
+        dataset.query("owid", "total_cases", start=day + dt.timedelta(20)).values.shape == (3, 0),
+        rejected("nosuch", "total_cases"),
+        rejected("covid", "new_cases"),
+        rejected("owid", "total_cases", [("France",), ("Narnia",)]),
+        dataset.last_days(3) == (day + dt.timedelta(7), day + dt.timedelta(9)),
+        rejected(0, call=dataset.last_days),
+        rejected(10000000000, call=dataset.last_days),
+    ]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+""" Batched derived metrics over [region, day] arrays
+
+Each function here works on every region of a 2-D array at once and reproduces the
+per-series helpers in parsers.py, which walk one region day by day:
+
+    forward_fill : fill_gaps, zero or missing days between the first and last value
+                   take the previous value
+    deltas       : calc_deltas_for_time_series, new_* from total_*
+    rates        : calc_rates_for_time_series, rate_* masked by RATE_CUTOFF
+    weighted_rates : calc_weighted_rates_for_time_series, weighted_rate_* smoothed with
+                   SMOOTHING_FACTOR
+    add_groups   : add_to_aggregation, sums of rows into aggregate rows (see rollup.py)
+
+Missing values are NaN.  Output arrays are only written where the per-series code would
+write, everything else is left untouched.  The results are the same bits, except for
+weighted_rates, which smooths a block of days in closed form and agrees to rounding.
+
+Every function takes an optional since, one column per row.  Only days at or after since are
+written, which is how an incremental update recomputes the suffix of each series that changed.
+The masks are still evaluated over whole rows, so the result is the same as a full recompute
+as long as the days before since are unchanged; the smoothing restarts from the saved value
+of the day before the block holding since.
+"""
+
+import numpy as np
+
+SMOOTHING_FACTOR = 0.3
+# days of the smoothing recurrence computed in closed form at a time, see weighted_rates
+SMOOTHING_BLOCK = 64
+RATE_CUTOFF = 100
+
+
+def first_present(present):
+    """ column of the first present day in each row, number of columns if there is none """
+    return np.where(present.any(axis=1), present.argmax(axis=1), present.shape[1])
+
+
+def last_present(present):
+    """ column of the last present day in each row, -1 if there is none """
+    return present.shape[1] - 1 - first_present(present[:, ::-1])
+
+
+def span_mask(present):
+    """ True from the first to the last present day of each row """
+    days = np.arange(present.shape[1])
+    return (days >= first_present(present)[:, None]) & (days <= last_present(present)[:, None])
+
+
+def run_mask(present, begin):
+    """ True for the contiguous run of present days starting at column begin of each row """
+    days = np.arange(present.shape[1])
+    after = days >= begin[:, None]
+    end = first_present(after & ~present)
+    return after & (days < end[:, None])
+
+
+def suffix_mask(shape, since):
+    """ True for days at or after since of each row, everywhere when since is None """
+    if since is None:
+        return np.ones(shape, dtype=bool)
+    return np.arange(shape[1]) >= since[:, None]
+
+
+def forward_fill(values, since=None):
+    """ fills zero or missing days in place between the first and last value of each row """
+    present = ~np.isnan(values)
+    nonzero = present & (values != 0)
+    n_days = values.shape[1]
+    # the days to fill are few, they are found by flat index and each takes the last nonzero
+    # day before it in the same row, 0 if there is none
+    gaps = np.flatnonzero(~nonzero)
+    rows, columns = np.divmod(gaps, n_days)
+    keep = (columns >= first_present(present)[rows]) & (columns <= last_present(present)[rows])
+    if since is not None:
+        keep &= columns >= since[rows]
+    gaps, rows, columns = gaps[keep], rows[keep], columns[keep]
+    nonzeros = np.flatnonzero(nonzero)
+    previous = np.searchsorted(nonzeros, gaps) - 1
+    source = nonzeros[np.maximum(previous, 0)]
+    filled = values[source // n_days, source % n_days]
+    filled[(previous < 0) | (source < gaps - columns)] = 0.0
+    values[rows, columns] = filled
+
+
+def deltas(values, out, since=None):
+    """ writes day over day differences of values into out, first day keeps its value """
+    present = ~np.isnan(values)
+    span = span_mask(present)
+    delta = np.empty_like(values)
+    delta[:, 0] = values[:, 0]
+    np.subtract(values[:, 1:], values[:, :-1], out=delta[:, 1:])
+    rows = np.flatnonzero(present.any(axis=1))
+    first = first_present(present[rows])
+    delta[rows, first] = values[rows, first]
+    np.copyto(out, delta, where=span & suffix_mask(values.shape, since))
+
+
+def rates(totals, delta, out, since=None):
+    """ writes 1 + new / previous total into out while the previous total exceeds RATE_CUTOFF """
+    begin = first_present(~np.isnan(totals)) + 1
+    write = run_mask(~np.isnan(delta), begin) & suffix_mask(totals.shape, since)
+    # a missing previous total is not above the cutoff either
+    write[:, 0] = False
+    write[:, 1:] &= totals[:, :-1] > RATE_CUTOFF
+    rate = np.empty_like(totals)
+    rate[:, 0] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(delta[:, 1:], totals[:, :-1], out=rate[:, 1:])
+    rate += 1.0
+    np.copyto(out, rate, where=write)
+
+
+def weighted_rates(rate, out, since=None):
+    """ writes the exponential smoothing of the first run of rates of each row into out
+
+    The days are taken SMOOTHING_BLOCK at a time, in blocks aligned on the columns of the
+    array.  Within a block the smoothing is a closed form over a running sum of the rates
+    scaled by powers of the decay, so only the value carried from one block into the next is
+    a loop.  An update starts at the block holding since, from the value saved for the day
+    before it, and so gives the same bits as smoothing the whole row.
+    """
+    present = ~np.isnan(rate)
+    begin = first_present(present)
+    run = run_mask(present, begin)
+    write = run & suffix_mask(rate.shape, since)
+    rows = np.flatnonzero(write.any(axis=1))
+    if not len(rows):
+        return
+    # views instead of copies when every row is written, as in a full parse
+    take = slice(None) if len(rows) == rate.shape[0] else rows
+    active = np.flatnonzero(write[take].any(axis=0))
+    start = active[0] // SMOOTHING_BLOCK * SMOOTHING_BLOCK
+    n_blocks = (active[-1] - start) // SMOOTHING_BLOCK + 1
+    stop = min(start + n_blocks * SMOOTHING_BLOCK, rate.shape[1])
+    decay = 1.0 - SMOOTHING_FACTOR
+    powers = decay ** np.arange(SMOOTHING_BLOCK + 1)
+    inverse = decay ** -np.arange(SMOOTHING_BLOCK, dtype=float)
+    scaled = np.zeros((len(rows), n_blocks * SMOOTHING_BLOCK))
+    np.copyto(scaled[:, :stop - start], rate[take, start:stop], where=run[take, start:stop])
+    scaled = scaled.reshape(len(rows), n_blocks, SMOOTHING_BLOCK)
+    scaled *= inverse
+    np.cumsum(scaled, axis=2, out=scaled)
+    scaled *= SMOOTHING_FACTOR * powers[:-1]
+    # a run starts from its first rate, as if carried in from the start of its block
+    begin = begin[rows] - start
+    first_block = np.where(begin >= 0, begin // SMOOTHING_BLOCK, -1)
+    first_value = rate[rows, np.clip(begin + start, 0, rate.shape[1] - 1)] * \
+        inverse[np.maximum(begin, 0) % SMOOTHING_BLOCK]
+    carried = np.zeros(len(rows))
+    if start > 0:
+        # runs already going the day before continue from the value saved for that day
+        going = run[rows, start - 1]
+        carried[going] = out[rows[going], start - 1]
+    # the value carried into each block, the last day of a block is carried into the next
+    carries = np.empty((len(rows), n_blocks))
+    for block in range(n_blocks):
+        starting = first_block == block
+        carried[starting] = first_value[starting]
+        carries[:, block] = carried
+        carried = scaled[:, block, -1] + carried * powers[-1]
+    scaled += carries[:, :, None] * powers[1:]
+    smoothed = scaled.reshape(len(rows), -1)[:, :stop - start]
+    if take is rows:
+        block = out[rows, start:stop]
+        np.copyto(block, smoothed, where=write[rows, start:stop])
+        out[rows, start:stop] = block
+    else:
+        np.copyto(out[:, start:stop], smoothed, where=write[:, start:stop])
+
+
+def add_groups(values, rows, targets, starts, since=None):
+    """ adds groups of rows into target rows wherever any row of the group has a value
+
+    rows are ordered by group, rows[starts[g]:starts[g + 1]] are added into row targets[g].
+    Values already in a target row are added to.
+    """
+    if not len(rows):
+        return
+    block = values[rows]
+    present = ~np.isnan(block)
+    any_present = np.logical_or.reduceat(present, starts, axis=0)
+    any_present &= suffix_mask(any_present.shape, None if since is None else since[targets])
+    sums = np.add.reduceat(np.where(present, block, 0.0), starts, axis=0)
+    current = values[targets]
+    current[any_present] = np.nan_to_num(current[any_present], nan=0.0) + sums[any_present]
+    values[targets] = current
@@ -1,16 +1,27 @@
 #!/usr/bin/env python
 
+import archive
 import argparse
+import concurrent.futures
 import datetime as dt
+import json
 import os
+import random
+import rawfile
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 import urllib.request
 
-from urllib.error import HTTPError
+from urllib.error import HTTPError, URLError
 
 if sys.version_info[0] < 3:
     raise Exception("Must be using Python 3")
 
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
 
 class Source(object):
     def __init__(self, name, url, filename):
@@ -18,6 +29,9 @@ class Source(object):
         self.url = url
         self.filename = filename
 
+    def __str__(self):
+        return f"{self.name}:{self.filename}"
+
 
 SOURCES = [
     Source("covidtracker", "http://covidtracking.com/api/states/daily.csv",
@@ -32,6 +46,9 @@ SOURCES = [
            "csse-deaths.csv"),
     Source("owid", "https://covid.ourworldindata.org/data/ecdc/full_data.csv",
            "owid-full_data.csv"),
+    # populations for the per capita metrics of metrics.py, not parsed as a source
+    Source("owid", "https://covid.ourworldindata.org/data/ecdc/locations.csv",
+           "owid-locations.csv"),
 ]
 
 
@@ -39,13 +56,29 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--datadir', default='.', type=str, nargs='?',
                         help="directory to store/read datafiles")
-    parser.add_argument('-t', '--ttl_minutes', default='60', type=int, nargs='?',
-                        help="ttl for datafiles in minutes")
+    parser.add_argument('-t', '--ttl_minutes', default='0', type=int, nargs='?',
+                        help="skip even the revalidation request for files younger than this")
+    parser.add_argument('-j', '--jobs', default='4', type=int, nargs='?',
+                        help="number of sources fetched in parallel")
+    parser.add_argument('--per_host', default='2', type=int, nargs='?',
+                        help="maximum concurrent requests to one host")
+    parser.add_argument('-r', '--retries', default='3', type=int, nargs='?',
+                        help="retries per source after the first attempt")
+    parser.add_argument('--backoff', default='1.0', type=float, nargs='?',
+                        help="base delay in seconds for exponential backoff between retries")
+    parser.add_argument('--mirror', default=None, type=str, nargs='?',
+                        help="fetch every file from MIRROR/<filename> instead of its source url")
+    parser.add_argument('--compress', default='gzip', choices=list(rawfile.CODECS) + ["none"],
+                        help="how downloads are stored, as <filename>.gz, .zst or uncompressed")
+    parser.add_argument('--archive', default=None, type=str, nargs='?',
+                        help="also keep every new version in this archive, see archive.py")
     args = parser.parse_args()
+    args.codec = None if args.compress == "none" else args.compress
     return args
 
 
 def check_ttl(outfile, ttl_seconds):
+    outfile = rawfile.stored_path(*os.path.split(outfile))
     if os.path.isfile(outfile):
         mtime = dt.datetime.utcfromtimestamp(os.path.getmtime(outfile))
         stale_time = dt.datetime.utcnow() - dt.timedelta(0, ttl_seconds)
@@ -54,33 +87,137 @@ def check_ttl(outfile, ttl_seconds):
     return False
 
 
+def validators_path(outfile):
+    return outfile + ".validators"
+
+
+def read_validators(outfile):
+    """ ETag and Last-Modified headers saved from the last download of outfile, stored
+        compressed or not
+    """
+    if not os.path.isfile(rawfile.stored_path(*os.path.split(outfile))):
+        return {}
+    try:
+        with open(validators_path(outfile)) as validators_file:
+            return json.load(validators_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_validators(outfile, headers):
+    validators = {key: headers[key] for key in ("ETag", "Last-Modified") if headers.get(key)}
+    with open(validators_path(outfile), 'w') as validators_file:
+        json.dump(validators, validators_file)
+
+
+def build_request(source, validators, codec):
+    headers = {'User-Agent': 'Mozilla/5.0',
+               'Accept-Encoding': "zstd, gzip" if codec == "zstd" else "gzip"}
+    if "ETag" in validators:
+        headers['If-None-Match'] = validators["ETag"]
+    if "Last-Modified" in validators:
+        headers['If-Modified-Since'] = validators["Last-Modified"]
+    return urllib.request.Request(source.url, headers=headers)
+
+
+def stream_to_file(response, outfile, codec):
+    """ writes the body next to outfile, stored as codec, and renames it into place once
+        complete, removing the copies stored with other codecs
+
+    Returns the path the body was stored under.
+    """
+    target = outfile + rawfile.CODECS.get(codec, "")
+    directory = os.path.dirname(os.path.abspath(outfile))
+    encoding = response.headers.get("Content-Encoding", "identity").lower()
+    fd, tmppath = tempfile.mkstemp(prefix=".", suffix=".part", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as output_file:
+            rawfile.store_stream(response, None if encoding == "identity" else encoding,
+                                 output_file, codec)
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, target)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+    for path in rawfile.stored_paths(*os.path.split(outfile)):
+        if path != target and os.path.isfile(path):
+            os.unlink(path)
+    return target
+
+
 def get_source(args, source):
     outfile = os.path.join(args.datadir, source.filename)
-    if check_ttl(outfile, args.ttl_minutes * 60):
+    if args.ttl_minutes and check_ttl(outfile, args.ttl_minutes * 60):
         print(
             f"skipping reading '{source.name}' from '{source.url}' into '{source.filename}'"
             f"as file is still fresh within the ttl of {args.ttl_minutes} minutes.")
         return
     print(f"reading '{source.name}' from '{source.url}' into '{source.filename}'")
-    req = urllib.request.Request(source.url, headers={'User-Agent': 'Mozilla/5.0'})
-    with open(outfile, 'wb') as output_file:
-        output_file.write(urllib.request.urlopen(req).read())
+    req = build_request(source, read_validators(outfile), args.codec)
+    try:
+        with urllib.request.urlopen(req) as response:
+            stored = stream_to_file(response, outfile, args.codec)
+            write_validators(outfile, response.headers)
+    except HTTPError as err:
+        if err.code != 304:
+            raise
+        print(f"'{source.filename}' not modified since the last download")
+        os.utime(rawfile.stored_path(args.datadir, source.filename))
+        return
+    if args.archive_store is not None:
+        args.archive_store.add(source.filename, stored)
+
+
+def is_retryable(err):
+    if isinstance(err, HTTPError):
+        return err.code in RETRY_STATUS
+    return isinstance(err, (URLError, OSError))
 
 
 def get_source_with_retry(args, source, retry_count=0):
-    try:
-        return get_source(args, source)
-    except HTTPError:
-        if retry_count < 1:
-            print(f"Too many errors trying to fetch f{source}")
-        # A bit ugly, but it's tail recursion
-        return get_source_with_retry(args, source, retry_count - 1)
+    for attempt in range(retry_count + 1):
+        try:
+            return get_source(args, source)
+        except (HTTPError, URLError, OSError) as err:
+            if attempt == retry_count or not is_retryable(err):
+                print(f"Too many errors trying to fetch {source}: {err}")
+                return
+            # full jitter keeps parallel retries against one host from lining up
+            delay = random.uniform(0, args.backoff * (2 ** attempt))
+            print(f"error fetching {source}: {err}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def host_limits(sources, per_host):
+    hosts = {urllib.parse.urlsplit(source.url).netloc for source in sources}
+    return {host: threading.BoundedSemaphore(per_host) for host in hosts}
+
+
+def get_source_limited(args, source, limits):
+    with limits[urllib.parse.urlsplit(source.url).netloc]:
+        return get_source_with_retry(args, source, retry_count=args.retries)
+
+
+def mirrored(sources, mirror):
+    """ the sources with their urls pointing at mirror, a local stand-in for testing """
+    if not mirror:
+        return sources
+    return [Source(source.name, urllib.parse.urljoin(mirror.rstrip("/") + "/", source.filename),
+                   source.filename) for source in sources]
 
 
 def main():
     args = get_args()
-    for source in SOURCES:
-        get_source_with_retry(args, source, retry_count=3)
+    error = rawfile.needs_zstandard(args.codec)
+    if error:
+        sys.exit(error)
+    args.archive_store = archive.Archive(args.archive) if args.archive else None
+    sources = mirrored(SOURCES, args.mirror)
+    limits = host_limits(sources, max(1, args.per_host))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [pool.submit(get_source_limited, args, source, limits) for source in sources]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+""" Optional per-stage instrumentation of the parse pipeline
+
+Stages are named blocks of work, timed with
+
+    with instrument.stage(f"ingest:{filename}") as stage:
+        rows = stage.count(rows)        # counts rows as they are consumed
+        ...
+        stage.points(store)             # present values in store once the stage is done
+
+and helpers decorated with @instrument.instrumented, which are timed per call as
+"<function>:<source>" when their second argument is a source name.
+
+Nothing is collected until enable() is called.  Until then stage() hands out one shared no-op
+object and decorated functions are the undecorated functions themselves: enable() swaps timing
+wrappers into their modules and disable() puts the originals back.  Only calls that look the
+helper up through its module are timed, which is how parsers.py calls them.
+
+Per stage the report has the number of calls, wall time, rows consumed, points produced and,
+with memory=True, the peak and net bytes allocated through tracemalloc.  cprofile=True runs
+cProfile alongside for a function level dump.
+"""
+
+import cProfile
+import datetime as dt
+import functools
+import json
+import numpy as np
+import resource
+import sys
+import time
+import tracemalloc
+
+_profiler = None
+_REGISTRY = []
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def present_count(store, source=None):
+    """ number of present values in store, or in one source of it """
+    return sum(int(np.count_nonzero(~np.isnan(values)))
+               for name, _, values in store.arrays() if source is None or name == source)
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.points = 0
+        self.alloc_peak_bytes = None
+        self.alloc_net_bytes = None
+
+    def add(self, stats):
+        self.calls += stats["calls"]
+        self.seconds += stats["seconds"]
+        self.rows += stats["rows"]
+        self.points += stats["points"]
+        for key in ("alloc_peak_bytes", "alloc_net_bytes"):
+            if stats.get(key) is not None:
+                setattr(self, key, (getattr(self, key) or 0) + stats[key])
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "rows": self.rows,
+            "rows_per_second": self.rows / self.seconds if self.rows and self.seconds else None,
+            "points": self.points,
+            "alloc_peak_bytes": self.alloc_peak_bytes,
+            "alloc_net_bytes": self.alloc_net_bytes,
+        }
+
+
+class Profiler(object):
+    def __init__(self, memory=False, cprofile=False):
+        self.memory = memory
+        self.started = dt.datetime.now()
+        self.start = time.perf_counter()
+        self.stats = {}
+        self.stack = []
+        self.cprofile = cProfile.Profile() if cprofile else None
+
+    def stats_for(self, name):
+        if name not in self.stats:
+            self.stats[name] = StageStats(name)
+        return self.stats[name]
+
+    def report(self):
+        return {
+            "argv": sys.argv,
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_seconds": time.perf_counter() - self.start,
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": [stats.as_dict() for stats in self.stats.values()],
+        }
+
+
+def reset_peak():
+    """ tracemalloc.reset_peak(), which needs python 3.9; older versions restart the tracing,
+        which also forgets the blocks traced so far, so the net bytes of enclosing stages are off
+    """
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+class Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.rows = 0
+        self.produced = 0
+        self.child_peak = 0
+
+    def __enter__(self):
+        if self.profiler.memory:
+            reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+        self.profiler.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        self.profiler.stack.pop()
+        stats = {"calls": 1, "seconds": seconds, "rows": self.rows, "points": self.produced}
+        if self.profiler.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # a nested stage reset the peak, it passed up what it saw
+            peak = max(peak, self.child_peak)
+            stats["alloc_peak_bytes"] = peak - self.base
+            stats["alloc_net_bytes"] = current - self.base
+            if self.profiler.stack:
+                parent = self.profiler.stack[-1]
+                parent.child_peak = max(parent.child_peak, peak)
+        self.profiler.stats_for(self.name).add(stats)
+        return False
+
+    def count(self, rows):
+        for row in rows:
+            self.rows += 1
+            yield row
+
+    def points(self, store, source=None):
+        self.produced += present_count(store, source)
+
+
+class NullStage(object):
+    """ what stage() returns while instrumentation is off """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, rows):
+        return rows
+
+    def points(self, store, source=None):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+def enabled():
+    return _profiler is not None
+
+
+def stage(name):
+    if _profiler is None:
+        return NULL_STAGE
+    return Stage(_profiler, name)
+
+
+def instrumented(function):
+    """ registers function to be timed while instrumentation is on, returns it unchanged """
+    _REGISTRY.append(function)
+    return function
+
+
+def timed(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        source = args[1] if len(args) > 1 and isinstance(args[1], str) else None
+        name = f"{function.__name__}:{source}" if source else function.__name__
+        # counted outside the stage so the counting is not timed as part of it
+        before = present_count(args[0], source) if source else 0
+        with stage(name):
+            result = function(*args, **kwargs)
+        if source and _profiler is not None:
+            _profiler.stats_for(name).points += present_count(args[0], source) - before
+        return result
+    return wrapper
+
+
+def enable(memory=False, cprofile=False):
+    """ starts collecting, discarding anything collected before """
+    global _profiler
+    disable()
+    _profiler = Profiler(memory, cprofile)
+    for function in _REGISTRY:
+        setattr(sys.modules[function.__module__], function.__name__, timed(function))
+    if memory:
+        tracemalloc.start()
+    if _profiler.cprofile:
+        _profiler.cprofile.enable()
+
+
+def disable():
+    """ stops collecting and returns the report, None if nothing was being collected """
+    global _profiler
+    if _profiler is None:
+        return None
+    if _profiler.cprofile:
+        _profiler.cprofile.disable()
+    for function in _REGISTRY:
+        setattr(sys.modules[function.__module__], function.__name__, function)
+    report = _profiler.report()
+    if _profiler.memory:
+        tracemalloc.stop()
+    _profiler = None
+    return report
+
+
+def absorb(stages):
+    """ adds the stages of a report made in another process, calls and times are summed """
+    if _profiler is None:
+        return
+    for stats in stages:
+        _profiler.stats_for(stats["name"]).add(stats)
+
+
+def write_report(path, cprofile_path=None):
+    """ stops collecting, writes the json report to path ("-" for stderr) and the cProfile
+        stats to cprofile_path
+    """
+    cprofile = _profiler.cprofile if _profiler else None
+    report = disable()
+    if report is None:
+        return
+    if path == "-":
+        json.dump(report, sys.stderr, indent=2)
+        sys.stderr.write("\n")
+    else:
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    if cprofile is not None and cprofile_path:
+        cprofile.dump_stats(cprofile_path)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+""" Declared derived metrics computed for every region and source at once
+
+A metric is declared once with its input type and its window or smoothing factor, and becomes
+one more type of every source that has the input:
+
+    RollingSum("new_cases_sum7", "new_cases", window=7)
+    PerCapita("new_cases_sum14_per100k", "new_cases_sum14", per=100000)
+
+compute() runs the declared metrics in order over whole [region, day] arrays, so an input can
+be an earlier metric and a new metric costs a few array operations instead of another pass
+over the regions.  Rolling windows come from a running sum, one subtraction per day however
+long the window.
+
+    rolling sums/means  over the last window days, written where the input is present and the
+                        window lies inside the series; missing days count as 0 (mean: are left
+                        out)
+    ewma                exponential smoothing of the input with factor alpha, carried over
+                        missing days
+    doubling time       days for the total to double at the growth over the last window days,
+                        NaN while it is not growing
+    per capita          input per `per` inhabitants, from the population of the region
+
+Populations come from owid-locations.csv in the data directory (fetched by get-covid-data.py),
+aggregate regions get the sum of their countries (see rollup.py).  Without the file the per
+capita metrics are left out.
+"""
+
+import csv
+import datetime as dt
+import derived
+import instrument
+import math
+import numpy as np
+import os
+import rawfile
+import region_normalize as rn
+import rollup
+
+POPULATIONS_FILE = "owid-locations.csv"
+
+
+class Metric(object):
+    """ a derived type computed from the input type of the same source
+
+    Each kind of metric subclasses this and defines compute(values, populations), the metric
+    for every row of the [region, day] input values, NaN where it has none.
+    """
+    fractional = True
+
+    def __init__(self, name, input):
+        self.name = name
+        self.input = input
+
+
+def running_sum(values):
+    """ running sums of each row with a zero column in front, missing days counting as 0 """
+    sums = np.zeros((values.shape[0], values.shape[1] + 1))
+    np.cumsum(np.nan_to_num(values, nan=0.0), axis=1, out=sums[:, 1:])
+    return sums
+
+
+def full_window(values, window):
+    """ True where the input is present and the window lies after the first present day """
+    present = ~np.isnan(values)
+    days = np.arange(values.shape[1])
+    return present & (days >= derived.first_present(present)[:, None] + window - 1)
+
+
+def window_sum(sums, window):
+    """ the sum over the window days ending at each day, from running_sum() """
+    total = sums[:, 1:].copy()
+    total[:, window:] -= sums[:, 1:-window]
+    return total
+
+
+class RollingSum(Metric):
+    fractional = False
+
+    def __init__(self, name, input, window):
+        Metric.__init__(self, name, input)
+        self.window = window
+
+    def compute(self, values, populations):
+        total = window_sum(running_sum(values), self.window)
+        return np.where(full_window(values, self.window), total, np.nan)
+
+
+class RollingMean(RollingSum):
+    fractional = True
+
+    def compute(self, values, populations):
+        total = window_sum(running_sum(values), self.window)
+        count = window_sum(running_sum((~np.isnan(values)).astype(float)), self.window)
+        with np.errstate(invalid='ignore'):
+            return np.where(full_window(values, self.window), total / count, np.nan)
+
+
+class Ewma(Metric):
+    def __init__(self, name, input, alpha):
+        Metric.__init__(self, name, input)
+        self.alpha = alpha
+
+    def compute(self, values, populations):
+        """ smoothed from the first present day on, missing days keep the last value """
+        present = ~np.isnan(values)
+        out = np.full(values.shape, np.nan)
+        last = values[:, 0].copy()
+        # one short vector operation per day over the regions; the blocked closed form of
+        # derived.weighted_rates only covers the first run, this carries over missing days
+        for day in range(values.shape[1]):
+            step = self.alpha * values[:, day] + (1.0 - self.alpha) * last
+            last = np.where(np.isnan(last), values[:, day], np.where(present[:, day], step, last))
+            out[:, day] = np.where(present[:, day], last, np.nan)
+        return out
+
+
+class DoublingTime(Metric):
+    def __init__(self, name, input, window):
+        Metric.__init__(self, name, input)
+        self.window = window
+
+    def compute(self, values, populations):
+        before = np.full(values.shape, np.nan)
+        before[:, self.window:] = values[:, :-self.window]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            growth = np.log(values / before)
+            doubling = self.window * math.log(2) / growth
+        return np.where((before > 0) & (growth > 0), doubling, np.nan)
+
+
+class PerCapita(Metric):
+    def __init__(self, name, input, per):
+        Metric.__init__(self, name, input)
+        self.per = per
+
+    def compute(self, values, populations):
+        with np.errstate(invalid='ignore'):
+            return values * (self.per / populations)[:, None]
+
+
+METRICS = []
+for _kind in ("cases", "deaths"):
+    METRICS += [
+        RollingSum(f"new_{_kind}_sum7", f"new_{_kind}", 7),
+        RollingSum(f"new_{_kind}_sum14", f"new_{_kind}", 14),
+        RollingMean(f"new_{_kind}_avg7", f"new_{_kind}", 7),
+        RollingMean(f"new_{_kind}_avg14", f"new_{_kind}", 14),
+        Ewma(f"new_{_kind}_ewma", f"new_{_kind}", derived.SMOOTHING_FACTOR),
+        DoublingTime(f"doubling_days_{_kind}", f"total_{_kind}", 7),
+        PerCapita(f"new_{_kind}_sum14_per100k", f"new_{_kind}_sum14", 100000),
+        PerCapita(f"total_{_kind}_per_million", f"total_{_kind}", 1000000),
+    ]
+FRACTIONAL_TYPES = {metric.name for metric in METRICS if metric.fractional}
+
+
+def select(names):
+    """ the declared metrics named in names, a comma separated list or "all", in order
+
+    The metrics their inputs depend on are selected as well.
+    """
+    by_name = {metric.name: metric for metric in METRICS}
+    wanted = set(by_name) if names == "all" else {name.strip() for name in names.split(",")}
+    unknown = wanted - set(by_name)
+    if unknown:
+        raise ValueError(f"unknown metrics {', '.join(sorted(unknown))}")
+    for metric in reversed(METRICS):
+        if metric.name in wanted and metric.input in by_name:
+            wanted.add(metric.input)
+    return [metric for metric in METRICS if metric.name in wanted]
+
+
+def read_populations(datadir):
+    """ canonical country name -> population from owid-locations.csv, {} without the file """
+    path = rawfile.stored_path(datadir, POPULATIONS_FILE)
+    if not os.path.isfile(path):
+        return {}
+    populations = {}
+    with rawfile.open_text(path) as csvfile:
+        for line in csv.DictReader(csvfile):
+            if line.get("population"):
+                populations[rn.normalize(line["location"])] = float(line["population"])
+    return populations
+
+
+def population_column(store, populations):
+    """ the population of every region of store, NaN where unknown
+
+    Aggregate rows get the sum over the countries of countries.csv in their group.
+    """
+    groups = {}
+    for region, population in populations.items():
+        for _, group in rollup.country_groups(region[0]) if len(region) == 1 else []:
+            groups[(group,)] = groups.get((group,), 0.0) + population
+    return np.array([populations.get(region, groups.get(region, np.nan))
+                     for region in store.regions])
+
+
+def compute(store, selected, populations=None, sources=None):
+    """ adds the selected metrics to every source (default all) of store that has their input """
+    column = population_column(store, populations or {})
+    for metric in selected:
+        if isinstance(metric, PerCapita) and not populations:
+            continue
+        with instrument.stage(f"metric:{metric.name}"):
+            for source in sources or list(store):
+                if store.has_array(source, metric.input):
+                    values = metric.compute(store.array(source, metric.input), column)
+                    store.array(source, metric.name)[:] = values
+
+
+def main():
+    from timeseries import TimeSeriesStore
+    store = TimeSeriesStore()
+    day = dt.date(2020, 3, 1)
+    for offset in range(20):
+        date = day + dt.timedelta(offset)
+        store.set_value("owid", ("France",), "new_cases", date, offset + 1)
+        store.set_value("owid", ("France",), "total_cases", date, 100 * 2 ** (offset / 7))
+        if offset != 12:
+            store.set_value("owid", ("Japan",), "new_cases", date, 10)
+    compute(store, select("new_cases_sum7,new_cases_avg7,new_cases_ewma,doubling_days_cases,"
+                          "new_cases_sum14_per100k"), {("France",): 2e6, ("Japan",): 1e6})
+    france, japan = store.find_region(("France",)), store.find_region(("Japan",))
+    europe = store.region_id(("Europe",))
+
+    def row(datatype, rid):
+        return store.array("owid", datatype)[rid].tolist()
+
+    sums = row("new_cases_sum7", france)
+    print(all([
+        np.isnan(sums[:6]).all(),
+        sums[6:] == [sum(range(offset - 5, offset + 2)) for offset in range(6, 20)],
+        row("new_cases_sum7", japan)[12] != row("new_cases_sum7", japan)[12],
+        row("new_cases_sum7", japan)[13] == 60,
+        row("new_cases_avg7", japan)[13] == 10,
+        row("new_cases_ewma", japan)[13] == 10,
+        np.isclose(row("new_cases_ewma", france)[1], 0.3 * 2 + 0.7 * 1),
+        np.allclose(row("doubling_days_cases", france)[7:], 7),
+        row("new_cases_sum14_per100k", japan)[19] == 130 * 0.1,
+        np.isclose(row("new_cases_sum14_per100k", france)[19], sum(range(7, 21)) / 20),
+        population_column(store, {("France",): 2e6})[europe] == 2e6,
+        [metric.name for metric in select("new_deaths_sum14_per100k")] ==
+        ["new_deaths_sum14", "new_deaths_sum14_per100k"],
+    ]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,122 +1,168 @@
 #!/usr/bin/env python
 
+import archive
 import argparse
-import csv
+import changes
+import dataset
 import datetime as dt
-import parsers
+import instrument
+import metrics
 import os
-
-
-class Source(object):
-    def __init__(self, name, filename, parser):
-        self.name = name
-        self.filename = filename
-        self.parser = parser
-
-
-SOURCES = [
-    Source("covidtracker", "covidtracker-daily.csv", parsers.covid_parser),
-    Source("csse", "csse-confirmed.csv", parsers.csse_parser_confirmed),
-    Source("csse", "csse-deaths.csv", parsers.csse_parser_deaths),
-    Source("owid", "owid-full_data.csv", parsers.owid_parser),
-]
+import pipeline
+import reconcile
+import streaming
+import sys
+import writer
 
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--datadir', default='.', type=str, nargs='?')
+    parser.add_argument('--cache_dir', default=None, type=str, nargs='?',
+                        help="where parsed snapshots are kept, default datadir/.parse-cache")
+    parser.add_argument('--no_cache', action='store_true',
+                        help="parse every source from scratch and do not write snapshots")
+    parser.add_argument('--full', action='store_true',
+                        help="derive changed sources from scratch instead of updating snapshots")
+    parser.add_argument('-j', '--jobs', default='1', type=int, nargs='?',
+                        help="number of processes parsing sources in parallel")
+    parser.add_argument('--archive', default=None, type=str, nargs='?',
+                        help="parse the newest files of this archive, written by "
+                             "get-covid-data.py --archive, instead of --datadir")
+    parser.add_argument('--as_of', default=None, type=dt.date.fromisoformat, nargs='?',
+                        help="parse the files of --archive as they were on this day, YYYY-MM-DD")
+    parser.add_argument('--format', default='text', choices=writer.FORMATS,
+                        help="output format, parquet and arrow need pyarrow")
+    parser.add_argument('-o', '--output', default=None, type=str, nargs='?',
+                        help="file to write the table to, default stdout")
+    parser.add_argument('--reconcile', default=None, type=str, nargs='?',
+                        help="compare the sources, add a consensus source and write the regions "
+                             "where they diverge to this json file, - for stderr")
+    parser.add_argument('--threshold', default='0.2', type=float, nargs='?',
+                        help="with --reconcile, relative deviation from the consensus reported")
+    parser.add_argument('--metrics', default=None, type=str, nargs='?',
+                        help="add these metrics of metrics.py, comma separated or all")
+    parser.add_argument('--changes', default=None, type=str, nargs='?',
+                        help="write the series that changed since the last run with --changes "
+                             "to this json file, - for stderr, see changes.py")
+    parser.add_argument('--changes_state', default=None, type=str, nargs='?',
+                        help="where --changes keeps the hashes of the last run, default "
+                             "cache_dir/series-hashes.npz")
+    parser.add_argument('--stream', action='store_true',
+                        help="parse and write a chunk of regions at a time within --memory_mb, "
+                             "without snapshots, see streaming.py")
+    parser.add_argument('--memory_mb', default=str(streaming.MEMORY_MB), type=int, nargs='?',
+                        help="with --stream, megabytes of parsed data held at a time")
+    parser.add_argument('--spill_dir', default=None, type=str, nargs='?',
+                        help="with --stream, where raw values are spilled, default the "
+                             "temporary directory")
+    parser.add_argument('--profile', default=None, type=str, nargs='?',
+                        help="write a json report of the time spent in each stage, - for stderr")
+    parser.add_argument('--profile_memory', action='store_true',
+                        help="with --profile, also trace allocations per stage (slow)")
+    parser.add_argument('--profile_cprofile', default=None, type=str, nargs='?',
+                        help="with --profile, also dump cProfile stats to this file")
     args = parser.parse_args()
+    error = writer.needs_pyarrow(args.format)
+    if error:
+        parser.error(error)
+    if (args.profile_memory or args.profile_cprofile) and not args.profile:
+        parser.error("--profile_memory and --profile_cprofile need --profile")
+    if args.as_of and not args.archive:
+        parser.error("--as_of needs --archive")
+    if args.changes_state and not args.changes:
+        parser.error("--changes_state needs --changes")
+    if args.stream and args.reconcile:
+        parser.error("--reconcile compares every region at once and cannot be used with --stream")
+    if args.memory_mb < 1:
+        parser.error("--memory_mb must be at least 1")
+    if args.metrics:
+        try:
+            args.metrics = metrics.select(args.metrics)
+        except ValueError as err:
+            parser.error(str(err))
     return args
 
 
-def read_csv(args, source):
-    filepath = os.path.join(args.datadir, source.filename)
-    csvfile = open(filepath)
-    return csv.DictReader(csvfile)
-
-
 def find_max_date(master_map):
     max_date = dt.date.today() - dt.timedelta(1000)
-    for source in master_map.values():
-        for region in source.values():
-            for valtype in region.values():
-                for date in valtype.keys():
-                    max_date = max(date, max_date)
-    return max_date
-
+    last = dataset.Dataset(master_map).max_date()
+    if last is None:
+        return max_date
+    return max(last, max_date)
 
-def print_time_series(start_date, header, time_series):
-    def int_or_float(header, value):
-        if "rate_" in header:
-            return f"{value:.3f}"
-        return f"{value:.0f}"
 
-    if not len(time_series.keys()):
-        return
-    min_date = sorted(time_series.keys())[0]
-    print(header, end=" ")
-    curr_day = max(start_date, min_date)
-    while curr_day in time_series:
-        print(f" {int_or_float(header, time_series[curr_day])}", end="")
-        curr_day = curr_day + dt.timedelta(days=1)
-    print(f"     {curr_day - dt.timedelta(days=1):%Y-%m-%d}")
+def print_master_map(start_date, master_map, fmt="text", path=None):
+    writer.write_master_map(path, master_map, start_date, fmt)
 
 
-def print_region_data(start_date, header, region_data):
-    for key, time_series in region_data.items():
-        print_time_series(start_date, f"{header}:{key}", time_series)
+def load_populations(args):
+    populations = metrics.read_populations(args.datadir)
+    if not populations and any(isinstance(metric, metrics.PerCapita) for metric in args.metrics):
+        print(f"no {metrics.POPULATIONS_FILE} in {args.datadir}, per capita metrics left out",
+              file=sys.stderr)
+    return populations
 
 
-def print_source_data(start_date, name, source_data):
-    for region, region_data in source_data.items():
-        print_region_data(start_date, f"{name}:{region}", region_data)
+def changes_state_path(args):
+    return args.changes_state or os.path.join(pipeline.get_cache_dir(args), "series-hashes.npz")
 
 
-def print_master_map(start_date, master_map):
-    for name, source_data in master_map.items():
-        print_source_data(start_date, name, source_data)
+def write_changes(args, tracker):
+    with instrument.stage("changes-save"):
+        changes.write_report(args.changes, tracker.report())
+        changes.save_state(changes_state_path(args), tracker.state())
 
 
 def main():
     args = get_args()
-    master_map = parsers.build_master_dict()
-    for source in SOURCES:
-        csv_list = read_csv(args, source)
-        source.parser(csv_list, master_map)
+    if args.profile:
+        instrument.enable(memory=args.profile_memory, cprofile=bool(args.profile_cprofile))
+    sources = pipeline.SOURCES
+    if args.archive:
+        with instrument.stage("checkout"):
+            args.datadir = archive.Archive(args.archive).checkout(args.as_of)
+        # files first fetched after as_of, or never, do not exist there
+        sources = pipeline.present_sources(args, sources)
+    tracker = None
+    if args.changes:
+        tracker = changes.ChangeTracker(changes.load_state(changes_state_path(args)))
+    if args.stream:
+        pipeline.use_aliases(args)
+        populations = load_populations(args) if args.metrics else None
+        streaming.stream_sources(args, sources, args.output, args.format, args.memory_mb,
+                                 args.spill_dir, args.metrics, populations, tracker)
+        pipeline.save_aliases(args)
+        if tracker:
+            write_changes(args, tracker)
+        if args.profile:
+            instrument.write_report(args.profile, args.profile_cprofile)
+        return
+    master_map = pipeline.load_sources(args, sources)
 
     # Modify after this to process data as you wish or return
 
-    max_date = find_max_date(master_map)
+    with instrument.stage("find_max_date"):
+        max_date = find_max_date(master_map)
     three_weeks_ago = max_date - dt.timedelta(days=21)
-    print("ZZZ", three_weeks_ago)
-    print_master_map(three_weeks_ago, master_map)
-
-
-"""
-    for k, v in master_map.items():
-        print(f'{k} total_cases owid ', end='')
-        curr_day = three_weeks_ago
-        while curr_day <= max_date:
-            print(f"{v.get(curr_day, {}).get('owid', {}).get('total_cases', 0)} ", end='')
-            curr_day = curr_day + dt.timedelta(days=1)
-        print('')
-
-    for k, v in master_map.items():
-        print(f'{k} total_cases csse ', end='')
-        curr_day = three_weeks_ago
-        while curr_day <= max_date:
-            print(f"{v.get(curr_day, {}).get('csse', {}).get('total_cases', 0)} ", end='')
-            curr_day = curr_day + dt.timedelta(days=1)
-        print('')
-
-    for k, v in master_map.items():
-        print(f'{k} total_cases covid ', end='')
-        curr_day = three_weeks_ago
-        while curr_day <= max_date:
-            print(f"{v.get(curr_day, {}).get('covid', {}).get('total_cases', 0)} ", end='')
-            curr_day = curr_day + dt.timedelta(days=1)
-        print('')
-"""
+    if args.reconcile:
+        with instrument.stage("reconcile"):
+            results = [reconcile.reconcile(master_map, datatype) for datatype in reconcile.TYPES]
+            reconcile.add_consensus(master_map, results)
+            reconcile.write_report(args.reconcile, results, args.threshold, three_weeks_ago)
+    if args.metrics:
+        metrics.compute(master_map, args.metrics, load_populations(args))
+    if tracker:
+        with instrument.stage("changes"):
+            tracker.add(master_map)
+    with instrument.stage(f"write:{args.format}"):
+        print_master_map(three_weeks_ago, master_map, args.format, args.output)
+    pipeline.save_aliases(args)
+    if tracker:
+        write_changes(args, tracker)
+    if args.profile:
+        instrument.write_report(args.profile, args.profile_cprofile)
+
 
 if __name__ == '__main__':
     main()
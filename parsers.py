@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
-""" Parsers parse arrays of maps (presumably read in from csv files) into standard format
+""" Parsers parse csv rows into standard format
+
+Each source file is read by the schema declared for it here (see schema.py), its derive
+function then adds the derived types.
 
 Master Dictionary
 
-regions are tuples (country, [subdivision,] [microdivion])
+regions are tuples (country, [subdivision,] [microdivion]), interned by the store to region ids
+whose attributes are in store.region_table (see registry.py)
 datetime.date only days, no normalization of dates is attempted
 type is a cross product of [total_, new_, rate_, weighted_rate_] and [cases, deaths]
 for example:
@@ -13,6 +17,9 @@ for example:
     - rate_cases : ratio of new_cases / total_cases of day before
     - weighted_rate_cases : exponential smoothed rate_cases with smoothing factor SMOOTHING_FACTOR
 
+The master map is a timeseries.TimeSeriesStore holding one [region_id, day_offset] array per
+(source, type).  It reads like the nested dictionary
+
 { source:
     { region:
         { type :
@@ -22,264 +29,453 @@ for example:
     }
 }
 
+The *_for_source helpers compute derived types for every region of a source at once with the
+batched engine in derived.py.  The per-series helpers work on one region row, with NaN for
+missing days, and are kept as the reference the engine is checked against in main().
+
+rate_* and weighted_rate_* are only declared by derive: they are lazy types of the store (see
+timeseries.py), computed from total_* and new_* on first access, for just the regions read.
+store.materialize() computes all of them, as derive used to.  Snapshots hold them computed, so
+an update of a snapshot recomputes them only from since, like the other derived types.
+
 """
 
-from collections import defaultdict
 import datetime as dt
+import derived
+import instrument
+from derived import RATE_CUTOFF, SMOOTHING_FACTOR
+import numpy as np
 import region_normalize as rn
-import re
-
-SMOOTHING_FACTOR = 0.3
-RATE_CUTOFF = 100
-ONE_DAY = dt.timedelta(days=1)
-
-
-def build_time_series():
-    return defaultdict(int)
+import rollup
+import schema
+from timeseries import Derivation, TimeSeriesStore
 
 
-def build_region_dict():
-    return defaultdict(build_time_series)
+def build_master_dict():
+    return TimeSeriesStore()
 
 
-def build_source_dict():
-    return defaultdict(build_region_dict)
+def row_since(out_map, since):
+    """ pads since to the current regions, regions added later are computed in full """
+    if since is None:
+        return None
+    return np.concatenate([since, np.zeros(len(out_map.regions) - len(since), dtype=since.dtype)])
 
 
-def build_master_dict():
-    return defaultdict(build_source_dict)
+def is_missing(val):
+    return val != val
 
 
-def add_raw_data_point(name, region, datatype, date, val, out_map):
-    if not val:
-        return
-    out_map[name][region][datatype][date] = float(val)
+def present_days(values):
+    return [day for day, val in enumerate(values) if not is_missing(val)]
 
 
 def fill_gaps(time_series):
-    dates = sorted(time_series.keys())
-    if not len(dates):
+    values = time_series.tolist()
+    days = present_days(values)
+    if not len(days):
         return
-    start, end = dates[0], dates[-1]
-    val = time_series[start]
-    day = start
-    while day <= end:
-        if not time_series[day]:
-            time_series[day] = val
-        val = time_series[day]
-        day += ONE_DAY
+    start, end = days[0], days[-1]
+    val = values[start]
+    for day in range(start, end + 1):
+        if is_missing(values[day]) or not values[day]:
+            values[day] = val
+        val = values[day]
+    time_series[:] = values
 
 
-def fill_gaps_for_source(source_map, key):
-    for region_data in source_map.values():
-        fill_gaps(region_data[key])
+@instrument.instrumented
+def fill_gaps_for_source(out_map, name, key, since=None):
+    derived.forward_fill(out_map.array(name, key), row_since(out_map, since))
 
 
 def calc_deltas_for_time_series(time_series, delta_time_series):
-    dates = sorted(time_series.keys())
-    if not len(dates):
+    values = time_series.tolist()
+    days = present_days(values)
+    if not len(days):
         return
-    start, end = dates[0], dates[-1]
-    delta_time_series[start] = time_series[start]
-    day = start + ONE_DAY
-    while day <= end:
-        delta = time_series[day] - time_series[day - ONE_DAY]
-        delta_time_series[day] = delta
-        day += ONE_DAY
+    start, end = days[0], days[-1]
+    deltas = delta_time_series.tolist()
+    deltas[start] = values[start]
+    for day in range(start + 1, end + 1):
+        deltas[day] = values[day] - values[day - 1]
+    delta_time_series[:] = deltas
 
 
-def calc_deltas(source_map, key, delta_key):
-    for region_data in source_map.values():
-        calc_deltas_for_time_series(region_data[key], region_data[delta_key])
+@instrument.instrumented
+def calc_deltas(out_map, name, key, delta_key, since=None):
+    derived.deltas(out_map.array(name, key), out_map.array(name, delta_key),
+                   row_since(out_map, since))
 
 
 def add_to_aggregation(source_ts, sum_ts):
-    if not len(source_ts):
-        return
-    for date, value in source_ts.items():
-        sum_ts[date] += value
+    values, sums = source_ts.tolist(), sum_ts.tolist()
+    for day, value in enumerate(values):
+        if is_missing(value):
+            continue
+        sums[day] = value if is_missing(sums[day]) else sums[day] + value
+    sum_ts[:] = sums
 
 
-def add_usa_aggregation(source_dict, key):
-    usa_dict = source_dict[("United States of America",)]
-    for region, region_data in source_dict.items():
-        if not rn.is_us_state(region):
-            continue
-        add_to_aggregation(region_data[key], usa_dict[key])
+@instrument.instrumented
+def add_aggregations(out_map, name, keys, since=None):
+    """ sums keys of subdivisions into their countries and of countries into the countries.csv
+        groups, see rollup.py
+    """
+    plan = rollup.RollupPlan(out_map, name)
+    since = row_since(out_map, since)
+    for key in keys:
+        plan.apply(out_map.array(name, key), since)
 
 
-def calc_rates_for_time_series(total_ts, delta_ts, rate_ts):
-    if not len(total_ts):
-        return
-    day = sorted(total_ts.keys())[0] + ONE_DAY
-    while day in delta_ts:
-        rate = 0.0
-        if total_ts[day - ONE_DAY] > RATE_CUTOFF:
-            rate = 1.0 + float(delta_ts[day]) / total_ts[day - ONE_DAY]
-            rate_ts[day] = rate
-        day += ONE_DAY
+def widen_aggregation_since(out_map, since, raw, name):
+    """ aggregate rows have to be recomputed from the earliest day any of their members changed,
+        members being the regions with data in out_map or in the new raw ingest
+    """
+    plan = rollup.RollupPlan(out_map, name, raw)
+    return plan.widen(row_since(out_map, since))
 
 
-def calc_rates(source_map, total_key, delta_key, rate_key):
-    for region_data in source_map.values():
-        if rate_key not in region_data:
-            region_data[rate_key]
-        calc_rates_for_time_series(region_data[total_key],
-                                   region_data[delta_key],
-                                   region_data[rate_key])
+def calc_rates_for_time_series(total_ts, delta_ts, rate_ts):
+    totals = total_ts.tolist()
+    days = present_days(totals)
+    if not len(days):
+        return
+    deltas, rates = delta_ts.tolist(), rate_ts.tolist()
+    day = days[0] + 1
+    while day < len(deltas) and not is_missing(deltas[day]):
+        previous = 0 if is_missing(totals[day - 1]) else totals[day - 1]
+        if previous > RATE_CUTOFF:
+            rates[day] = 1.0 + float(deltas[day]) / previous
+        day += 1
+    rate_ts[:] = rates
+
+
+def is_computed(out_map, name, key):
+    return out_map.has_array(name, key) and not out_map.is_lazy(name, key)
+
+
+@instrument.instrumented
+def calc_rates(out_map, name, total_key, delta_key, rate_key, since=None):
+    """ declares rate_key, or recomputes it from since when an update starts from a computed one
+    """
+    if since is None or not is_computed(out_map, name, rate_key):
+        out_map.derive_lazily(name, rate_key, Derivation("rates", [total_key, delta_key]))
+        return
+    derived.rates(out_map.array(name, total_key), out_map.array(name, delta_key),
+                  out_map.array(name, rate_key), row_since(out_map, since))
 
 
 def calc_weighted_rates_for_time_series(rate_ts, weighted_rate_ts):
-    if not len(rate_ts):
-        print("BAD VALUES" + str(rate_ts) + str(weighted_rate_ts))
+    rates = rate_ts.tolist()
+    days = present_days(rates)
+    if not len(days):
         return
-    day = sorted(rate_ts.keys())[0]
-    last_weighted_rate = rate_ts[day]
-    while day in rate_ts:
+    weighted_rates = weighted_rate_ts.tolist()
+    day = days[0]
+    last_weighted_rate = rates[day]
+    while day < len(rates) and not is_missing(rates[day]):
         old_weight = (1.0 - SMOOTHING_FACTOR) * last_weighted_rate
-        last_weighted_rate = (SMOOTHING_FACTOR * rate_ts[day]) + old_weight
-        weighted_rate_ts[day] = last_weighted_rate
-        print(weighted_rate_ts[day])
-        day += ONE_DAY
-
-
-def calc_weighted_rates(source_map, rate_key, weighted_rate_key):
-    for region_data in source_map.values():
-        if weighted_rate_key not in region_data:
-            region_data[weighted_rate_key]
-        calc_weighted_rates_for_time_series(region_data[rate_key], region_data[weighted_rate_key])
+        last_weighted_rate = (SMOOTHING_FACTOR * rates[day]) + old_weight
+        weighted_rates[day] = last_weighted_rate
+        day += 1
+    weighted_rate_ts[:] = weighted_rates
 
 
-def zero_missing(inmap, key):
-    if key not in inmap:
-        return 0
-    val = inmap[key]
-    if not val:
-        return 0
-    return val
+@instrument.instrumented
+def calc_weighted_rates(out_map, name, rate_key, weighted_rate_key, since=None):
+    if since is None or not is_computed(out_map, name, weighted_rate_key):
+        out_map.derive_lazily(name, weighted_rate_key, Derivation("weighted_rates", [rate_key]))
+        return
+    derived.weighted_rates(out_map.array(name, rate_key),
+                           out_map.array(name, weighted_rate_key), row_since(out_map, since))
+
+
+class Parser(object):
+    """ a source parser: its schema reads raw values into the master map, derive computes the
+        other types from them in three steps
+
+        prepare     row by row, before the roll-up: gaps filled, new_* from total_*
+        roll-up     the additive types summed into the aggregate rows (see rollup.py)
+        finish      row by row, after the roll-up: the rate types, lazy unless an update
+                    starts from computed ones
+
+    Calling it parses from scratch.  update() instead brings the derived types of a previous
+    parse up to date with a new raw ingest, recomputing only the suffix of each series from the
+    first day whose raw values changed.  The steps are separate for streaming.py, which runs
+    them on chunks of regions.
+    """
+    def __init__(self, schema, prepare, additive, finish):
+        self.schema = schema
+        self.name = schema.source
+        self.ingest = schema.ingest
+        self.prepare = prepare
+        self.additive = additive
+        self.finish = finish
+
+    def __call__(self, lines, out_map):
+        self.ingest(lines, out_map)
+        self.derive(out_map)
+
+    def derive(self, out_map, since=None):
+        if self.prepare:
+            self.prepare(out_map, since)
+        add_aggregations(out_map, self.name, self.additive, since)
+        self.finish(out_map, since)
+
+    def widen(self, out_map, since, raw):
+        """ moves since back for the aggregate rows, see widen_aggregation_since """
+        return widen_aggregation_since(out_map, since, raw, self.name)
+
+    def update(self, previous, previous_raw, raw):
+        """ returns previous with the changes between previous_raw and raw applied """
+        out_map = previous.copy()
+        for region in raw.regions:
+            out_map.region_id(region)
+        if raw.origin is not None:
+            out_map.day_offset(raw.date_of(0))
+            out_map.day_offset(raw.date_of(raw.n_days - 1))
+        since = self.widen(out_map, changed_since(out_map, previous_raw, raw), raw)
+        suffix = derived.suffix_mask((len(out_map.regions), out_map.n_days), since)
+        for source, datatype, values in out_map.arrays():
+            values[suffix] = np.nan
+            if raw.has_array(source, datatype):
+                np.copyto(values, out_map.aligned(raw, source, datatype), where=suffix)
+        self.derive(out_map, since)
+        return out_map
+
+
+def changed_since(out_map, previous_raw, raw):
+    """ first day of each region whose derived values can differ between the two raw ingests
+
+    That is the first day a raw value differs, moved back to just after the last raw value of
+    either ingest: the days between the last value and new data appended later get filled.
+    Unchanged regions get the number of days, nothing to recompute.
+    """
+    n_regions, n_days = len(out_map.regions), out_map.n_days
+    first_change = np.full(n_regions, n_days)
+    last_value = np.full(n_regions, n_days)
+    keys = {(source, datatype) for store in (previous_raw, raw)
+            for source, datatype, _ in store.arrays()}
+    for source, datatype in keys:
+        old = out_map.aligned(previous_raw, source, datatype)
+        new = out_map.aligned(raw, source, datatype)
+        changed = ~((old == new) | (np.isnan(old) & np.isnan(new)))
+        first_change = np.minimum(first_change, derived.first_present(changed))
+        old_last = derived.last_present(~np.isnan(old))
+        new_last = derived.last_present(~np.isnan(new))
+        last = np.where((old_last >= 0) | (new_last >= 0), np.minimum(old_last, new_last) + 1,
+                        n_days)
+        last_value = np.minimum(last_value, last)
+    return np.where(first_change < n_days, np.minimum(first_change, last_value), n_days)
 
 
 def noop_parser(lines, out_map):
     pass
 
 
-def covid_str2date(datestr):
-    year = int(datestr[:4])
-    month = int(datestr[4:6])
-    day = int(datestr[6:8])
-    return dt.date(year, month, day)
-
-
-def add_covid_data(region, date, line, out_map):
-    add_raw_data_point('covid', region, 'total_cases', date, zero_missing(line, 'positive'),
-                       out_map)
-    add_raw_data_point('covid', region, 'total_deaths', date, zero_missing(line, 'death'), out_map)
+COVID_SCHEMA = schema.LongSchema("covid", region=["state"], country="USA", date="date",
+                                 date_format="%Y%m%d",
+                                 values={"total_cases": "positive", "total_deaths": "death"})
 
 
-def covid_parser(lines, out_map):
-    for line in lines:
-        print(line)
-        state = line["state"]
-        region = rn.normalize("USA", state)
-        date = covid_str2date(line["date"])
-        add_covid_data(region, date, line, out_map)
+def covid_prepare(out_map, since=None):
+    fill_gaps_for_source(out_map, "covid", "total_cases", since)
+    calc_deltas(out_map, "covid", "total_cases", "new_cases", since)
+    fill_gaps_for_source(out_map, "covid", "total_deaths", since)
+    calc_deltas(out_map, "covid", "total_deaths", "new_deaths", since)
 
-    covid_map = out_map["covid"]
 
-    fill_gaps_for_source(covid_map, "total_cases")
-    calc_deltas(covid_map, "total_cases", "new_cases")
-    fill_gaps_for_source(covid_map, "total_deaths")
-    calc_deltas(covid_map, "total_deaths", "new_deaths")
+def covid_finish(out_map, since=None):
+    calc_rates(out_map, "covid", "total_cases", "new_cases", "rate_cases", since)
+    calc_weighted_rates(out_map, "covid", "rate_cases", "weighted_rate_cases", since)
+    calc_rates(out_map, "covid", "total_deaths", "new_deaths", "rate_deaths", since)
+    calc_weighted_rates(out_map, "covid", "rate_deaths", "weighted_rate_deaths", since)
 
-    add_usa_aggregation(covid_map, "total_cases")
-    add_usa_aggregation(covid_map, "new_cases")
-    add_usa_aggregation(covid_map, "total_deaths")
-    add_usa_aggregation(covid_map, "new_deaths")
 
-    calc_rates(covid_map, "total_cases", "new_cases", "rate_cases")
-    calc_weighted_rates(covid_map, "rate_cases", "weighted_rate_cases")
-    calc_rates(covid_map, "total_deaths", "new_deaths", "rate_deaths")
-    calc_weighted_rates(covid_map, "rate_deaths", "weighted_rate_deaths")
+covid_parser = Parser(COVID_SCHEMA, covid_prepare,
+                      ["total_cases", "new_cases", "total_deaths", "new_deaths"], covid_finish)
 
 
-def csse_str2date(datestr):
-    month, day, year = datestr.split('/')
-    return dt.date(2000 + int(year), int(month), int(day))
+CSSE_REGION = ["Country/Region", "Province/State"]
+CSSE_CONFIRMED_SCHEMA = schema.WideSchema("csse", region=CSSE_REGION, date_format="%m/%d/%y",
+                                          datatype="total_cases")
+CSSE_DEATHS_SCHEMA = schema.WideSchema("csse", region=CSSE_REGION, date_format="%m/%d/%y",
+                                       datatype="total_deaths")
 
 
-def csse_parser(lines, out_map, datatype):
-    for line in lines:
-        subdivision = line["Province/State"]
-        country = line["Country/Region"]
-        region = rn.normalize(country, subdivision)
-        for item in line:
-            if re.match(r"\d\d?/\d\d?/\d\d", item):
-                val = line[item]
-                date = csse_str2date(item)
-                add_raw_data_point('csse', region, datatype, date, val, out_map)
+def csse_prepare_confirmed(out_map, since=None):
+    fill_gaps_for_source(out_map, "csse", "total_cases", since)
+    calc_deltas(out_map, "csse", "total_cases", "new_cases", since)
 
 
-def csse_parser_confirmed(lines, out_map):
-    csse_parser(lines, out_map, "total_cases")
-    csse_map = out_map["csse"]
+def csse_finish_confirmed(out_map, since=None):
+    calc_rates(out_map, "csse", "total_cases", "new_cases", "rate_cases", since)
+    calc_weighted_rates(out_map, "csse", "rate_cases", "weighted_rate_cases", since)
 
-    fill_gaps_for_source(csse_map, "total_cases")
-    calc_deltas(csse_map, "total_cases", "new_cases")
 
-    add_usa_aggregation(csse_map, "total_cases")
-    add_usa_aggregation(csse_map, "new_cases")
+def csse_prepare_deaths(out_map, since=None):
+    fill_gaps_for_source(out_map, "csse", "total_deaths", since)
+    calc_deltas(out_map, "csse", "total_deaths", "new_deaths", since)
 
-    calc_rates(csse_map, "total_cases", "new_cases", "rate_cases")
-    calc_weighted_rates(csse_map, "rate_cases", "weighted_rate_cases")
 
-    return
+def csse_finish_deaths(out_map, since=None):
+    calc_rates(out_map, "csse", "total_deaths", "new_deaths", "rate_deaths", since)
+    calc_weighted_rates(out_map, "csse", "rate_deaths", "weighted_rate_deaths", since)
 
 
-def csse_parser_deaths(lines, out_map):
-    csse_parser(lines, out_map, "total_deaths")
-    csse_map = out_map["csse"]
+csse_parser_confirmed = Parser(CSSE_CONFIRMED_SCHEMA, csse_prepare_confirmed,
+                               ["total_cases", "new_cases"], csse_finish_confirmed)
+csse_parser_deaths = Parser(CSSE_DEATHS_SCHEMA, csse_prepare_deaths,
+                            ["total_deaths", "new_deaths"], csse_finish_deaths)
 
-    fill_gaps_for_source(csse_map, "total_deaths")
-    calc_deltas(csse_map, "total_deaths", "new_deaths")
 
-    add_usa_aggregation(csse_map, "total_deaths")
-    add_usa_aggregation(csse_map, "new_deaths")
+OWID_SCHEMA = schema.LongSchema("owid", region=["location"], date="date", date_format="%Y-%m-%d",
+                                values={"new_cases": "new_cases", "total_cases": "total_cases",
+                                        "new_deaths": "new_deaths",
+                                        "total_deaths": "total_deaths"})
 
-    calc_rates(csse_map, "total_deaths", "new_deaths", "rate_deaths")
-    calc_weighted_rates(csse_map, "rate_deaths", "weighted_rate_deaths")
-    return
 
+def owid_finish(out_map, since=None):
+    calc_rates(out_map, "owid", "total_cases", "new_cases", "rate_cases", since)
+    calc_weighted_rates(out_map, "owid", "rate_cases", "weighted_rate_cases", since)
+    calc_rates(out_map, "owid", "total_deaths", "new_deaths", "rate_deaths", since)
+    calc_weighted_rates(out_map, "owid", "rate_deaths", "weighted_rate_deaths", since)
 
-def owid_str2date(datestr):
-    year, month, day = datestr.split("-")
-    return dt.date(int(year), int(month), int(day))
 
+# OWID publishes new_* itself, nothing to prepare
+owid_parser = Parser(OWID_SCHEMA, None,
+                     ["total_cases", "new_cases", "total_deaths", "new_deaths"], owid_finish)
 
-def add_owid_data(region, date, line, out_map):
-    add_raw_data_point("owid", region, "new_cases", date, zero_missing(line, "new_cases"), out_map)
-    add_raw_data_point("owid", region, "total_cases", date, zero_missing(line, "total_cases"),
-                       out_map)
-    add_raw_data_point("owid", region, "new_deaths", date, zero_missing(line, "new_deaths"),
-                       out_map)
-    add_raw_data_point("owid", region, "total_deaths", date, zero_missing(line, "total_deaths"),
-                       out_map)
 
-
-def owid_parser(lines, out_map):
-    for line in lines:
-        region = rn.normalize(line["location"])
-        date = owid_str2date(line["date"])
-        add_owid_data(region, date, line, out_map)
-
-    calc_rates(out_map["owid"], "total_cases", "new_cases", "rate_cases")
-    calc_weighted_rates(out_map["owid"], "rate_cases", "weighted_rate_cases")
-    calc_rates(out_map["owid"], "total_deaths", "new_deaths", "rate_deaths")
-    calc_weighted_rates(out_map["owid"], "rate_deaths", "weighted_rate_deaths")
+def random_series(n_regions, n_days, seed=0):
+    """ cumulative counts with missing days, zero days and empty rows for checking """
+    rng = np.random.default_rng(seed)
+    values = np.cumsum(rng.integers(0, 40, (n_regions, n_days)), axis=1).astype(float)
+    values[rng.random((n_regions, n_days)) < 0.1] = 0.0
+    values[rng.random((n_regions, n_days)) < 0.1] = np.nan
+    values[:, :n_days // 4][rng.random(n_regions) < 0.3] = np.nan
+    values[rng.random(n_regions) < 0.05] = np.nan
+    return values
+
+
+def check_derived_engine(n_regions=200, n_days=120):
+    """ the batched engine in derived.py must match the per-series reference helpers """
+    def per_series(func, *arrays):
+        for rows in zip(*arrays):
+            func(*rows)
+
+    def same(a, b):
+        return np.array_equal(a, b, equal_nan=True)
+
+    def close(a, b):
+        # the batched smoothing sums a block of days in closed form, in another order
+        return np.array_equal(np.isnan(a), np.isnan(b)) and np.allclose(a, b, rtol=1e-12,
+                                                                         equal_nan=True)
+
+    totals = random_series(n_regions, n_days)
+    batch_totals, series_totals = totals.copy(), totals.copy()
+    derived.forward_fill(batch_totals)
+    per_series(fill_gaps, series_totals)
+
+    empty = np.full_like(totals, np.nan)
+    batch_deltas, series_deltas = empty.copy(), empty.copy()
+    derived.deltas(batch_totals, batch_deltas)
+    per_series(calc_deltas_for_time_series, series_totals, series_deltas)
+
+    batch_sums, series_sums = batch_totals.copy(), series_totals.copy()
+    groups = {0: list(range(2, n_regions, 3)), 1: list(range(4, n_regions, 3))}
+    derived.add_groups(batch_sums, np.array(groups[0] + groups[1]), np.array([0, 1]),
+                       np.array([0, len(groups[0])]))
+    for target, group in groups.items():
+        for row in group:
+            add_to_aggregation(series_sums[row], series_sums[target])
+
+    batch_rates, series_rates = empty.copy(), empty.copy()
+    derived.rates(batch_totals, batch_deltas, batch_rates)
+    per_series(calc_rates_for_time_series, series_totals, series_deltas, series_rates)
+
+    raw_deltas = random_series(n_regions, n_days, seed=1)
+    batch_raw_rates, series_raw_rates = empty.copy(), empty.copy()
+    derived.rates(totals, raw_deltas, batch_raw_rates)
+    per_series(calc_rates_for_time_series, totals, raw_deltas, series_raw_rates)
+
+    batch_weighted, series_weighted = empty.copy(), empty.copy()
+    derived.weighted_rates(batch_rates, batch_weighted)
+    per_series(calc_weighted_rates_for_time_series, series_rates, series_weighted)
+
+    return all([
+        same(batch_totals, series_totals),
+        same(batch_deltas, series_deltas),
+        same(batch_sums, series_sums),
+        same(batch_rates, series_rates),
+        same(batch_raw_rates, series_raw_rates),
+        close(batch_weighted, series_weighted),
+    ])
+
+
+def check_incremental_update(n_days=120, seed=2):
+    """ Parser.update on top of a previous parse must match parsing the new raw values from
+        scratch, with days appended, historical values revised and the roll-ups involved
+    """
+    states = [("United States of America", code) for code in sorted(rn.REV_STATES)]
+    start = dt.date(2020, 3, 1)
+    rng = np.random.default_rng(seed)
+    cases, deaths = random_series(len(states), n_days, seed), random_series(len(states), n_days)
+
+    def raw_store(cases, deaths):
+        return TimeSeriesStore.from_arrays(states, start, {("covid", "total_cases"): cases,
+                                                           ("covid", "total_deaths"): deaths})
+
+    previous_raw = raw_store(cases[:, :-7].copy(), deaths[:, :-7].copy())
+    previous = previous_raw.copy()
+    covid_parser.derive(previous)
+    revised = rng.random(cases.shape) < 0.01
+    cases[revised] = np.round(cases[revised] * 1.5)
+    raw = raw_store(cases, deaths)
+    full = raw.copy()
+    covid_parser.derive(full)
+    updated = covid_parser.update(previous, previous_raw, raw)
+    # as from a snapshot, which holds the rate types computed
+    previous.materialize()
+    eager = covid_parser.update(previous, previous_raw, raw)
+    full.materialize()
+    return all([
+        not eager.is_lazy("covid", "weighted_rate_cases"),
+        all(np.array_equal(values, store.array(source, datatype), equal_nan=True)
+            for source, datatype, values in full.arrays() for store in (updated, eager)),
+    ])
+
+
+def check_lazy_derive(n_days=120, seed=3):
+    """ the lazy rate types must match computing them eagerly, whichever rows are read first """
+    states = [("United States of America", code) for code in sorted(rn.REV_STATES)]
+    cases = random_series(len(states), n_days, seed)
+    store = TimeSeriesStore.from_arrays(states, dt.date(2020, 3, 1),
+                                        {("covid", "total_cases"): cases})
+    covid_parser.derive(store)
+    lazy_before = {datatype for _, datatype, _ in store.arrays()}
+    totals, deltas = store.array("covid", "total_cases"), store.array("covid", "new_cases")
+    rates, weighted = np.full_like(totals, np.nan), np.full_like(totals, np.nan)
+    derived.rates(totals, deltas, rates)
+    derived.weighted_rates(rates, weighted)
+    some = np.array([3, 1, 3, len(states) - 1])
+    first = store.rows("covid", "weighted_rate_cases", some)
+    partial = store.is_lazy("covid", "rate_cases")
+    copied = store.copy()
+    store.materialize()
+    return all([
+        "rate_cases" not in lazy_before and "weighted_rate_cases" in store.types("covid"),
+        np.array_equal(first, weighted[some], equal_nan=True),
+        partial and not store.is_lazy("covid", "rate_cases"),
+        np.array_equal(store.array("covid", "rate_cases"), rates, equal_nan=True),
+        np.array_equal(store.array("covid", "weighted_rate_cases"), weighted, equal_nan=True),
+        np.array_equal(copied.array("covid", "weighted_rate_cases"), weighted, equal_nan=True),
+    ])
 
 
 def main():
-    # run_tests TBD
-    pass
+    print(all([check_derived_engine(), check_incremental_update(), check_lazy_derive()]))
 
 
 if __name__ == '__main__':
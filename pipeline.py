@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+""" Loading the parsed master map from the source files
+
+Each source file is parsed into its own store, through its snapshot when possible (see
+snapshot.py), and the stores are merged into one master map.  parse-data.py is the command
+line front end; the functions here take its parsed arguments.
+"""
+
+import archive
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import instrument
+import os
+import parsers
+import rawfile
+import region_normalize as rn
+import snapshot
+import sys
+import tempfile
+
+
+class Source(object):
+    def __init__(self, name, filename, parser, reader=csv.reader):
+        self.name = name
+        self.filename = filename
+        self.parser = parser
+        self.reader = reader
+
+
+SOURCES = [
+    Source("covidtracker", "covidtracker-daily.csv", parsers.covid_parser),
+    Source("csse", "csse-confirmed.csv", parsers.csse_parser_confirmed),
+    Source("csse", "csse-deaths.csv", parsers.csse_parser_deaths),
+    Source("owid", "owid-full_data.csv", parsers.owid_parser),
+]
+
+
+def options(datadir, **overrides):
+    """ the arguments the functions here take, with parse-data.py's defaults, for library use """
+    args = argparse.Namespace(datadir=datadir, cache_dir=None, no_cache=False, full=False, jobs=1,
+                              profile=None, profile_memory=False)
+    for key, value in overrides.items():
+        setattr(args, key, value)
+    return args
+
+
+def source_path(args, source):
+    """ where the file of source is stored in the data directory, compressed or not """
+    return rawfile.stored_path(args.datadir, source.filename)
+
+
+def present_sources(args, sources):
+    """ the sources with a file in the data directory """
+    return [source for source in sources if os.path.isfile(source_path(args, source))]
+
+
+@contextlib.contextmanager
+def read_csv(args, source):
+    """ the rows of the file of source, decompressed as they are read """
+    with rawfile.open_text(source_path(args, source)) as csvfile:
+        yield source.reader(csvfile)
+
+
+def ingest_source(args, source):
+    """ reads the raw values of one source file into its own store """
+    raw = parsers.build_master_dict()
+    with instrument.stage(f"ingest:{source.filename}") as stage, read_csv(args, source) as rows:
+        source.parser.ingest(stage.count(rows), raw)
+        stage.points(raw)
+    return raw
+
+
+def parse_source(args, source):
+    """ parses one source file into its own store, also returning the raw ingest """
+    raw = ingest_source(args, source)
+    with instrument.stage(f"derive:{source.filename}") as stage:
+        partial = raw.copy()
+        source.parser.derive(partial)
+        stage.points(partial)
+    return partial, raw
+
+
+def get_cache_dir(args):
+    return args.cache_dir or os.path.join(args.datadir, ".parse-cache")
+
+
+def load_source(args, source):
+    """ returns the parsed store for source
+
+    An unchanged file is loaded from its snapshot.  A changed file is ingested again and, unless
+    --full is given, only the days after the first changed raw value of each region are derived
+    again on top of the snapshot.
+    """
+    if args.no_cache:
+        return parse_source(args, source)[0]
+    cache_dir = get_cache_dir(args)
+    filepath = source_path(args, source)
+    with instrument.stage(f"snapshot-load:{source.filename}"):
+        code = snapshot.code_fingerprint()
+        previous = snapshot.load_snapshot(cache_dir, filepath, code, source.filename)
+    if previous is not None and previous.fresh:
+        return previous.store
+    fingerprint = snapshot.file_fingerprint(filepath)
+    if previous is not None and not args.full:
+        raw = ingest_source(args, source)
+        with instrument.stage(f"update:{source.filename}"):
+            partial = source.parser.update(previous.store, previous.raw, raw)
+    else:
+        partial, raw = parse_source(args, source)
+    with instrument.stage(f"snapshot-save:{source.filename}"):
+        snapshot.save_snapshot(cache_dir, filepath, partial, raw, fingerprint, code,
+                               source.filename)
+    return partial
+
+
+def aliases_path(args):
+    """ the aliases.csv of the country names region_match matched, None with --no_cache """
+    return None if args.no_cache else os.path.join(get_cache_dir(args), "aliases.csv")
+
+
+def use_aliases(args):
+    rn.use_aliases(aliases_path(args))
+
+
+def save_aliases(args):
+    """ keeps the country names matched by region_match in the cache dir and reports them """
+    path = aliases_path(args)
+    learned = rn.save_aliases(path) if path else rn.learned_aliases()
+    for alias, match in sorted(learned.items()):
+        print(f"matched {alias!r} to {match.name!r} (score {match.score:.2f}), "
+              + (f"added to {path}" if path else "not kept with --no_cache"), file=sys.stderr)
+
+
+def load_source_in_worker(args, source, aliases):
+    """ runs in a --jobs worker, the result is left in a snapshot instead of being pickled back
+
+    Returns the country names the worker matched, which the parent saves, and with --profile
+    the stages it timed.
+    """
+    rn.use_aliases(aliases)
+    if not args.profile:
+        load_source(args, source)
+        return rn.learned_aliases(), None
+    instrument.enable(memory=args.profile_memory)
+    load_source(args, source)
+    return rn.learned_aliases(), instrument.disable()["stages"]
+
+
+def load_sources_in_parallel(args, sources, master_map):
+    """ parses each source in its own process and merges the results
+
+    Workers write their stores as snapshots and the parent maps the arrays from disk, so the
+    numeric data is never pickled.  With --no_cache the snapshots go to a scratch directory
+    that is removed afterwards.
+    """
+    with tempfile.TemporaryDirectory(prefix="parse-data-") as scratch:
+        worker_args = argparse.Namespace(**vars(args))
+        if args.no_cache:
+            worker_args.no_cache, worker_args.full, worker_args.cache_dir = False, True, scratch
+        cache_dir = get_cache_dir(worker_args)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [pool.submit(load_source_in_worker, worker_args, source,
+                                   aliases_path(args))
+                       for source in sources]
+            for source, future in zip(sources, futures):
+                learned, stages = future.result()
+                rn.add_learned(learned)
+                instrument.absorb(stages or [])
+                parsed = snapshot.load_snapshot(cache_dir, source_path(args, source),
+                                                name=source.filename)
+                if parsed is None or not parsed.fresh:
+                    # the file moved under the worker, parse it here instead
+                    merge(master_map, load_source(args, source))
+                    continue
+                merge(master_map, parsed.store)
+                del parsed
+
+
+def merge(master_map, partial):
+    with instrument.stage("merge") as stage:
+        master_map.merge(partial)
+        stage.points(partial)
+
+
+def load_sources(args, sources):
+    use_aliases(args)
+    master_map = parsers.build_master_dict()
+    if args.jobs > 1 and len(sources) > 1:
+        load_sources_in_parallel(args, sources, master_map)
+        return master_map
+    for source in sources:
+        merge(master_map, load_source(args, source))
+    return master_map
+
+
+def load_archive(args, sources, archive_dir):
+    """ yields (date, master map) for every day with a new version in archive_dir, oldest first
+
+    Each day is checked out into the as-of directory of the archive (see archive.py) and parsed
+    with its snapshots, so every day is an incremental update of the day before.  Sources
+    without a version yet are left out.
+    """
+    store = archive.Archive(archive_dir)
+    for day in store.days():
+        day_args = argparse.Namespace(**vars(args))
+        day_args.datadir = store.checkout(day)
+        yield day, load_sources(day_args, present_sources(day_args, sources))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+""" Compressed storage of the raw source files
+
+get-covid-data.py keeps every download compressed, as <filename>.gz (the default) or
+<filename>.zst, and the parsers read them back through one incremental decoder, so a file is
+never decompressed to disk or held in memory whole:
+
+    with rawfile.open_text(rawfile.stored_path(datadir, "owid-full_data.csv")) as csvfile:
+        for row in csv.DictReader(csvfile):
+            ...
+
+An uncompressed <filename> is still read as it is.  zstd needs the zstandard package, gzip only
+the standard library.  A body the server already sent gzip-encoded is written to disk as it
+came when the stored codec is gzip as well.
+"""
+
+import gzip
+import importlib.util
+import io
+import os
+import shutil
+
+CODECS = {"gzip": ".gz", "zstd": ".zst"}
+CHUNK_SIZE = 1 << 16
+READ_BUFFER = 1 << 20
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+
+def needs_zstandard(codec):
+    """ returns an error message when codec needs zstandard and it is not installed """
+    if codec != "zstd":
+        return None
+    if importlib.util.find_spec("zstandard") is None:
+        return "zstd needs zstandard, install it with 'pip install zstandard'"
+    return None
+
+
+def codec_of(path):
+    for codec, suffix in CODECS.items():
+        if path.endswith(suffix):
+            return codec
+    return None
+
+
+def stored_paths(datadir, filename):
+    """ the paths filename may be stored under, uncompressed first """
+    path = os.path.join(datadir, filename)
+    return [path] + [path + suffix for suffix in CODECS.values()]
+
+
+def stored_path(datadir, filename):
+    """ the newest stored copy of filename, the uncompressed path if there is none """
+    existing = [path for path in stored_paths(datadir, filename) if os.path.isfile(path)]
+    if not existing:
+        return os.path.join(datadir, filename)
+    return max(existing, key=os.path.getmtime)
+
+
+def decoded(stream, codec):
+    """ a readable binary stream of the decompressed content of stream """
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    if codec is None:
+        return stream
+    raise ValueError(f"unknown codec {codec}")
+
+
+def encoded(stream, codec):
+    """ a writable binary stream compressing into stream, closing it leaves stream open """
+    if codec == "gzip":
+        # no name and no mtime in the header: the same content always compresses the same
+        return gzip.GzipFile(filename="", fileobj=stream, mode='wb', compresslevel=GZIP_LEVEL,
+                             mtime=0)
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(stream, closefd=False)
+    raise ValueError(f"unknown codec {codec}")
+
+
+def open_binary(path):
+    """ the decompressed content of path, buffered for line by line reading """
+    infile = open(path, 'rb', buffering=READ_BUFFER)
+    codec = codec_of(path)
+    if codec is None:
+        return infile
+    return io.BufferedReader(decoded(infile, codec), buffer_size=READ_BUFFER)
+
+
+def open_text(path):
+    """ path as text for the csv module, decompressed on the fly """
+    return io.TextIOWrapper(open_binary(path), newline='')
+
+
+def store_stream(stream, encoding, output_file, codec):
+    """ copies stream, compressed with encoding (None if not), into output_file as codec """
+    if encoding == codec:
+        shutil.copyfileobj(stream, output_file, CHUNK_SIZE)
+        return
+    source = decoded(stream, encoding)
+    if codec is None:
+        shutil.copyfileobj(source, output_file, CHUNK_SIZE)
+        return
+    with encoded(output_file, codec) as target:
+        shutil.copyfileobj(source, target, CHUNK_SIZE)
+
+
+def compress_file(path, codec):
+    """ replaces the uncompressed file path by its codec version, returns the new path """
+    target = path + CODECS[codec]
+    with open(path, 'rb') as infile, open(target, 'wb') as outfile:
+        store_stream(infile, None, outfile, codec)
+    os.unlink(path)
+    return target
+
+
+def main():
+    import tempfile
+    content = "".join(f"{n},row {n}\r\n" for n in range(50000)).encode()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "data.csv")
+        with open(path, 'wb') as outfile:
+            outfile.write(content)
+        gzipped = compress_file(path, "gzip")
+        with open(gzipped, 'rb') as infile:
+            first = infile.read()
+        with open(gzipped, 'rb') as infile, open(os.path.join(tmp, "copy.csv"), 'wb') as outfile:
+            store_stream(infile, "gzip", outfile, None)
+        with open(os.path.join(tmp, "copy.csv"), 'rb') as infile:
+            copied = infile.read()
+        with open_text(stored_path(tmp, "data.csv")) as infile:
+            lines = infile.readlines()
+        again = compress_file(os.path.join(tmp, "copy.csv"), "gzip")
+        with open(again, 'rb') as infile:
+            second = infile.read()
+        print(all([
+            stored_path(tmp, "data.csv") == gzipped,
+            len(first) < len(content) / 3,
+            copied == content,
+            first == second,
+            lines[1] == "1,row 1\r\n" and len(lines) == 50000,
+            needs_zstandard("gzip") is None,
+        ]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+""" Reconciliation of the sources that report the same regions
+
+The master map keeps every source on one grid of region ids and day offsets, so for one type
+the sources stack into a [source, region, day] array and are compared cell by cell at once:
+
+    consensus   the median over the sources present in a cell
+    deviation   (value - consensus) / max(|consensus|, MIN_SCALE) per source and cell, NaN
+                where fewer than two sources report the cell
+    lag         per source and region, the shift in days (within +-max_lag) that best lines the
+                source up with the median of the other sources; positive when it reports later
+
+A source that reports a day late shows up as a lag of 1 instead of as a deviation on every
+day.  divergent() lists the (region, source) pairs whose deviation passes a threshold.
+
+    results = [reconcile.reconcile(master_map, datatype) for datatype in reconcile.TYPES]
+    reconcile.add_consensus(master_map, results)        # as the "consensus" source
+"""
+
+import datetime as dt
+import json
+import numpy as np
+import sys
+
+TYPES = ["total_cases", "total_deaths"]
+CONSENSUS_SOURCE = "consensus"
+MIN_SCALE = 10.0
+MAX_LAG = 7
+MIN_OVERLAP = 7
+# a shifted alignment has to cut the mean deviation by this much to count as a lag
+LAG_GAIN = 0.25
+
+
+def nan_median(values):
+    """ the median over axis 0 ignoring NaN, NaN where every value is """
+    ordered = np.sort(values, axis=0)
+    count = np.count_nonzero(~np.isnan(values), axis=0)
+    low = np.take_along_axis(ordered, np.maximum(count - 1, 0)[None] // 2, axis=0)[0]
+    high = np.take_along_axis(ordered, (count // 2)[None], axis=0)[0]
+    return (low + high) / 2
+
+
+def relative(values, reference):
+    return (values - reference) / np.maximum(np.abs(reference), MIN_SCALE)
+
+
+def estimate_lags(values, reference, max_lag=MAX_LAG):
+    """ per region (row), the shift of values against reference with the smallest mean
+        relative deviation: 0 unless a shift is clearly better, NaN without enough overlap
+    """
+    n_regions, n_days = values.shape
+    scale = np.maximum(np.abs(reference), MIN_SCALE)
+    errors = np.full((2 * max_lag + 1, n_regions), np.inf)
+    for index, lag in enumerate(range(-max_lag, max_lag + 1)):
+        if abs(lag) >= n_days:
+            continue
+        # values[t] against reference[t - lag]
+        shifted, base = slice(max(lag, 0), n_days + min(lag, 0)), \
+            slice(max(-lag, 0), n_days - max(lag, 0))
+        deviation = np.abs(values[:, shifted] - reference[:, base])
+        deviation /= scale[:, base]
+        present = ~np.isnan(deviation)
+        overlap = np.count_nonzero(present, axis=1)
+        total = np.where(present, deviation, 0.0).sum(axis=1)
+        errors[index] = np.where(overlap >= MIN_OVERLAP, total / np.maximum(overlap, 1), np.inf)
+    best = errors.argmin(axis=0)
+    best_error = errors[best, np.arange(n_regions)]
+    aligned = errors[max_lag]
+    lags = np.where(best_error < aligned * (1 - LAG_GAIN), best - max_lag, 0).astype(float)
+    lags[np.isinf(best_error)] = np.nan
+    return lags
+
+
+class Reconciliation(object):
+    """ the comparison of one type across sources, arrays over the store's regions and days """
+    def __init__(self, store, datatype, sources, consensus, deviation, lags):
+        self.store = store
+        self.datatype = datatype
+        self.sources = sources
+        self.consensus = consensus
+        self.deviation = deviation
+        self.lags = lags
+
+    def divergent(self, threshold, start=None):
+        """ the (region, source) pairs deviating by more than threshold on some day from
+            start on, worst first, as dicts for the report
+        """
+        first = 0 if start is None else max(0, start.toordinal() - self.store.origin)
+        deviation = np.abs(self.deviation[:, :, first:])
+        over = np.nan_to_num(deviation, nan=0.0) > threshold
+        days = np.count_nonzero(over, axis=2)
+        worst = np.where(over, deviation, 0.0).max(axis=2, initial=0.0)
+        rows = []
+        for sid, rid in zip(*np.nonzero(days)):
+            last = first + int(np.flatnonzero(over[sid, rid])[-1])
+            lag = self.lags[sid, rid]
+            rows.append({
+                "region": list(self.store.regions[rid]),
+                "type": self.datatype,
+                "source": self.sources[sid],
+                "days": int(days[sid, rid]),
+                "max_deviation": round(float(worst[sid, rid]), 4),
+                "last_day": self.store.date_of(last).isoformat(),
+                "lag": None if lag != lag else int(lag),
+            })
+        rows.sort(key=lambda row: (-row["max_deviation"], row["region"], row["source"]))
+        return rows
+
+
+def reconcile(store, datatype, sources=None, max_lag=MAX_LAG):
+    """ compares datatype across sources (default every source that has it) in one pass """
+    if sources is None:
+        sources = [source for source in store
+                   if source != CONSENSUS_SOURCE and store.has_array(source, datatype)]
+    values = np.stack([store.array(source, datatype) for source in sources])
+    shared = np.count_nonzero(~np.isnan(values), axis=0) >= 2
+    # most regions are reported by one source, which is then the consensus as it is
+    consensus = np.fmax.reduce(values, axis=0)
+    deviation = np.full(values.shape, np.nan)
+    rows = np.flatnonzero(shared.any(axis=1))
+    consensus[rows] = nan_median(values[:, rows])
+    deviation[:, rows] = np.where(shared[rows], relative(values[:, rows], consensus[rows]), np.nan)
+    lags = np.full((len(sources), len(store.regions)), np.nan)
+    # only regions reported by two sources on enough days can have a lag
+    rows = np.flatnonzero(np.count_nonzero(shared, axis=1) >= MIN_OVERLAP)
+    for sid in range(len(sources)):
+        others = np.delete(values[:, rows], sid, axis=0)
+        if len(others):
+            lags[sid, rows] = estimate_lags(values[sid, rows], nan_median(others), max_lag)
+    return Reconciliation(store, datatype, sources, consensus, deviation, lags)
+
+
+def add_consensus(store, results, name=CONSENSUS_SOURCE):
+    """ stores the consensus series of results as source name """
+    for result in results:
+        store.array(name, result.datatype)[:] = result.consensus
+
+
+def write_report(path, results, threshold, start=None):
+    """ writes the divergent pairs of every result as json to path, "-" for stderr """
+    report = {
+        "threshold": threshold,
+        "start": start.isoformat() if start else None,
+        "divergent": [row for result in results for row in result.divergent(threshold, start)],
+    }
+    if path == "-":
+        json.dump(report, sys.stderr, indent=2)
+        sys.stderr.write("\n")
+    else:
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+def main():
+    from timeseries import TimeSeriesStore
+    store = TimeSeriesStore()
+    day = dt.date(2020, 3, 1)
+    totals = [100 * 2 ** (offset / 4) for offset in range(40)]
+    for offset in range(40):
+        date = day + dt.timedelta(offset)
+        store.set_value("owid", ("France",), "total_cases", date, totals[offset])
+        store.set_value("csse", ("France",), "total_cases", date, totals[offset])
+        # one day behind the others
+        store.set_value("covid", ("France",), "total_cases", date, totals[max(offset - 1, 0)])
+        store.set_value("owid", ("Japan",), "total_cases", date, 50)
+        store.set_value("csse", ("Japan",), "total_cases", date, 50 if offset != 30 else 500)
+    result = reconcile(store, "total_cases")
+    france, japan = store.find_region(("France",)), store.find_region(("Japan",))
+    rows = result.divergent(0.5)
+    add_consensus(store, [result])
+    print(all([
+        result.sources == ["owid", "csse", "covid"],
+        result.consensus[france, 10] == totals[10],
+        result.lags[:, france].tolist() == [0, 0, 1],
+        result.lags[2, japan] != result.lags[2, japan],
+        nan_median(np.array([[1.0], [np.nan], [3.0]]))[0] == 2.0,
+        [(row["region"], row["source"], row["days"]) for row in rows] ==
+        [(["Japan"], "csse", 1), (["Japan"], "owid", 1)],
+        rows[0]["last_day"] == (day + dt.timedelta(30)).isoformat(),
+        store.array(CONSENSUS_SOURCE, "total_cases")[japan, 30] == 275,
+    ]))
+
+
+if __name__ == '__main__':
+    main()
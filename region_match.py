@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+""" Matching country names region_normalize does not know to ones it does
+
+Upstream files rename countries every so often ("Burma", "Cabo Verde", "Turkiye"), and a name
+missing from countries.csv and NORMALIZED_COUNTRIES used to become a region of its own,
+"Burma NOT FOUND", that no other source joins with.  A TrigramIndex holds every known spelling:
+
+    names       folded to lower case ascii words, "Côte d'Ivoire" is "cote d ivoire", and split
+                into the trigrams of each word padded with two spaces in front and one behind
+    codes       alpha-2 and alpha-3 codes, matched whole and case-insensitively, score 1.0
+
+match() scores the spellings sharing a trigram with the name by the Dice coefficient of their
+trigram sets, 2 * shared / (trigrams of the name + trigrams of the spelling), through an
+inverted index from trigram to spellings, so a lookup costs the postings of the trigrams of the
+name and never a pass over the whole list.  A match is kept when the best canonical name scores
+at least min_score and beats the next best canonical name by margin.
+
+region_normalize.normalize_country() falls back to the index for unknown names, and
+parse-data.py keeps the matches it accepts in the aliases.csv of the cache dir (see
+pipeline.save_aliases).
+"""
+
+import numpy as np
+import re
+import unicodedata
+
+MIN_SCORE = 0.75
+MARGIN = 0.1
+_NOT_WORD = re.compile(r"[^a-z0-9]+")
+
+
+def fold(name):
+    """ name in lower case ascii words separated by single spaces """
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    return _NOT_WORD.sub(" ", name.lower()).strip()
+
+
+def trigrams(name):
+    """ the set of trigrams of the words of a folded name """
+    grams = set()
+    for word in name.split():
+        word = f"  {word} "
+        grams.update(word[start:start + 3] for start in range(len(word) - 2))
+    return grams
+
+
+class Match(object):
+    """ the canonical name found for a name, the spelling it matched and the score """
+    __slots__ = ("name", "spelling", "score")
+
+    def __init__(self, name, spelling, score):
+        self.name = name
+        self.spelling = spelling
+        self.score = score
+
+    def __repr__(self):
+        return f"Match({self.name!r}, {self.spelling!r}, {self.score:.3f})"
+
+
+class TrigramIndex(object):
+    """ spellings -> canonical names, looked up by trigram similarity
+
+    spellings maps every known spelling to its canonical name, codes maps alpha codes to
+    canonical names.
+    """
+    def __init__(self, spellings, codes=None):
+        # one entry per folded spelling, the first canonical name given for it wins
+        self.entries = {}
+        for spelling, name in spellings.items():
+            self.entries.setdefault(fold(spelling), (spelling, name))
+        self.codes = {code.upper(): name for code, name in (codes or {}).items() if code}
+        self.spellings = []
+        self.names = []
+        postings = {}
+        for folded, (spelling, name) in self.entries.items():
+            grams = trigrams(folded)
+            if not grams:
+                continue
+            for gram in grams:
+                postings.setdefault(gram, []).append(len(self.spellings))
+            self.spellings.append(spelling)
+            self.names.append(name)
+        self.sizes = np.array([len(trigrams(fold(spelling))) for spelling in self.spellings])
+        self.postings = {gram: np.array(ids, dtype=np.intp) for gram, ids in postings.items()}
+
+    def candidates(self, name, limit=5):
+        """ up to limit Matches for name, best first, one per canonical name """
+        folded = fold(name)
+        code = self.codes.get(folded.upper()) if len(folded) in (2, 3) else None
+        if code is not None:
+            return [Match(code, folded.upper(), 1.0)]
+        if folded in self.entries:
+            spelling, canonical = self.entries[folded]
+            return [Match(canonical, spelling, 1.0)]
+        grams = trigrams(folded)
+        hits = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not hits:
+            return []
+        ids, shared = np.unique(np.concatenate(hits), return_counts=True)
+        scores = 2.0 * shared / (len(grams) + self.sizes[ids])
+        matches = []
+        seen = set()
+        for position in np.argsort(-scores, kind="stable").tolist():
+            canonical = self.names[ids[position]]
+            if canonical in seen:
+                continue
+            seen.add(canonical)
+            matches.append(Match(canonical, self.spellings[ids[position]],
+                                 float(scores[position])))
+            if len(matches) == limit:
+                break
+        return matches
+
+    def match(self, name, min_score=MIN_SCORE, margin=MARGIN):
+        """ the Match of name if it is good enough, None otherwise """
+        matches = self.candidates(name, limit=2)
+        if not matches or matches[0].score < min_score:
+            return None
+        if len(matches) > 1 and matches[0].score - matches[1].score < margin:
+            return None
+        return matches[0]
+
+
+def main():
+    import region_normalize as rn
+    import time
+    index = rn.get_matcher()
+    names = ["Burma", "Cabo Verde", "Untied Kingdom", "Phillipines", "Narnia", "Atlantis",
+             "Diamond Princess", "Congo (Kinshasa)"]
+    start = time.perf_counter()
+    for _ in range(100):
+        for name in names:
+            index.candidates(name)
+    per_lookup = (time.perf_counter() - start) / (100 * len(names))
+
+    def matched(name):
+        match = index.match(name)
+        return match and match.name
+
+    print(all([
+        fold("Côte d'Ivoire") == "cote d ivoire",
+        trigrams("uk") == {"  u", " uk", "uk "},
+        matched("cote divoire") == "Côte d'Ivoire",
+        matched("Unitd States") == rn.normalize_country("US"),
+        matched("Africa") is None and matched("Netherlands Antilles") is None,
+        matched("Phillipines") == "Philippines",
+        matched("deu") == "Germany" and matched("FR") == "France",
+        matched("Narnia") is None and matched("Atlantis") is None,
+        matched("") is None,
+        per_lookup < 1e-3,
+    ]))
+
+
+if __name__ == '__main__':
+    main()
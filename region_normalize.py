@@ -1,34 +1,36 @@
 #!/usr/bin/env python
 
 import csv
+import functools
+import hashlib
+import itertools
 import os
+import pickle
+import region_match
 import sys
+import tempfile
 
 if sys.version_info[0] < 3:
     raise Exception("Must be using Python 3")
 
-# Read in country list and build a map of names
-COUNTRIES = {}
+# The country list is read from countries.csv on first use, not at import.  The parsed table is
+# pickled under __pycache__ keyed by a hash of the csv so later processes skip the csv parse.
 __location__ = os.path.realpath(
     os.path.join(os.getcwd(), os.path.dirname(__file__)))
-filepath = os.path.join(__location__, 'countries.csv')
-csvfile = open(filepath)
-countries = csv.DictReader(csvfile)
-for country_dict in countries:
-    name = country_dict['name']
-    COUNTRIES[name] = country_dict
-    first_name = name.split(",")[0]
-    if first_name not in COUNTRIES:
-        COUNTRIES[first_name] = country_dict
-    first_name = name.split(" ")[0]
-    if first_name not in COUNTRIES:
-        COUNTRIES[first_name] = country_dict
-    COUNTRIES["Cruise Ship"] = {"name": "Cruise Ship"}
-    COUNTRIES["World"] = {"name": "World"}
-    COUNTRIES["Vatican"] = {"name": "World"}
+COUNTRIES_CSV = os.path.join(__location__, 'countries.csv')
+COUNTRIES_CACHE_VERSION = 1
+_COUNTRIES = None
+_ALIASES = None
+_MATCHER = None
+# the aliases.csv of the names region_match matched on earlier runs, see use_aliases()
+_ALIASES_CSV = None
+# alias -> region_match.Match accepted by normalize_country, not in _ALIASES_CSV yet
+_LEARNED = {}
 
 MISSING_COUNTRIES = ["Cruise Ship", "World", "Vatican"]
 
+NORMALIZE_CACHE_SIZE = 1 << 16
+
 STATES = {'Alaska': 'AK', 'Alabama': 'AL', 'Arkansas': 'AR', 'American Samoa': 'AS',
           'Arizona': 'AZ', 'California': 'CA', 'Colorado': 'CO', 'Connecticut': 'CT',
           'District of Columbia': 'DC', 'Delaware': 'DE', 'Florida': 'FL', 'Georgia': 'GA',
@@ -90,35 +92,250 @@ def is_us_state(region):
     return True
 
 
-def normalize_country(country):
-    global COUNTRIES, NORMALIZED_COUNTRIES
-    if country in COUNTRIES:
-        return COUNTRIES[country]["name"]
+def read_countries(filepath):
+    """ builds the map of names from the csv, adding first-comma and first-word aliases """
+    countries = {}
+    with open(filepath, newline='') as csvfile:
+        for country_dict in csv.DictReader(csvfile):
+            name = country_dict['name']
+            countries[name] = country_dict
+            first_name = name.split(",")[0]
+            if first_name not in countries:
+                countries[first_name] = country_dict
+            first_name = name.split(" ")[0]
+            if first_name not in countries:
+                countries[first_name] = country_dict
+    countries["Cruise Ship"] = {"name": "Cruise Ship"}
+    countries["World"] = {"name": "World"}
+    countries["Vatican"] = {"name": "World"}
+    return countries
+
+
+def countries_cache_path(filepath):
+    with open(filepath, 'rb') as csvfile:
+        digest = hashlib.sha1(csvfile.read()).hexdigest()[:16]
+    return os.path.join(__location__, '__pycache__',
+                        f"countries-{COUNTRIES_CACHE_VERSION}-{digest}.pickle")
+
+
+def write_countries_cache(cache_path, countries):
+    """ best effort, a read-only checkout just parses the csv every time """
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+        with os.fdopen(fd, 'wb') as cache_file:
+            pickle.dump(countries, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, cache_path)
+    except OSError:
+        pass
+
+
+def load_countries(filepath=COUNTRIES_CSV):
+    cache_path = countries_cache_path(filepath)
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            return pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    countries = read_countries(filepath)
+    write_countries_cache(cache_path, countries)
+    return countries
+
+
+def get_countries():
+    global _COUNTRIES
+    if _COUNTRIES is None:
+        _COUNTRIES = load_countries()
+    return _COUNTRIES
+
+
+def resolve_country(country):
+    """ looks a name up in COUNTRIES, going through NORMALIZED_COUNTRIES if needed """
+    countries = get_countries()
+    if country in countries:
+        return countries[country]["name"]
     if country in NORMALIZED_COUNTRIES:
         country = NORMALIZED_COUNTRIES[country]
-    if country in COUNTRIES:
-        return COUNTRIES[country]["name"]
+    if country in countries:
+        return countries[country]["name"]
     country = country + " NOT FOUND"
     return country
 
 
+def read_aliases(filepath=None):
+    """ alias -> name from an aliases.csv (default the one of use_aliases()), names
+        countries.csv does not have are left out
+    """
+    filepath = filepath or _ALIASES_CSV
+    if filepath is None:
+        return {}
+    try:
+        with open(filepath, newline='') as csvfile:
+            rows = list(csv.DictReader(csvfile))
+    except OSError:
+        return {}
+    countries = get_countries()
+    return {row['alias']: row['name'] for row in rows if row['name'] in countries}
+
+
+def write_aliases(filepath, matches):
+    """ adds the region_match.Match of each alias in matches to the aliases.csv at filepath """
+    rows = {}
+    try:
+        with open(filepath, newline='') as csvfile:
+            rows = {row['alias']: row for row in csv.DictReader(csvfile)}
+    except OSError:
+        pass
+    for alias, match in matches.items():
+        rows[alias] = {'alias': alias, 'name': match.name, 'matched': match.spelling,
+                       'score': f"{match.score:.3f}"}
+    directory = os.path.dirname(os.path.abspath(filepath))
+    fd, tmppath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', newline='') as csvfile:
+            out = csv.DictWriter(csvfile, ['alias', 'name', 'matched', 'score'])
+            out.writeheader()
+            out.writerows(rows[alias] for alias in sorted(rows))
+        os.replace(tmppath, filepath)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def build_alias_index():
+    """ maps every spelling in COUNTRIES, NORMALIZED_COUNTRIES (full names, first-comma and
+        first-word aliases) and read_aliases() to the canonical name resolve_country gives it
+    """
+    aliases = {alias: resolve_country(alias) for alias in itertools.chain(get_countries(),
+                                                                          NORMALIZED_COUNTRIES)}
+    for alias, name in read_aliases().items():
+        aliases.setdefault(alias, resolve_country(name))
+    return aliases
+
+
+def get_aliases():
+    global _ALIASES
+    if _ALIASES is None:
+        _ALIASES = build_alias_index()
+    return _ALIASES
+
+
+def get_matcher():
+    """ the region_match.TrigramIndex of the full names, NORMALIZED_COUNTRIES, read_aliases()
+        and alpha codes; first-word and first-comma aliases are too short to match against
+    """
+    global _MATCHER
+    if _MATCHER is None:
+        aliases, countries = get_aliases(), get_countries()
+        rows = [row for name, row in countries.items() if row["name"] == name]
+        spellings = {row["name"]: aliases[row["name"]] for row in rows}
+        for alias in itertools.chain(NORMALIZED_COUNTRIES, read_aliases()):
+            # entries of NORMALIZED_COUNTRIES naming a country countries.csv lacks match nothing
+            if aliases[alias] in countries:
+                spellings[alias] = aliases[alias]
+        codes = {row[column]: aliases[row["name"]] for row in rows
+                 for column in ("alpha-2", "alpha-3") if row.get(column)}
+        _MATCHER = region_match.TrigramIndex(spellings, codes)
+    return _MATCHER
+
+
+def learned_aliases():
+    """ alias -> region_match.Match for the names matched since the last save_aliases() """
+    return dict(_LEARNED)
+
+
+def add_learned(matches):
+    """ takes the alias -> region_match.Match another process learned, for save_aliases() """
+    aliases = get_aliases()
+    for alias, match in matches.items():
+        aliases.setdefault(alias, match.name)
+        _LEARNED.setdefault(alias, match)
+
+
+def use_aliases(filepath):
+    """ reads the aliases of earlier runs from filepath, None for none; the file is not written
+        here but by save_aliases(), once per run so that processes never write it concurrently
+    """
+    global _ALIASES_CSV
+    if filepath != _ALIASES_CSV:
+        _ALIASES_CSV = filepath
+        reset_normalize_cache()
+
+
+def save_aliases(filepath=None):
+    """ adds the names matched so far to filepath (default the one of use_aliases()), returns
+        them; best effort like the countries cache, without a writable file they are matched
+        again every run
+    """
+    filepath = filepath or _ALIASES_CSV
+    learned = learned_aliases()
+    if not learned or filepath is None:
+        return {}
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        write_aliases(filepath, learned)
+    except OSError:
+        return {}
+    for alias in learned:
+        _LEARNED.pop(alias, None)
+    return learned
+
+
+def __getattr__(name):
+    """ COUNTRIES and ALIASES are loaded lazily on first access """
+    if name == "COUNTRIES":
+        return get_countries()
+    if name == "ALIASES":
+        return get_aliases()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def reset_normalize_cache():
+    """ forgets ALIASES and memoized results after COUNTRIES or NORMALIZED_COUNTRIES change """
+    global _ALIASES, _MATCHER
+    _ALIASES = None
+    _MATCHER = None
+    normalize.cache_clear()
+
+
+def normalize_country(country):
+    """ the canonical name of country, matched by region_match when no table has it """
+    aliases = get_aliases()
+    name = aliases.get(country)
+    if name is not None:
+        return name
+    match = get_matcher().match(country)
+    if match is None:
+        return country + " NOT FOUND"
+    aliases[country] = match.name
+    _LEARNED[country] = match
+    return match.name
+
+
+def is_country_name(name):
+    """ true for names that are already canonical country names """
+    return get_aliases().get(name) == name
+
+
 def normalize_subdivision(subdivision):
     if subdivision in STATES:
         return STATES[subdivision]
     return subdivision
 
 
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def normalize(country, subdivision=None, microdivision=None):
     """ returns a list consisting of either a
         (country),
         (country, subdivision), or
         (country, subdivision, subsubdivision)
+
+    Results are memoized per raw argument tuple, normalize.cache_info() has the hit/miss stats.
     """
-    global COUNTRIES, STATES, NORMALIZED_COUNTRIES
     country = normalize_country(country)
     if not subdivision:
         return country,
-    if subdivision == normalize_country(subdivision) and subdivision not in STATES:
+    if is_country_name(subdivision) and subdivision not in STATES:
         country = subdivision
         subdivision = microdivision
     if not subdivision:
@@ -134,15 +351,47 @@ def normalize(country, subdivision=None, microdivision=None):
     return country, subdivision, microdivision
 
 
+def normalize_column(countries, subdivisions=None):
+    """ normalizes a whole column of countries, with an optional parallel column of subdivisions,
+        calling normalize once per distinct pair
+    """
+    if subdivisions is None:
+        subdivisions = itertools.repeat(None)
+    regions = {}
+    column = []
+    for pair in zip(countries, subdivisions):
+        region = regions.get(pair)
+        if region is None:
+            region = regions[pair] = normalize(*pair)
+        column.append(region)
+    return column
+
+
 def main():
+    with tempfile.TemporaryDirectory() as directory:
+        alias_file = os.path.join(directory, "aliases.csv")
+        write_aliases(alias_file, {"Phillipines": region_match.Match("Philippines", "", 0.75)})
+        saved = read_aliases(alias_file)
+        use_aliases(alias_file)
+        from_file = get_aliases().get("Phillipines")
+        use_aliases(None)
     print(all([
         normalize("China") == ("China",),
-        normalize("Korea") == ("Korea, Republic of",),
+        # a bare "Korea" is the first-word alias of the first Korea in countries.csv, the DPRK
+        normalize("Korea, South") == ("Korea, Republic of",),
         normalize("China", "Hong Kong") == ("Hong Kong",),
         normalize("US") == ("United States of America",),
         normalize("US", "California") == ("United States of America", "CA"),
         normalize("USA", "CA") == ("United States of America", "CA"),
         normalize("USA", "District of Columbia") == ("United States of America", "DC"),
+        normalize_column(["US", "China", "US"], ["California", "Hong Kong", "California"]) ==
+        [("United States of America", "CA"), ("Hong Kong",), ("United States of America", "CA")],
+        all(normalize_country(alias) == resolve_country(alias) for alias in get_aliases()),
+        normalize("Phillipines", "Manila") == ("Philippines", "Manila"),
+        normalize("Narnia") == ("Narnia NOT FOUND",),
+        learned_aliases()["Phillipines"].name == "Philippines",
+        saved == {"Phillipines": "Philippines"},
+        from_file == "Philippines" and "Phillipines" not in build_alias_index(),
     ]))
 
 
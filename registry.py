@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+""" Attributes of normalized regions, worked out once per region
+
+Regions are the tuples of region_normalize.normalize().  What the rest of the code asks about a
+region, and used to work out again from the tuple on every call, is computed the first time and
+kept in a RegionInfo:
+
+    level       1 country, 2 subdivision, 3 microdivision
+    country     the first element
+    us_state    region_normalize.is_us_state()
+    alpha2/3    the ISO 3166 codes of the country, None for names not in countries.csv
+    groups      countries.csv column -> group of the country, for the countries.csv columns
+                intermediate-region, sub-region and region
+    aggregate   the column the region is a group of, for rows like ("Europe",)
+    parents     the regions it is summed into directly by the roll-up (see rollup.py)
+
+A TimeSeriesStore interns regions to small integer ids and its region_table holds the info of
+each id, so the roll-up and the Dataset indexes look attributes up by id.  column() gives one
+attribute of every region as an array, for filtering with numpy.
+"""
+
+import numpy as np
+import region_normalize as rn
+
+GROUP_COLUMNS = ["intermediate-region", "sub-region", "region"]
+_GROUPS = None
+_INFOS = {}
+
+
+def groups():
+    """ name -> countries.csv column for every group name """
+    global _GROUPS
+    if _GROUPS is None:
+        _GROUPS = {}
+        for country in rn.COUNTRIES.values():
+            for column in GROUP_COLUMNS:
+                if country.get(column):
+                    _GROUPS[country[column]] = column
+    return _GROUPS
+
+
+class RegionInfo(object):
+    __slots__ = ("region", "level", "country", "us_state", "alpha2", "alpha3", "groups",
+                 "aggregate", "parents")
+
+    def __init__(self, region):
+        self.region = region
+        self.level = len(region)
+        self.country = region[0]
+        self.us_state = rn.is_us_state(region)
+        row = rn.COUNTRIES.get(region[0])
+        if row is None or row["name"] != region[0]:
+            # an alias or a name countries.csv does not have
+            row = {}
+        self.alpha2 = row.get("alpha-2")
+        self.alpha3 = row.get("alpha-3")
+        self.groups = {column: row[column] for column in GROUP_COLUMNS if row.get(column)}
+        self.aggregate = groups().get(region[0]) if len(region) == 1 else None
+        if len(region) > 1:
+            self.parents = [region[:-1]]
+        else:
+            self.parents = [(group,) for group in self.groups.values()]
+
+
+def info(region):
+    """ the RegionInfo of region, shared by every caller """
+    region_info = _INFOS.get(region)
+    if region_info is None:
+        region_info = _INFOS[region] = RegionInfo(region)
+    return region_info
+
+
+def reset():
+    """ forgets every RegionInfo, after COUNTRIES changed """
+    global _GROUPS
+    _GROUPS = None
+    _INFOS.clear()
+
+
+class RegionTable(object):
+    """ the RegionInfo of every region id of a store
+
+    regions is the store's own list, which only ever grows, so the table catches up with it
+    when read.
+    """
+    def __init__(self, regions):
+        self.regions = regions
+        self.infos = []
+        self._columns = {}
+
+    def _update(self):
+        if len(self.infos) < len(self.regions):
+            self.infos.extend(info(region) for region in self.regions[len(self.infos):])
+            self._columns = {}
+
+    def __getitem__(self, rid):
+        self._update()
+        return self.infos[rid]
+
+    def __len__(self):
+        return len(self.regions)
+
+    def column(self, name):
+        """ the attribute name of every region id as an array """
+        self._update()
+        values = self._columns.get(name)
+        if values is None:
+            values = self._columns[name] = np.array([getattr(region_info, name)
+                                                     for region_info in self.infos])
+        return values
+
+
+def main():
+    from timeseries import TimeSeriesStore
+    # the store fills the registry module, not this script's copy of it
+    import registry
+    store = TimeSeriesStore()
+    texas = rn.normalize("US", "Texas")
+    ids = [store.region_id(region) for region in [texas, ("France",), ("Europe",)]]
+    table = store.region_table
+    before = table.column("level")
+    store.region_id(("Cruise Ship",))
+    print(all([
+        table[ids[0]].us_state and not table[ids[1]].us_state,
+        table[ids[0]].alpha3 == "USA",
+        table[ids[0]].parents == [texas[:1]],
+        table[ids[1]].groups == {"sub-region": "Western Europe", "region": "Europe"},
+        table[ids[1]].parents == [("Western Europe",), ("Europe",)],
+        table[ids[2]].aggregate == "region",
+        table[ids[2]].parents == [] and table[ids[2]].alpha2 is None,
+        before.tolist() == [2, 1, 1],
+        table.column("level").tolist() == [2, 1, 1, 1],
+        registry.info(texas) is table[ids[0]],
+    ]))
+
+
+if __name__ == '__main__':
+    main()
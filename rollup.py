@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+""" Roll-up of regions into aggregate regions
+
+Additive types (total_*, new_*) of a source are summed up a hierarchy, lowest level first:
+
+    subdivision  ->  country         (country, subdivision, micro) -> (country, subdivision)
+                                     (country, subdivision)        -> (country,)
+    country      ->  ISO groups      intermediate-region, sub-region and region columns of
+                                     countries.csv, for example ("Western Europe",), ("Europe",)
+
+A subdivision is added to the row of its country, also when the source has a row of its own for
+the country; this is how US states have always been added into the USA.  Groups are sums of the
+country rows only (after their subdivisions were added), so a sub-region does not depend on
+which of its countries have an intermediate-region.  Rows that are not countries of countries.csv,
+like World or Cruise Ship, are left out of every group.
+
+Rates and smoothed rates are not summed, the parsers compute them on the aggregate rows after
+the roll-up like on any other row.
+"""
+
+import derived
+import numpy as np
+import registry
+
+GROUP_COLUMNS = registry.GROUP_COLUMNS
+groups = registry.groups
+
+
+def group_level(region):
+    """ the countries.csv column region is an aggregate of, None for other regions """
+    return registry.info(region).aggregate
+
+
+def country_groups(name):
+    """ (column, group) pairs a canonical country name belongs to """
+    return list(registry.info((name,)).groups.items())
+
+
+def parents(region):
+    """ the aggregate regions region is summed into directly """
+    return registry.info(region).parents
+
+
+def aggregates(regions):
+    """ every aggregate region some region of regions is summed into, directly or not """
+    found = set()
+    todo = list(regions)
+    while todo:
+        for parent in parents(todo.pop()):
+            if parent not in found:
+                found.add(parent)
+                todo.append(parent)
+    return found
+
+
+class RollupStep(object):
+    """ one level of the roll-up, every row is summed into one target """
+    def __init__(self, out_map, parents):
+        """ parents maps a target region to the ids of the rows summed into it """
+        self.targets = np.array([out_map.region_id(target) for target in parents], dtype=np.intp)
+        self.rows = np.array([rid for rids in parents.values() for rid in rids], dtype=np.intp)
+        sizes = [len(rids) for rids in parents.values()]
+        self.starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.intp)
+
+
+class RollupPlan(object):
+    """ the roll-up steps for the regions one source has data for
+
+    Building the plan adds the aggregate regions to the store, so arrays fetched before are
+    stale afterwards.  The regions with data in source name of the store raw, if given, are
+    members as well.
+    """
+    def __init__(self, out_map, name, raw=None):
+        regions = {out_map.regions[rid]: rid for rid in out_map.source_region_ids(name)}
+        self.raw_rows = np.zeros(0, dtype=np.intp)
+        if raw is not None:
+            raw_rows = [out_map.region_id(raw.regions[rid]) for rid in raw.source_region_ids(name)]
+            for rid in raw_rows:
+                regions.setdefault(out_map.regions[rid], rid)
+            self.raw_rows = np.array(raw_rows, dtype=np.intp)
+        self.steps = []
+        for depth in (3, 2):
+            parents = {}
+            for region, rid in regions.items():
+                if len(region) == depth:
+                    parents.setdefault(region[:-1], []).append(rid)
+            if parents:
+                self.steps.append(RollupStep(out_map, parents))
+                for parent in parents:
+                    regions.setdefault(parent, out_map.region_id(parent))
+        for column in GROUP_COLUMNS:
+            parents = {}
+            for region, rid in regions.items():
+                if len(region) == 1:
+                    group = registry.info(region).groups.get(column)
+                    if group:
+                        parents.setdefault((group,), []).append(rid)
+            if parents:
+                self.steps.append(RollupStep(out_map, parents))
+
+    def apply(self, values, since=None):
+        """ adds every step into values, a [region_id, day_offset] array of the store """
+        for step in self.steps:
+            derived.add_groups(values, step.rows, step.targets, step.starts, since)
+
+    def widen(self, since):
+        """ moves the since of each target back to the earliest since of its members
+
+        A target with raw values of its own is recomputed from the start: the days before since
+        hold its own values plus its members', which its own new_* cannot continue from.
+        """
+        for step in self.steps:
+            since[np.intersect1d(step.targets, self.raw_rows)] = 0
+            member_since = np.minimum.reduceat(since[step.rows], step.starts)
+            since[step.targets] = np.minimum(since[step.targets], member_since)
+        return since
+
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+""" Declared layouts of the source files and the chunked ingest they share
+
+A source file is described once by a schema instead of a hand-written loop:
+
+    LongSchema("owid", region=["location"], date="date", date_format="%Y-%m-%d",
+               values={"new_cases": "new_cases", "total_cases": "total_cases"})
+        one row per region and day, with one column per type
+
+    WideSchema("csse", region=["Country/Region", "Province/State"], date_format="%m/%d/%y",
+               datatype="total_cases")
+        one row per region, with one column per day for a single type
+
+region lists the columns passed to region_normalize.normalize, after the constant country if
+one is given.  schema.ingest(rows, out_map) takes csv.reader rows, header first.  Rows are
+taken about CHUNK_CELLS cells at a time and only the declared columns are pulled out, each
+straight into a float array; the values of a chunk then go into the store in one assignment
+per type.  Dates are parsed once per distinct string and regions normalized once per distinct
+key.
+
+read() yields the cells of each chunk as (datatype, region ids, day ordinals, values) arrays,
+which ingest() writes into the store and streaming.py spills to disk.  Empty cells are missing
+values.  A type array is created, and a region interned, at the first row that has a value for
+it, so the store comes out laid out as with one set_value() per cell.
+"""
+
+import datetime as dt
+import itertools
+import numpy as np
+import re
+import region_normalize as rn
+
+# cells held as strings at a time, a chunk is as many rows as that takes
+CHUNK_CELLS = 1 << 14
+
+
+class DateCache(object):
+    """ date string -> ordinal, parsing every distinct string once """
+    def __init__(self, date_format):
+        self.date_format = date_format
+        self.ordinals = {}
+
+    def __call__(self, datestr):
+        ordinal = self.ordinals.get(datestr)
+        if ordinal is None:
+            ordinal = dt.datetime.strptime(datestr, self.date_format).toordinal()
+            self.ordinals[datestr] = ordinal
+        return ordinal
+
+
+class RegionCache(object):
+    """ tuple of region cells -> region id in out_map """
+    def __init__(self, country, out_map):
+        self.prefix = (country,) if country else ()
+        self.out_map = out_map
+        self.rids = {}
+
+    def __call__(self, cells):
+        rid = self.rids.get(cells)
+        if rid is None:
+            rid = self.rids[cells] = self.out_map.region_id(rn.normalize(*self.prefix, *cells))
+        return rid
+
+
+def floats(cells):
+    """ the cells of a column as float64, empty cells NaN """
+    return np.fromiter(map(float, [cell or "nan" for cell in cells]), float, len(cells))
+
+
+def padded(rows, width):
+    """ rows with short rows filled up with empty cells to width """
+    if min(map(len, rows)) >= width:
+        return rows
+    return [row if len(row) >= width else row + [""] * (width - len(row)) for row in rows]
+
+
+def add_cells(out_map, source, datatype, rids, ordinals, values):
+    """ writes cells from read() into out_map, whose days they are already interned in """
+    target = out_map.array(source, datatype)
+    target[rids, ordinals - out_map.origin] = values
+
+
+def chunks(rows, width):
+    size = max(1, CHUNK_CELLS // width)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class LongSchema(object):
+    """ one row per region and day, one value column per type """
+    def __init__(self, source, region, date, date_format, values, country=None):
+        self.source = source
+        self.region = region
+        self.date = date
+        self.date_format = date_format
+        # datatype -> column, in the order the types are created
+        self.values = values
+        self.country = country
+
+    @property
+    def datatypes(self):
+        return list(self.values)
+
+    def read(self, rows, out_map):
+        """ yields (datatype, region ids, day ordinals, values) for the present cells of each
+            chunk, interning their regions and days in out_map
+        """
+        rows = iter(rows)
+        header = next(rows, None)
+        if header is None:
+            return
+        index = {name: column for column, name in enumerate(header)}
+        region_columns = [index[name] for name in self.region]
+        # types whose column the file does not have are left out
+        datatypes = [datatype for datatype, name in self.values.items() if name in index]
+        value_columns = [index[self.values[datatype]] for datatype in datatypes]
+        width = max(region_columns + value_columns + [index[self.date]]) + 1
+        regions = RegionCache(self.country, out_map)
+        dates = DateCache(self.date_format)
+        for chunk in chunks(rows, len(header)):
+            chunk = padded(chunk, width)
+            values = np.array([floats([row[column] for row in chunk])
+                               for column in value_columns]).reshape(len(value_columns), -1)
+            present = ~np.isnan(values)
+            used = np.flatnonzero(present.any(axis=0))
+            if not len(used):
+                continue
+            rids = np.array([regions(tuple(chunk[row][column] for column in region_columns))
+                             for row in used.tolist()], dtype=np.intp)
+            ordinals = np.array([dates(chunk[row][index[self.date]]) for row in used.tolist()])
+            for ordinal in np.unique(ordinals).tolist():
+                out_map.ordinal_offset(ordinal)
+            values, present = values[:, used], present[:, used]
+            # types in the order a cell by cell ingest would meet them
+            for k in sorted(np.flatnonzero(present.any(axis=1)).tolist(),
+                            key=lambda k: (int(present[k].argmax()), k)):
+                yield datatypes[k], rids[present[k]], ordinals[present[k]], values[k][present[k]]
+
+    def ingest(self, rows, out_map):
+        for cells in self.read(rows, out_map):
+            add_cells(out_map, self.source, *cells)
+
+
+class WideSchema(object):
+    """ one row per region, one column per day of a single type
+
+    Day columns are the header cells matching date_pattern, each parsed and mapped to its day
+    offset once per file.  Every row's region is interned, even without values.
+    """
+    def __init__(self, source, region, date_format, datatype, date_pattern=r"\d\d?/\d\d?/\d\d"):
+        self.source = source
+        self.region = region
+        self.date_format = date_format
+        self.datatype = datatype
+        self.date_pattern = re.compile(date_pattern)
+
+    @property
+    def datatypes(self):
+        return [self.datatype]
+
+    def read(self, rows, out_map):
+        """ yields (datatype, region ids, day ordinals, values) for the present cells of each
+            chunk, interning their regions and every day of the header in out_map
+        """
+        rows = iter(rows)
+        header = next(rows, None)
+        if header is None:
+            return
+        region_columns = [header.index(name) for name in self.region]
+        columns = [column for column, cell in enumerate(header) if self.date_pattern.match(cell)]
+        if not columns:
+            return
+        dates = DateCache(self.date_format)
+        ordinals = np.array([dates(header[column]) for column in columns])
+        for ordinal in ordinals.tolist():
+            out_map.ordinal_offset(ordinal)
+        span = None
+        if columns[-1] - columns[0] + 1 == len(columns):
+            span = slice(columns[0], columns[-1] + 1)
+        # no cells, the type exists once the header is read even if no row has a value
+        yield self.datatype, np.zeros(0, np.intp), np.zeros(0, np.intp), np.zeros(0)
+        regions = RegionCache(None, out_map)
+        for chunk in chunks(rows, len(header)):
+            chunk = padded(chunk, len(header))
+            rids = np.array([regions(tuple(row[column] for column in region_columns))
+                             for row in chunk], dtype=np.intp)
+            values = np.empty((len(chunk), len(columns)))
+            for row, cells in enumerate(chunk):
+                cells = cells[span] if span else [cells[column] for column in columns]
+                if "" in cells:
+                    cells = [cell or "nan" for cell in cells]
+                values[row] = list(map(float, cells))
+            rows_present, days_present = np.nonzero(~np.isnan(values))
+            yield (self.datatype, rids[rows_present], ordinals[days_present],
+                   values[rows_present, days_present])
+
+    def ingest(self, rows, out_map):
+        for cells in self.read(rows, out_map):
+            add_cells(out_map, self.source, *cells)
+
+
+def main():
+    from timeseries import TimeSeriesStore
+    import csv
+    import io
+    store = TimeSeriesStore()
+    long_rows = csv.reader(io.StringIO(
+        "date,location,new_cases,total_cases\n"
+        "2020-03-02,France,,5\n"
+        "2020-03-01,Germany,0,\n"
+        "2020-03-03,\"Korea, South\",1,6\n"
+        "2020-03-04,Japan\n"
+        "2020-02-28,France,2,3\n"))
+    LongSchema("owid", ["location"], "date", "%Y-%m-%d",
+               {"new_cases": "new_cases", "total_cases": "total_cases",
+                "new_deaths": "new_deaths"}).ingest(long_rows, store)
+    wide_rows = csv.reader(io.StringIO(
+        "Province/State,Country/Region,Lat,Long,2/29/20,3/1/20\n"
+        ",Italy,0,0,1,\n"
+        ",Spain,0,0\n"))
+    WideSchema("csse", ["Country/Region", "Province/State"], "%m/%d/%y",
+               "total_cases").ingest(wide_rows, store)
+    france, germany = store.find_region(("France",)), store.find_region(("Germany",))
+    print(all([
+        store.regions[:3] == [("France",), ("Germany",), ("Korea, Republic of",)],
+        store.find_region(("Japan",)) is None,
+        store.find_region(("Spain",)) is not None,
+        store.types("owid") == ["total_cases", "new_cases"],
+        store.date_of(0) == dt.date(2020, 2, 28),
+        store["owid"][("France",)]["total_cases"] == {dt.date(2020, 2, 28): 3.0,
+                                                      dt.date(2020, 3, 2): 5.0},
+        store.array("owid", "new_cases")[germany].tolist().count(0.0) == 1,
+        store.array("owid", "new_cases")[france, 0] == 2,
+        store["csse"][("Italy",)]["total_cases"] == {dt.date(2020, 2, 29): 1.0},
+    ]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+""" Serves the parsed data over HTTP, keeping it in memory between requests
+
+    python serve-data.py -d data_dir [--port 8000 | --unix /tmp/covid.sock]
+
+The data files are parsed once at startup (through the snapshots, see parse-data.py) and
+checked every --interval seconds.  When get-covid-data.py has replaced one, the sources are
+loaded again in a background thread and the new dataset is swapped in with a single
+assignment, so requests never wait for a refresh and always see one consistent dataset.
+
+Every answer is json:
+
+    GET  /health                    load time, last refresh error, last day
+    GET  /sources                   first and last day of every source
+    GET  /regions?<filters>         regions matching dataset.Dataset.regions filters
+    GET  /query?source=&type=       one type of one source for the regions given by
+             [&r=country:sub...]    r (repeated, parts joined by ':') or by the region filters,
+             [&<filters>]           from start to end (YYYY-MM-DD) or over the last days days
+             [&start=&end=|&days=]
+    POST /refresh                   check the files now instead of at the next interval
+"""
+
+import argparse
+import datetime as dt
+import http.server
+import json
+import metrics
+import os
+import pipeline
+import rawfile
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+
+from dataset import Dataset
+
+if sys.version_info[0] < 3:
+    raise Exception("Must be using Python 3")
+
+REGION_FILTERS = {"country": str, "level": int, "us_state": bool, "region": str,
+                  "sub_region": str, "intermediate_region": str, "aggregate": str}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--datadir', default='.', type=str, nargs='?')
+    parser.add_argument('--cache_dir', default=None, type=str, nargs='?',
+                        help="where parsed snapshots are kept, default datadir/.parse-cache")
+    parser.add_argument('-j', '--jobs', default='1', type=int, nargs='?',
+                        help="number of processes parsing sources in parallel")
+    parser.add_argument('--host', default='127.0.0.1', type=str, nargs='?')
+    parser.add_argument('--port', default='8000', type=int, nargs='?')
+    parser.add_argument('--unix', default=None, type=str, nargs='?',
+                        help="listen on this unix socket instead of host and port")
+    parser.add_argument('--interval', default='60', type=float, nargs='?',
+                        help="seconds between checks of the data files")
+    parser.add_argument('--metrics', default=None, type=str, nargs='?',
+                        help="add these metrics of metrics.py, comma separated or all")
+    args = parser.parse_args()
+    try:
+        args.metrics = metrics.select(args.metrics) if args.metrics else []
+    except ValueError as err:
+        parser.error(str(err))
+    return args
+
+
+class State(object):
+    """ one loaded dataset, never changed once published """
+    def __init__(self, dataset, fingerprints, loaded):
+        self.dataset = dataset
+        self.fingerprints = fingerprints
+        self.loaded = loaded
+
+
+def file_fingerprints(args):
+    fingerprints = {}
+    for source in pipeline.SOURCES:
+        try:
+            stat = os.stat(pipeline.source_path(args, source))
+            fingerprints[source.filename] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            fingerprints[source.filename] = None
+    if args.metrics:
+        path = rawfile.stored_path(args.datadir, metrics.POPULATIONS_FILE)
+        fingerprints[metrics.POPULATIONS_FILE] = os.path.isfile(path) and os.stat(path).st_mtime_ns
+    return fingerprints
+
+
+class DataService(object):
+    def __init__(self, args):
+        self.args = args
+        self.options = pipeline.options(args.datadir, cache_dir=args.cache_dir, jobs=args.jobs)
+        self.state = None
+        self.error = None
+        self.wakeup = threading.Event()
+
+    def load(self):
+        """ loads the sources if the files changed since the current state, then publishes """
+        fingerprints = file_fingerprints(self.args)
+        if self.state is not None and fingerprints == self.state.fingerprints:
+            return False
+        master_map = pipeline.load_sources(self.options, pipeline.SOURCES)
+        pipeline.save_aliases(self.options)
+        metrics.compute(master_map, self.args.metrics, metrics.read_populations(self.args.datadir))
+        self.state = State(Dataset(master_map), fingerprints, dt.datetime.now())
+        return True
+
+    def refresh(self):
+        try:
+            if self.load():
+                print(f"loaded {self.args.datadir} at {self.state.loaded:%H:%M:%S}")
+            self.error = None
+        except Exception:
+            # keep serving the last good state
+            self.error = traceback.format_exc()
+            print(self.error, file=sys.stderr)
+
+    def refresh_forever(self):
+        while True:
+            self.wakeup.wait(self.args.interval)
+            self.wakeup.clear()
+            self.refresh()
+
+    def start(self):
+        self.refresh()
+        threading.Thread(target=self.refresh_forever, name="refresh", daemon=True).start()
+
+
+def region_filters(params):
+    filters = {}
+    for key, convert in REGION_FILTERS.items():
+        if key in params:
+            value = params[key][-1]
+            filters[key] = value.lower() in ("1", "true", "yes") if convert is bool else \
+                convert(value)
+    return filters
+
+
+def parse_date(value):
+    return dt.date.fromisoformat(value) if value else None
+
+
+def required(params, name):
+    if name not in params:
+        raise ValueError(f"missing parameter {name}")
+    return params[name][-1]
+
+
+def json_value(value):
+    return None if value != value else value
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        routes = {"/health": self.health, "/sources": self.sources, "/regions": self.regions,
+                  "/query": self.query}
+        if url.path not in routes:
+            self.send_json(404, {"error": f"no such path {url.path}"})
+            return
+        state = self.service.state
+        if state is None:
+            self.send_json(503, {"error": "not loaded yet"})
+            return
+        try:
+            self.send_json(200, routes[url.path](state, params))
+        except (KeyError, ValueError) as err:
+            self.send_json(400, {"error": f"bad request: {err}"})
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path != "/refresh":
+            self.send_json(404, {"error": f"no such path {self.path}"})
+            return
+        self.service.wakeup.set()
+        self.send_json(202, {"refresh": "scheduled"})
+
+    def health(self, state, params):
+        max_date = state.dataset.max_date()
+        return {"loaded": state.loaded.isoformat(timespec="seconds"),
+                "max_date": max_date.isoformat() if max_date else None,
+                "error": self.service.error}
+
+    def sources(self, state, params):
+        ranges = {}
+        for source in state.dataset.sources():
+            days = state.dataset.date_range(source)
+            ranges[source] = [day.isoformat() for day in days] if days else None
+        return ranges
+
+    def regions(self, state, params):
+        return [list(region) for region in state.dataset.regions(**region_filters(params))]
+
+    def query(self, state, params):
+        dataset = state.dataset
+        if "r" in params:
+            regions = [tuple(value.split(":")) for value in params["r"]]
+        else:
+            regions = dataset.regions(**region_filters(params))
+        start, end = parse_date(params.get("start", [""])[-1]), \
+            parse_date(params.get("end", [""])[-1])
+        if "days" in params and dataset.max_date():
+            start, end = dataset.last_days(int(params["days"][-1]), end)
+        selection = dataset.query(required(params, "source"), required(params, "type"), regions,
+                                  start, end)
+        return {
+            "dates": [date.isoformat() for date in selection.dates],
+            "series": [{"region": list(region), "values": [json_value(v) for v in row.tolist()]}
+                       for region, row in zip(selection.regions, selection.values)],
+        }
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"{time.strftime('%H:%M:%S')} {self.address_string()} "
+                         f"{format % args}\n")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+def make_server(args, service):
+    handler = type("BoundHandler", (Handler,), {"service": service})
+    if args.unix:
+        return UnixHTTPServer(args.unix, handler)
+    return http.server.ThreadingHTTPServer((args.host, args.port), handler)
+
+
+def main():
+    args = get_args()
+    service = DataService(args)
+    service.start()
+    server = make_server(args, service)
+    where = args.unix or f"http://{args.host}:{server.server_address[1]}"
+    print(f"serving {args.datadir} on {where}")
+    # exit through the finally below on kill too, so the unix socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix and os.path.exists(args.unix):
+            os.unlink(args.unix)
+
+
+if __name__ == '__main__':
+    main()
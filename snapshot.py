@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+""" Binary snapshots of parsed sources
+
+parse-data.py parses each input file into its own TimeSeriesStore and merges them.  A snapshot
+keeps one parsed store on disk as a directory of .npy arrays plus a manifest.json:
+
+    <cache_dir>/<input filename>/
+        manifest.json   - input fingerprint, code fingerprint, regions, origin, array lists
+        store-<n>.npy   - one [region_id, day_offset] array per (source, type), fully derived
+        raw-<n>.npy     - the raw values the parser ingested, before anything was derived
+
+save_snapshot computes the lazy types (see timeseries.py) of the store before writing it, so
+a loaded store does not compute them again and an update recomputes them only from the first
+changed day.  save_store keeps a lazy type as its derivation in the manifest, without an array.
+
+A snapshot is fresh while the input file and the parsing code are unchanged.  The input is
+fingerprinted by size, mtime and sha1; the hash is only recomputed when size or mtime moved, so
+a file the downloader merely touched (304 Not Modified) still hits.  Arrays are loaded
+memory-mapped, so loading costs little more than reading the manifest.  The code is the files
+in CODE_FILES; main() checks that every module the parsing code imports is listed there.
+
+A stale snapshot of the same code is still returned, its raw arrays are what an incremental
+update compares a new ingest against (see parsers.Parser.update).
+"""
+
+import ast
+import datetime as dt
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+from timeseries import Derivation, TimeSeriesStore
+
+SNAPSHOT_VERSION = 3
+HASH_CHUNK_SIZE = 1 << 20
+# the aliases.csv region_normalize learns into is left out: a name it holds is matched to the
+# same country without it, and it grows while the snapshots of a run are being written
+CODE_FILES = ["parsers.py", "derived.py", "region_normalize.py", "region_match.py", "rollup.py",
+              "registry.py", "schema.py", "timeseries.py", "countries.csv"]
+# modules the parsing code imports that do not change what a parse produces
+NOT_CODE_FILES = ["instrument.py"]
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+
+def file_hash(filepath):
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(filepath, sha1=None):
+    stat = os.stat(filepath)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "sha1": sha1 or file_hash(filepath)}
+
+
+def code_fingerprint():
+    """ hash of the code and tables that decide what a parse produces """
+    digest = hashlib.sha1(str(SNAPSHOT_VERSION).encode())
+    for filename in CODE_FILES:
+        filepath = os.path.join(__location__, filename)
+        if os.path.exists(filepath):
+            digest.update(file_hash(filepath).encode())
+    return digest.hexdigest()
+
+
+def snapshot_dir(cache_dir, filename):
+    return os.path.join(cache_dir, filename)
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, "manifest.json")) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(directory, manifest):
+    fd, tmppath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmppath, os.path.join(directory, "manifest.json"))
+
+
+def input_unchanged(directory, manifest, filepath):
+    """ compares filepath with the fingerprint in manifest, hashing only if size or mtime moved """
+    previous = manifest["input"]
+    stat = os.stat(filepath)
+    if stat.st_size != previous["size"]:
+        return False
+    if stat.st_mtime_ns == previous["mtime_ns"]:
+        return True
+    if file_hash(filepath) != previous["sha1"]:
+        return False
+    manifest["input"] = file_fingerprint(filepath, previous["sha1"])
+    write_manifest(directory, manifest)
+    return True
+
+
+class Snapshot(object):
+    def __init__(self, store, raw, fresh):
+        self.store = store
+        self.raw = raw
+        self.fresh = fresh
+
+
+def load_store(directory, manifest, prefix):
+    arrays = {}
+    for index, (source, datatype, *lazy) in enumerate(manifest["arrays"]):
+        if lazy:
+            arrays[(source, datatype)] = Derivation(lazy[0]["function"], lazy[0]["inputs"])
+            continue
+        arrays[(source, datatype)] = np.load(os.path.join(directory, f"{prefix}-{index}.npy"),
+                                             mmap_mode='r')
+    regions = [tuple(region) for region in manifest["regions"]]
+    origin = dt.date.fromisoformat(manifest["origin"]) if manifest["origin"] else None
+    return TimeSeriesStore.from_arrays(regions, origin, arrays)
+
+
+def save_store(directory, store, prefix):
+    arrays = []
+    for index, (source, datatype, values) in enumerate(store.layout()):
+        if isinstance(values, Derivation):
+            arrays.append([source, datatype,
+                           {"function": values.function, "inputs": values.inputs}])
+            continue
+        np.save(os.path.join(directory, f"{prefix}-{index}.npy"), values)
+        arrays.append([source, datatype])
+    return {
+        "regions": store.regions,
+        "origin": store.date_of(0).isoformat() if store.origin is not None else None,
+        "arrays": arrays,
+    }
+
+
+def load_snapshot(cache_dir, filepath, code=None, name=None):
+    """ returns the stored parse of filepath, or None when there is no snapshot for this code
+
+    Snapshots are kept under name, by default the file name of filepath.
+    """
+    directory = snapshot_dir(cache_dir, name or os.path.basename(filepath))
+    manifest = read_manifest(directory)
+    if not manifest or manifest.get("version") != SNAPSHOT_VERSION:
+        return None
+    if manifest["code"] != (code or code_fingerprint()):
+        return None
+    fresh = input_unchanged(directory, manifest, filepath)
+    return Snapshot(load_store(directory, manifest["store"], "store"),
+                    load_store(directory, manifest["raw"], "raw"), fresh)
+
+
+def save_snapshot(cache_dir, filepath, store, raw, fingerprint, code=None, name=None):
+    """ writes store and the raw ingest it was derived from as the snapshot of filepath,
+        replacing any older one
+
+    fingerprint is file_fingerprint(filepath) taken before the file was parsed, so a file
+    replaced during the parse does not get a snapshot that claims to match it.
+    """
+    directory = snapshot_dir(cache_dir, name or os.path.basename(filepath))
+    store.materialize()
+    os.makedirs(cache_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=cache_dir, prefix=".staging-")
+    try:
+        write_manifest(staging, {
+            "version": SNAPSHOT_VERSION,
+            "code": code or code_fingerprint(),
+            "input": fingerprint,
+            "store": save_store(staging, store, "store"),
+            "raw": save_store(staging, raw, "raw"),
+        })
+        if os.path.isdir(directory):
+            retired = tempfile.mkdtemp(dir=cache_dir, prefix=".retired-")
+            os.replace(directory, os.path.join(retired, "snapshot"))
+            shutil.rmtree(retired)
+        os.replace(staging, directory)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def local_imports(filename):
+    """ the files of this directory that filename imports, directly or through each other """
+    found, todo = set(), [filename]
+    while todo:
+        with open(os.path.join(__location__, todo.pop())) as infile:
+            tree = ast.parse(infile.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = name.split(".")[0] + ".py"
+                if module not in found and os.path.exists(os.path.join(__location__, module)):
+                    found.add(module)
+                    todo.append(module)
+    return found
+
+
+def main():
+    parsing = set().union(*(local_imports(filename)
+                            for filename in ("parsers.py", "rollup.py", "timeseries.py")))
+    missing = parsing - set(CODE_FILES) - set(NOT_CODE_FILES)
+    if missing:
+        print(f"not in CODE_FILES: {sorted(missing)}")
+    print(all([
+        not missing,
+        {"schema.py", "registry.py", "region_match.py"} <= parsing,
+    ]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+""" Memory-bounded parsing, a chunk of regions at a time
+
+pipeline.load_sources() holds every source in one master map before anything is written, which
+does not fit in memory for county level files or long archives.  parse-data.py --stream takes
+each source file in two steps instead, reading it only once:
+
+    spill   the schema of the file (see schema.py) reads it and its cells are kept by bucket
+            of SPILL_REGIONS regions, in memory until they pass a quarter of the memory
+            ceiling and appended to one file per bucket in a scratch directory from then on.
+            Only the regions and days are interned.
+    chunks  as many buckets as the memory ceiling allows are loaded into a store of their own,
+            which goes through the parser's prepare and finish steps (see parsers.Parser) and
+            the metrics, is written out and dropped.
+
+Aggregate rows (see rollup.py) need every chunk.  The regions others are summed into are kept
+aside with their own raw values, each chunk adds its rows into partial sums of them, and once
+the chunks are done they are prepared, get the partial sums, are rolled up among themselves,
+finished and written last.  There are as many as the hierarchy has, not as the file has regions.
+
+Peak memory is then one chunk, the aggregates and the interned regions, whatever the number of
+regions.  The table holds the rows of the full parse, ordered by file, chunk and region instead
+of by source and region.  --reconcile compares every region at once and is not available.
+"""
+
+import datetime as dt
+import derived
+import instrument
+import metrics
+import numpy as np
+import os
+import parsers
+import pipeline
+import rollup
+import tempfile
+import writer
+from timeseries import TimeSeriesStore
+
+MEMORY_MB = 256
+SPILL_REGIONS = 64
+RECORD = np.dtype([("rid", np.int32), ("ordinal", np.int32), ("type", np.int8),
+                   ("value", np.float64)])
+# bytes of a chunk per array value: the store's capacity doubling and the temporaries of the
+# derived engine and the writer can take as much again, twice
+CHUNK_OVERHEAD = 4 * 8
+
+
+class Spill(object):
+    """ records by bucket of regions, buffered up to limit bytes and in files beyond """
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self.limit = limit
+        self.buffers = {}
+        self.nbytes = 0
+        self.spilled = set()
+
+    def path(self, bucket):
+        return os.path.join(self.directory, f"bucket-{bucket}.bin")
+
+    def add(self, records):
+        buckets = records["rid"] // SPILL_REGIONS
+        order = np.argsort(buckets, kind="stable")
+        records, buckets = records[order], buckets[order]
+        for part in np.split(records, np.flatnonzero(np.diff(buckets)) + 1):
+            self.buffers.setdefault(int(part["rid"][0]) // SPILL_REGIONS, []).append(part)
+        self.nbytes += records.nbytes
+        if self.nbytes > self.limit:
+            self.flush()
+
+    def flush(self):
+        for bucket, parts in self.buffers.items():
+            with open(self.path(bucket), 'ab') as spill_file:
+                for part in parts:
+                    part.tofile(spill_file)
+            self.spilled.add(bucket)
+        self.buffers, self.nbytes = {}, 0
+
+    def buckets(self):
+        return sorted(self.spilled | set(self.buffers))
+
+    def load(self, bucket):
+        """ the records of bucket in the order they were added, once """
+        parts = []
+        if bucket in self.spilled:
+            parts.append(np.fromfile(self.path(bucket), dtype=RECORD))
+            os.unlink(self.path(bucket))
+        parts += self.buffers.pop(bucket, [])
+        return np.concatenate(parts)
+
+
+class SpilledFile(object):
+    """ a source file read into a Spill, with the regions and days it interned """
+    def __init__(self, source, directory, limit):
+        self.source = source
+        self.parser = source.parser
+        # regions and days only, no arrays
+        self.skeleton = TimeSeriesStore()
+        self.datatypes = []
+        self.present = set()
+        self.last = None
+        self.spill = Spill(directory, limit)
+
+    def read(self, args):
+        with instrument.stage(f"spill:{self.source.filename}") as stage, \
+                pipeline.read_csv(args, self.source) as rows:
+            for datatype, rids, ordinals, values in self.parser.schema.read(stage.count(rows),
+                                                                            self.skeleton):
+                if datatype not in self.datatypes:
+                    self.datatypes.append(datatype)
+                if not len(rids):
+                    continue
+                records = np.empty(len(rids), dtype=RECORD)
+                records["rid"], records["ordinal"], records["value"] = rids, ordinals, values
+                records["type"] = self.datatypes.index(datatype)
+                self.spill.add(records)
+                self.present.update(np.unique(rids).tolist())
+                last = int(ordinals.max())
+                self.last = last if self.last is None else max(self.last, last)
+
+    def store(self, days, datatypes=None):
+        """ an empty store over days with the types of the file created in order """
+        store = TimeSeriesStore()
+        store.ordinal_offset(days[0])
+        store.ordinal_offset(days[1])
+        for datatype in datatypes or self.datatypes:
+            store.array(self.parser.name, datatype)
+        return store
+
+    def load(self, store, records):
+        """ writes records into store, interning their regions in the order of the file """
+        rids, inverse = np.unique(records["rid"], return_inverse=True)
+        rids = np.array([store.region_id(self.skeleton.regions[rid]) for rid in rids.tolist()],
+                        dtype=np.intp)[inverse]
+        offsets = records["ordinal"] - store.origin
+        for index, datatype in enumerate(self.datatypes):
+            cells = records["type"] == index
+            store.array(self.parser.name, datatype)[rids[cells], offsets[cells]] = \
+                records["value"][cells]
+
+
+def add_into(target, source, name, datatypes, members):
+    """ adds rows of source into rows of target where any of them has a value, members maps a
+        region of target to the row ids of source added into it
+    """
+    if not members:
+        return
+    targets = np.array([target.region_id(region) for region in members], dtype=np.intp)
+    rows = np.array([rid for rids in members.values() for rid in rids], dtype=np.intp)
+    sizes = [len(rids) for rids in members.values()]
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.intp)
+    for datatype in datatypes:
+        values = target.array(name, datatype)
+        # the targets and then the rows in one block for derived.add_groups
+        block = np.concatenate([values[targets], source.array(name, datatype)[rows]])
+        derived.add_groups(block, np.arange(len(rows)) + len(targets), np.arange(len(targets)),
+                           starts)
+        values[targets] = block[:len(targets)]
+
+
+def stream_file(spilled, days, table, memory_mb, selected, populations, tracker=None):
+    """ derives and writes the rows of spilled a chunk of buckets at a time, the aggregate rows
+        last
+    """
+    parser, filename = spilled.parser, spilled.source.filename
+    regions = spilled.skeleton.regions
+    aggregate = rollup.aggregates(regions[rid] for rid in spilled.present)
+    is_aggregate = np.array([region in aggregate for region in regions], dtype=bool)
+    own = spilled.store(days)
+    partial = spilled.store(days, parser.additive)
+    buckets = spilled.spill.buckets()
+    # the first chunk is one bucket, the types it ends up with size the others
+    n_buckets = 1
+    while buckets:
+        chunk_ids, buckets = buckets[:n_buckets], buckets[n_buckets:]
+        with instrument.stage(f"stream:{filename}") as stage:
+            records = np.concatenate([spilled.spill.load(bucket) for bucket in chunk_ids])
+            held = is_aggregate[records["rid"]]
+            spilled.load(own, records[held])
+            chunk = spilled.store(days)
+            spilled.load(chunk, records[~held])
+            del records, held
+            if parser.prepare:
+                parser.prepare(chunk)
+            members = {}
+            for rid, region in enumerate(chunk.regions):
+                for parent in rollup.parents(region):
+                    members.setdefault(parent, []).append(rid)
+            add_into(partial, chunk, parser.name, parser.additive, members)
+            parser.finish(chunk)
+            if selected:
+                metrics.compute(chunk, selected, populations, [parser.name])
+            table.write(chunk)
+            if tracker:
+                tracker.add(chunk)
+            stage.points(chunk)
+        row_bytes = chunk.n_days * len(chunk.types(parser.name)) * CHUNK_OVERHEAD
+        n_buckets = max(1, (memory_mb << 20) // (row_bytes * SPILL_REGIONS))
+        del chunk
+    with instrument.stage(f"stream-aggregates:{filename}") as stage:
+        if parser.prepare:
+            parser.prepare(own)
+        add_into(own, partial, parser.name, parser.additive,
+                 {region: [rid] for rid, region in enumerate(partial.regions)})
+        parsers.add_aggregations(own, parser.name, parser.additive)
+        parser.finish(own)
+        if selected:
+            metrics.compute(own, selected, populations, [parser.name])
+        table.write(own)
+        if tracker:
+            tracker.add(own)
+        stage.points(own)
+
+
+def stream_sources(args, sources, path=None, fmt="text", memory_mb=MEMORY_MB, spill_dir=None,
+                   selected=None, populations=None, tracker=None):
+    """ parses sources and writes them to path (default stdout) in format fmt like
+        parse-data.py does, holding about memory_mb of them in memory at a time
+
+    Every chunk written is also given to tracker, a changes.ChangeTracker, if there is one.
+    """
+    with tempfile.TemporaryDirectory(prefix="parse-data-", dir=spill_dir) as scratch:
+        files = []
+        for index, source in enumerate(sources):
+            directory = os.path.join(scratch, str(index))
+            os.mkdir(directory)
+            spilled = SpilledFile(source, directory, (memory_mb << 20) // 4)
+            spilled.read(args)
+            if spilled.skeleton.origin is not None:
+                files.append(spilled)
+        max_date = dt.date.today() - dt.timedelta(1000)
+        last = [spilled.last for spilled in files if spilled.last is not None]
+        if last:
+            max_date = max(max_date, dt.date.fromordinal(max(last)))
+        three_weeks_ago = max_date - dt.timedelta(days=21)
+        skeletons = [spilled.skeleton for spilled in files]
+        days = None
+        if skeletons:
+            days = (min(skeleton.origin for skeleton in skeletons),
+                    max(skeleton.origin + skeleton.n_days - 1 for skeleton in skeletons))
+        with writer.open_output(path, fmt) as output:
+            table = writer.TableWriter(output, three_weeks_ago, fmt)
+            for spilled in files:
+                stream_file(spilled, days, table, memory_mb, selected, populations, tracker)
+            table.close()
+
+
+def main():
+    import csv
+    import io
+    import region_normalize as rn
+    import schema
+    spill = Spill(None, 1 << 20)
+    records = np.zeros(3, dtype=RECORD)
+    records["rid"], records["value"] = [SPILL_REGIONS, 1, SPILL_REGIONS + 1], [1, 2, 3]
+    spill.add(records)
+    target = TimeSeriesStore()
+    target.set_value("src", ("A",), "new_cases", dt.date(2020, 3, 1), 1)
+    target.day_offset(dt.date(2020, 3, 2))
+    rows = csv.reader(io.StringIO("location,date,new_cases\nA,2020-03-01,2\nA,2020-03-02,3\n"
+                                  "B,2020-03-02,4\n"))
+    source = TimeSeriesStore()
+    schema.LongSchema("src", ["location"], "date", "%Y-%m-%d",
+                      {"new_cases": "new_cases"}).ingest(rows, source)
+    texas = rn.normalize("US", "Texas")
+    add_into(target, source, "src", ["new_cases"], {("A",): [0, 1]})
+    print(all([
+        spill.buckets() == [0, 1],
+        spill.load(1)["value"].tolist() == [1, 3],
+        spill.buckets() == [0],
+        target.array("src", "new_cases")[0].tolist() == [3, 7],
+        rollup.parents(texas) == [texas[:1]],
+        rollup.aggregates([texas]) == {texas[:1], ("Northern America",), ("Americas",)},
+    ]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+
+""" Columnar time series store backing the master map
+
+Every (source, type) pair owns one dense float64 array indexed by [region_id, day_offset].
+Missing values are NaN.  Regions are interned to small integer ids and dates to day offsets
+from a movable origin, so a data point costs 8 bytes instead of a date object, a boxed float
+and a hash entry, and whole-table operations can work on the arrays directly.  ordinal_offset()
+takes a day as its proleptic ordinal, the integer the schemas parse dates to, so ingest never
+builds a date object.  region_table holds the attributes of every region id, such as its level,
+ISO codes and roll-up parents, worked out once per region (see registry.py).
+
+The store can still be read like the old nested dictionary
+
+    store[source][region][type][date] -> value
+
+through read-only mapping views.  Views only report regions and types that hold data.
+Arrays handed out by array() are views into storage that is reallocated as regions and days
+are added, so fetch them again after adding data.
+
+A type can also be declared lazy with derive_lazily(): it is computed by a Derivation from
+other types of the same source the first time it is read, its inputs first if they are lazy
+themselves.  array() computes every row, rows() only the rows asked for, and computed rows are
+kept.  Lazy types keep their place in types() and are listed by layout(), while arrays() only
+yields what has been computed; declare them once their inputs are final.
+"""
+
+from collections.abc import Mapping
+import datetime as dt
+import derived
+import instrument
+import numpy as np
+import registry
+import threading
+
+INITIAL_REGIONS = 64
+INITIAL_DAYS = 128
+
+
+class Derivation(object):
+    """ a lazy type: derived.<function>(*input arrays, out) over rows of the same source """
+    def __init__(self, function, inputs):
+        self.function = function
+        self.inputs = inputs
+
+    def compute(self, inputs, out):
+        getattr(derived, self.function)(*inputs, out)
+
+
+class TimeSeriesStore(Mapping):
+    def __init__(self):
+        self.regions = []
+        self.region_ids = {}
+        # the attributes of every region id, see registry.py
+        self.region_table = registry.RegionTable(self.regions)
+        self.origin = None
+        self.n_days = 0
+        self._region_capacity = INITIAL_REGIONS
+        self._day_capacity = INITIAL_DAYS
+        # a lazy type holds None here until its first row is computed
+        self._arrays = {}
+        # (source, datatype) -> [Derivation, rows computed so far] while not every row is
+        self._lazy = {}
+        self._lazy_lock = threading.RLock()
+
+    # region interning
+
+    def region_id(self, region):
+        rid = self.region_ids.get(region)
+        if rid is None:
+            rid = len(self.regions)
+            if rid >= self._region_capacity:
+                self._reallocate(self._region_capacity * 2, self._day_capacity, 0)
+            self.regions.append(region)
+            self.region_ids[region] = rid
+        return rid
+
+    def find_region(self, region):
+        return self.region_ids.get(region)
+
+    # date interning
+
+    def day_offset(self, date):
+        return self.ordinal_offset(date.toordinal())
+
+    def ordinal_offset(self, ordinal):
+        """ day_offset() for a date given as its proleptic ordinal, date.toordinal() """
+        if self.origin is None:
+            self.origin = ordinal
+            self.n_days = 1
+            return 0
+        offset = ordinal - self.origin
+        if offset < 0:
+            # grow to the left with some slack so walking backwards stays amortized
+            shift = max(-offset, self.n_days // 2)
+            capacity = self._day_capacity
+            while capacity < self.n_days + shift:
+                capacity *= 2
+            self._reallocate(self._region_capacity, capacity, shift)
+            self.origin -= shift
+            self.n_days += shift
+            offset += shift
+        elif offset >= self.n_days:
+            if offset >= self._day_capacity:
+                capacity = self._day_capacity
+                while capacity <= offset:
+                    capacity *= 2
+                self._reallocate(self._region_capacity, capacity, 0)
+            self.n_days = offset + 1
+        return offset
+
+    def find_day(self, date):
+        if self.origin is None:
+            return None
+        offset = date.toordinal() - self.origin
+        if offset < 0 or offset >= self.n_days:
+            return None
+        return offset
+
+    def date_of(self, offset):
+        return dt.date.fromordinal(self.origin + int(offset))
+
+    def dates(self):
+        return [self.date_of(offset) for offset in range(self.n_days)]
+
+    # arrays
+
+    def _new_array(self, region_capacity, day_capacity):
+        return np.full((region_capacity, day_capacity), np.nan)
+
+    def _reallocate(self, region_capacity, day_capacity, shift):
+        n_regions = len(self.regions)
+        for source_arrays in self._arrays.values():
+            for datatype, old in source_arrays.items():
+                if old is None:
+                    continue
+                new = self._new_array(region_capacity, day_capacity)
+                new[:n_regions, shift:shift + self.n_days] = old[:n_regions, :self.n_days]
+                source_arrays[datatype] = new
+        self._region_capacity = region_capacity
+        self._day_capacity = day_capacity
+
+    def _storage(self, source, datatype):
+        source_arrays = self._arrays.setdefault(source, {})
+        if source_arrays.get(datatype) is None:
+            source_arrays[datatype] = self._new_array(self._region_capacity, self._day_capacity)
+        return source_arrays[datatype][:len(self.regions), :self.n_days]
+
+    def array(self, source, datatype):
+        """ returns the [region_id, day_offset] array for (source, datatype), creating it
+
+        A lazy type is computed for every region first.
+        """
+        if (source, datatype) in self._lazy:
+            self._compute(source, datatype, np.arange(len(self.regions)))
+        return self._storage(source, datatype)
+
+    def rows(self, source, datatype, rids):
+        """ array(source, datatype)[rids], computing only those rows of a lazy type """
+        rids = np.asarray(rids, dtype=np.intp)
+        if (source, datatype) in self._lazy:
+            self._compute(source, datatype, rids)
+        elif not self.has_array(source, datatype):
+            return np.full((len(rids), self.n_days), np.nan)
+        return self._storage(source, datatype)[rids]
+
+    def has_array(self, source, datatype):
+        return datatype in self._arrays.get(source, {})
+
+    # lazy types
+
+    def derive_lazily(self, source, datatype, derivation):
+        """ declares datatype of source as computed by derivation when first read, dropping
+            whatever it held
+        """
+        source_arrays = self._arrays.setdefault(source, {})
+        source_arrays[datatype] = None
+        self._lazy[(source, datatype)] = [derivation, np.zeros(0, dtype=bool)]
+
+    def is_lazy(self, source, datatype):
+        return (source, datatype) in self._lazy
+
+    def _compute(self, source, datatype, rids):
+        with self._lazy_lock:
+            entry = self._lazy.get((source, datatype))
+            if entry is None:
+                return
+            derivation, done = entry
+            if len(done) < len(self.regions):
+                done = entry[1] = np.concatenate(
+                    [done, np.zeros(len(self.regions) - len(done), dtype=bool)])
+            todo = np.unique(rids[~done[rids]])
+            if len(todo):
+                with instrument.stage(f"lazy:{datatype}:{source}"):
+                    inputs = [self.rows(source, name, todo) for name in derivation.inputs]
+                    out = np.full((len(todo), self.n_days), np.nan)
+                    derivation.compute(inputs, out)
+                    self._storage(source, datatype)[todo] = out
+                done[todo] = True
+            if done.all():
+                del self._lazy[(source, datatype)]
+
+    def materialize(self):
+        """ computes every lazy type, the store then holds what an eager derive would """
+        for source, datatype in list(self._lazy):
+            self.array(source, datatype)
+
+    def types(self, source):
+        return list(self._arrays.get(source, {}))
+
+    def set_value(self, source, region, datatype, date, val):
+        rid = self.region_id(region)
+        offset = self.day_offset(date)
+        self.array(source, datatype)[rid, offset] = val
+
+    def region_mask(self, source):
+        """ boolean mask over region ids that hold any data in source
+
+        Lazy types are derived from the others and add no regions, they are not computed.
+        """
+        mask = np.zeros(len(self.regions), dtype=bool)
+        for name, _, values in self.arrays():
+            if name == source:
+                mask |= ~np.isnan(values).all(axis=1)
+        return mask
+
+    def source_region_ids(self, source):
+        return np.flatnonzero(self.region_mask(source)).tolist()
+
+    def arrays(self):
+        """ yields (source, datatype, array) for every computed array in the store, lazy types
+            are left out until every row of them is computed
+        """
+        for source, source_arrays in self._arrays.items():
+            for datatype in source_arrays:
+                if (source, datatype) not in self._lazy:
+                    yield source, datatype, self.array(source, datatype)
+
+    def layout(self):
+        """ yields (source, datatype, array or Derivation) for every type, in types() order """
+        for source, source_arrays in self._arrays.items():
+            for datatype in source_arrays:
+                entry = self._lazy.get((source, datatype))
+                if entry is not None:
+                    yield source, datatype, entry[0]
+                else:
+                    yield source, datatype, self.array(source, datatype)
+
+    def merge(self, other):
+        """ copies the present values of every array of other into this store
+
+        Lazy types of other stay lazy here, unless this store already computed the type.
+        """
+        if other.origin is None:
+            return
+        rids = np.array([self.region_id(region) for region in other.regions], dtype=np.intp)
+        self.ordinal_offset(other.origin + other.n_days - 1)
+        start = self.ordinal_offset(other.origin)
+        days = slice(start, start + other.n_days)
+        for source, datatype, values in other.layout():
+            if isinstance(values, Derivation):
+                if not self.has_array(source, datatype) or self.is_lazy(source, datatype):
+                    self.derive_lazily(source, datatype, values)
+                    continue
+                values = other.array(source, datatype)
+            target = self.array(source, datatype)
+            block = target[rids, days]
+            np.copyto(block, values, where=~np.isnan(values))
+            target[rids, days] = block
+
+    def copy(self):
+        """ a writable copy trimmed to the current regions and days, lazy types still lazy """
+        arrays = {(source, datatype): values if isinstance(values, Derivation) else
+                  np.array(values) for source, datatype, values in self.layout()}
+        origin = self.date_of(0) if self.origin is not None else None
+        return TimeSeriesStore.from_arrays(self.regions, origin, arrays)
+
+    def aligned(self, other, source, datatype):
+        """ other's array for (source, datatype) laid out on this store's regions and days
+
+        Every region and day of other must already be interned here.  Regions and days other
+        does not have are NaN.
+        """
+        values = np.full((len(self.regions), self.n_days), np.nan)
+        if other.origin is None or not other.has_array(source, datatype):
+            return values
+        rids = np.array([self.region_ids[region] for region in other.regions], dtype=np.intp)
+        start = self.find_day(other.date_of(0))
+        values[rids, start:start + other.n_days] = other.array(source, datatype)
+        return values
+
+    @classmethod
+    def from_arrays(cls, regions, origin, arrays):
+        """ builds a store around existing [region_id, day_offset] arrays
+
+        arrays maps (source, datatype) to arrays that all have one row per region and the same
+        number of days, starting at the date origin, or to the Derivation of a lazy type.  They
+        are used as they are, so read-only (for example memory-mapped) arrays give a read-only
+        store.
+        """
+        store = cls()
+        for region in regions:
+            store.region_ids[region] = len(store.regions)
+            store.regions.append(region)
+        shapes = {values.shape for values in arrays.values() if not isinstance(values, Derivation)}
+        if len(shapes) > 1:
+            raise ValueError(f"arrays of different shapes {shapes}")
+        n_days = shapes.pop()[1] if shapes else 0
+        if n_days:
+            store.origin = origin.toordinal()
+            store.n_days = n_days
+        store._region_capacity = max(len(regions), 1)
+        store._day_capacity = max(n_days, 1)
+        for (source, datatype), values in arrays.items():
+            if isinstance(values, Derivation):
+                store.derive_lazily(source, datatype, values)
+            else:
+                store._arrays.setdefault(source, {})[datatype] = values
+        return store
+
+    def nbytes(self):
+        return sum(arr.nbytes for arrays in self._arrays.values() for arr in arrays.values()
+                   if arr is not None)
+
+    # read-only mapping protocol: source -> SourceView
+
+    def __getitem__(self, source):
+        if source not in self._arrays:
+            raise KeyError(source)
+        return SourceView(self, source)
+
+    def __iter__(self):
+        return iter(list(self._arrays))
+
+    def __len__(self):
+        return len(self._arrays)
+
+
+class SourceView(Mapping):
+    """ region -> RegionView for one source """
+    def __init__(self, store, source):
+        self.store = store
+        self.source = source
+        self._mask = store.region_mask(source)
+
+    def __getitem__(self, region):
+        rid = self.store.find_region(region)
+        if rid is None or not self._mask[rid]:
+            raise KeyError(region)
+        return RegionView(self.store, self.source, rid)
+
+    def __iter__(self):
+        regions = self.store.regions
+        return (regions[rid] for rid in np.flatnonzero(self._mask))
+
+    def __len__(self):
+        return int(self._mask.sum())
+
+
+class RegionView(Mapping):
+    """ type -> SeriesView for one region of one source """
+    def __init__(self, store, source, rid):
+        self.store = store
+        self.source = source
+        self.rid = rid
+
+    def _types(self):
+        return [datatype for datatype in self.store.types(self.source)
+                if not np.isnan(self.store.array(self.source, datatype)[self.rid]).all()]
+
+    def __getitem__(self, datatype):
+        if datatype not in self._types():
+            raise KeyError(datatype)
+        return SeriesView(self.store, self.store.array(self.source, datatype)[self.rid])
+
+    def __iter__(self):
+        return iter(self._types())
+
+    def __len__(self):
+        return len(self._types())
+
+
+class SeriesView(Mapping):
+    """ date -> value for one row, skipping missing days """
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, date):
+        offset = self.store.find_day(date)
+        if offset is None or np.isnan(self.row[offset]):
+            raise KeyError(date)
+        return float(self.row[offset])
+
+    def __iter__(self):
+        return (self.store.date_of(offset) for offset in np.flatnonzero(~np.isnan(self.row)))
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self.row)))
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+""" Writing the master map out as a table
+
+Every format writes one row per (source, region, type) series over the days from start_date to
+the last day in the store.  Rows are formatted whole from the store arrays and written through
+one large buffer instead of one print() per value.
+
+    text     the original dump: "source:region:type v v v ...     last-date", each row running
+             from start_date (or the series' first day) up to its first gap
+    csv/tsv  source, country, subdivision, microdivision, type, then one column per date
+    jsonl    one object per series with the start date and a list of values, null if missing
+    parquet  the csv columns as an Apache Parquet file, needs pyarrow
+    arrow    the same table as an Arrow IPC file, needs pyarrow
+
+Counts are written as integers, rate_ series and the fractional metrics of metrics.py with three
+decimals, parquet and arrow keep the float64 values as they are.
+"""
+
+import contextlib
+import csv
+import importlib.util
+import io
+import json
+import metrics
+import numpy as np
+import sys
+
+FORMATS = ["text", "csv", "tsv", "jsonl", "parquet", "arrow"]
+BINARY_FORMATS = {"parquet", "arrow"}
+WRITE_BUFFER = 1 << 20
+REGION_COLUMNS = ["country", "subdivision", "microdivision"]
+
+
+def needs_pyarrow(fmt):
+    """ returns an error message when fmt needs pyarrow and it is not installed """
+    if fmt not in BINARY_FORMATS:
+        return None
+    if importlib.util.find_spec("pyarrow") is None:
+        return f"--format {fmt} needs pyarrow, install it with 'pip install pyarrow'"
+    return None
+
+
+def decimals(datatype):
+    return 3 if "rate_" in datatype or datatype in metrics.FRACTIONAL_TYPES else 0
+
+
+def value_format(datatype):
+    return f"{{:.{decimals(datatype)}f}}"
+
+
+def series(master_map):
+    """ yields (source, region, datatype, row) for every series holding data, in the order of
+        the text dump
+    """
+    for source in master_map:
+        datatypes = master_map.types(source)
+        arrays = [master_map.array(source, datatype) for datatype in datatypes]
+        present = np.array([~np.isnan(values).all(axis=1) for values in arrays])
+        for rid in np.flatnonzero(present.any(axis=0)):
+            region = master_map.regions[rid]
+            for datatype, values, has_data in zip(datatypes, arrays, present[:, rid]):
+                if has_data:
+                    yield source, region, datatype, values[rid]
+
+
+def series_rows(master_map, start_date):
+    """ series() with each row cut to the days from start_date on """
+    if master_map.origin is None:
+        return
+    start = max(0, start_date.toordinal() - master_map.origin)
+    for source, region, datatype, row in series(master_map):
+        yield source, region, datatype, row[start:]
+
+
+def text_lines(master_map, start_date):
+    """ the lines print_master_map used to print """
+    if master_map.origin is None:
+        return
+    start = start_date.toordinal() - master_map.origin
+    for source, region, datatype, row in series(master_map):
+        begin = max(start, int(np.flatnonzero(~np.isnan(row))[0]))
+        end = begin
+        if begin < len(row) and not np.isnan(row[begin]):
+            gaps = np.flatnonzero(np.isnan(row[begin:]))
+            end = begin + int(gaps[0]) if len(gaps) else len(row)
+        fmt = value_format(datatype)
+        values = "".join(" " + fmt.format(value) for value in row[begin:end].tolist())
+        last = master_map.date_of(end - 1)
+        yield f"{source}:{region}:{datatype} {values}     {last:%Y-%m-%d}\n"
+
+
+def region_cells(region):
+    return list(region) + [""] * (len(REGION_COLUMNS) - len(region))
+
+
+def header_dates(master_map, start_date):
+    start = max(0, start_date.toordinal() - master_map.origin)
+    return [f"{master_map.date_of(offset):%Y-%m-%d}" for offset in range(start, master_map.n_days)]
+
+
+def write_delimited(output, master_map, start_date, delimiter, header=True):
+    writer = csv.writer(output, delimiter=delimiter, lineterminator="\n")
+    if master_map.origin is None:
+        return
+    if header:
+        writer.writerow(["source"] + REGION_COLUMNS + ["type"] +
+                        header_dates(master_map, start_date))
+    for source, region, datatype, row in series_rows(master_map, start_date):
+        fmt = value_format(datatype)
+        cells = ["" if value != value else fmt.format(value) for value in row.tolist()]
+        writer.writerow([source] + region_cells(region) + [datatype] + cells)
+
+
+def write_jsonl(output, master_map, start_date):
+    if master_map.origin is None:
+        return
+    start = max(start_date.toordinal() - master_map.origin, 0)
+    start = f"{master_map.date_of(start):%Y-%m-%d}"
+    for source, region, datatype, row in series_rows(master_map, start_date):
+        digits = decimals(datatype)
+        values = [None if value != value else round(value, digits) if digits else int(round(value))
+                  for value in row.tolist()]
+        output.write(json.dumps({"source": source, "region": list(region), "type": datatype,
+                                 "start": start, "values": values}) + "\n")
+
+
+def arrow_table(master_map, start_date):
+    import pyarrow as pa
+    rows = list(series_rows(master_map, start_date))
+    columns = {"source": pa.array([source for source, _, _, _ in rows], pa.string())}
+    for index, name in enumerate(REGION_COLUMNS):
+        columns[name] = pa.array([region[index] if index < len(region) else None
+                                  for _, region, _, _ in rows], pa.string())
+    columns["type"] = pa.array([datatype for _, _, datatype, _ in rows], pa.string())
+    if rows:
+        block = np.stack([row for _, _, _, row in rows])
+        for index, date in enumerate(header_dates(master_map, start_date)):
+            columns[date] = pa.array(block[:, index], from_pandas=True)
+    return pa.table(columns)
+
+
+def open_output(path, fmt):
+    """ a buffered file for path, or for stdout when path is None or "-" """
+    binary = fmt in BINARY_FORMATS
+    if path in (None, "-"):
+        sys.stdout.flush()
+        try:
+            fileno = sys.stdout.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            # stdout was replaced, by contextlib.redirect_stdout for example
+            return contextlib.nullcontext(sys.stdout.buffer if binary else sys.stdout)
+        if binary:
+            return open(fileno, 'wb', buffering=WRITE_BUFFER, closefd=False)
+        return open(fileno, 'w', buffering=WRITE_BUFFER, newline='', closefd=False)
+    if binary:
+        return open(path, 'wb', buffering=WRITE_BUFFER)
+    return open(path, 'w', buffering=WRITE_BUFFER, newline='')
+
+
+class TableWriter(object):
+    """ writes stores over the same days one after the other as a single table
+
+    streaming.py writes the master map a chunk of regions at a time through it, the header is
+    written once.  close() finishes the parquet and arrow files.
+    """
+    def __init__(self, output, start_date, fmt="text"):
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown format {fmt}, expected one of {FORMATS}")
+        self.output = output
+        self.start_date = start_date
+        self.fmt = fmt
+        self.header = True
+        # the pyarrow writer, opened with the schema of the first table with rows
+        self.batches = None
+        self.empty = None
+        if fmt == "text":
+            output.write(f"ZZZ {start_date}\n")
+
+    def write(self, master_map):
+        if self.fmt == "text":
+            self.output.writelines(text_lines(master_map, self.start_date))
+        elif self.fmt in ("csv", "tsv"):
+            write_delimited(self.output, master_map, self.start_date,
+                            "," if self.fmt == "csv" else "\t", self.header)
+            self.header = self.header and master_map.origin is None
+        elif self.fmt == "jsonl":
+            write_jsonl(self.output, master_map, self.start_date)
+        else:
+            self.write_arrow(arrow_table(master_map, self.start_date))
+
+    def write_arrow(self, table, empty=False):
+        if not table.num_rows and not empty:
+            # without rows there are no date columns, only written if nothing else is
+            if self.batches is None:
+                self.empty = table
+            return
+        if self.batches is None:
+            if self.fmt == "parquet":
+                import pyarrow.parquet as pq
+                self.batches = pq.ParquetWriter(self.output, table.schema)
+            else:
+                import pyarrow as pa
+                self.batches = pa.ipc.new_file(self.output, table.schema)
+        self.batches.write_table(table)
+
+    def close(self):
+        if self.fmt not in BINARY_FORMATS:
+            return
+        if self.batches is None and self.empty is not None:
+            self.write_arrow(self.empty, empty=True)
+        if self.batches is not None:
+            self.batches.close()
+
+
+def write_table(output, master_map, start_date, fmt="text"):
+    """ writes master_map from start_date on to the open file output in format fmt """
+    table = TableWriter(output, start_date, fmt)
+    table.write(master_map)
+    table.close()
+
+
+def write_master_map(path, master_map, start_date, fmt="text"):
+    with open_output(path, fmt) as output:
+        write_table(output, master_map, start_date, fmt)
+
+
+def main():
+    import datetime as dt
+    from timeseries import TimeSeriesStore
+    store = TimeSeriesStore()
+    day = dt.date(2020, 3, 1)
+    for offset, value in enumerate([1, 2, 4, float("nan"), 8]):
+        if value == value:
+            store.set_value("src", ("A",), "total_cases", day + dt.timedelta(offset), value)
+    store.set_value("src", ("B", "X"), "rate_total_cases", day, 0.5)
+    text, table = io.StringIO(), io.StringIO()
+    write_table(text, store, day + dt.timedelta(1))
+    write_table(table, store, day, "csv")
+    # counts that are not whole, like a consensus median, round alike in every format
+    halves = TimeSeriesStore()
+    for offset, value in enumerate([2.5, 3.7]):
+        halves.set_value("src", ("A",), "total_cases", day + dt.timedelta(offset), value)
+    halves_csv, halves_jsonl = io.StringIO(), io.StringIO()
+    write_table(halves_csv, halves, day, "csv")
+    write_table(halves_jsonl, halves, day, "jsonl")
+    print(all([
+        text.getvalue().splitlines() == ["ZZZ 2020-03-02",
+                                         "src:('A',):total_cases  2 4     2020-03-03",
+                                         "src:('B', 'X'):rate_total_cases      2020-03-01"],
+        table.getvalue().splitlines()[1:] == ["src,A,,,total_cases,1,2,4,,8",
+                                              "src,B,X,,rate_total_cases,0.500,,,,"],
+        halves_csv.getvalue().splitlines()[1] == "src,A,,,total_cases,2,4",
+        json.loads(halves_jsonl.getvalue())["values"] == [2, 4],
+    ]))
+
+
+if __name__ == '__main__':
+    main()